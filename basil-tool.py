@@ -9,31 +9,158 @@ import logging
 import shutil
 import sqlite3
 import time
+import fcntl
+import json
+import socket
+import socketserver
+import traceback
+import threading
+import signal
+import queue
+import select
+import collections
+import io
+import concurrent.futures
+import re
+import contextlib
+import contextvars
+import functools
+import mmap
+import struct
+import bisect
+import gzip
+import multiprocessing
+import weakref
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# the cache root and daemon socket, and the client shim
+from basil_client import CACHE_ROOT, DAEMON_SOCKET, check_owner, run_client
 
 READELF_BIN=shutil.which("readelf")
 JAVA_BIN=shutil.which("java")
 BOOGIE_BIN=shutil.which("boogie")  # /root/.dotnet/tools/boogie
 BAP_BIN=shutil.which("bap")
 BASIL_BIN=shutil.which("basil")
-# Broken
-MODEL_TOOL_BIN="/home/am/Documents/programming/2023/basil-tools/modelTool/bin/Debug/net6.0/linux-x64/modelTool"
 
 DEFAULT_LOGGER_NAME = 'default_logger'
 
-JOB_TABLE = "create table if not exists jobs (job string, resultname string, resultfile string);"
+# Eviction limits for the cache root, see cleanup_tempdirs.
+CACHE_MAX_BYTES = int(os.environ.get("BASIL_TOOL_CACHE_BYTES", 10 * 1024 ** 3))
+CACHE_MAX_ENTRIES = int(os.environ.get("BASIL_TOOL_CACHE_ENTRIES", 1000))
+CACHE_MAX_AGE = float(os.environ.get("BASIL_TOOL_CACHE_AGE", 7 * 24 * 3600))
+# Resident basil JVMs, only used in daemon mode. BASIL_WORKER_CMD starts one
+# worker, e.g. "java -cp basil.jar etc/scripts/basil-worker/BasilWorker.java".
+BASIL_WORKER_CMD = os.environ.get("BASIL_WORKER_CMD")
+
+# Part of every tool's fingerprint, set it to something new when upgrading a
+# tool in a way tool_fingerprint can't see.
+TOOLCHAIN_ID = os.environ.get("BASIL_TOOL_TOOLCHAIN")
+BASIL_WORKERS = int(os.environ.get("BASIL_WORKERS", 2))
+# Workers are restarted after this many jobs to bound leaks in the JVM.
+BASIL_WORKER_JOBS = int(os.environ.get("BASIL_WORKER_JOBS", 50))
+
+# Number of Boogie processes to verify a program's procedures with, 1 runs
+# Boogie once over the whole file.
+BOOGIE_JOBS = int(os.environ.get("BOOGIE_JOBS", os.cpu_count() or 1))
+
+# ioctl to clone a file's extents, from linux/fs.h
+FICLONE = 0x40049409
+
+# Subprocess output goes straight to files, only this much of it is logged.
+LOG_PREVIEW_BYTES = 4096
+
+# Minimum seconds between the sweeps run at the end of a request.
+SWEEP_INTERVAL = float(os.environ.get("BASIL_TOOL_SWEEP_INTERVAL", 600))
+
+# Host wide limits on concurrently running heavy stages, see stage_slots.
+# BASIL_TOOL_SLOTS overrides them, e.g. "bap=2,basil=2,boogie=1,total=4,cores=8".
+STAGE_SLOTS = os.environ.get("BASIL_TOOL_SLOTS")
+# Give up on a stage that could not start within this many seconds, rather
+# than run into the compile timeout with the work still queued.
+ADMISSION_TIMEOUT = float(os.environ.get("BASIL_TOOL_ADMISSION_TIMEOUT", 240))
+
+# Outputs stored compressed, see compress_artifact.
+COMPRESSED_OUTPUTS = ("adt", "bir")
+ARTIFACT_ZSTD_LEVEL = int(os.environ.get("BASIL_TOOL_ZSTD_LEVEL", 9))
+# ADT bytes to train a compression dictionary on, see train_dictionary.
+DICTIONARY_SAMPLE_BYTES = 100 * 1024 ** 2
+DICTIONARY_BYTES = 112 * 1024
+
+# Key cache entries on the normalised digest of ELF binaries rather than
+# their bytes, see ElfFile.normalised_digest. Off until --check-normalisation
+# has passed on a corpus with BAP installed.
+NORMALISE_BINARIES = os.environ.get("BASIL_TOOL_NORMALISE", "0") != "0"
+
+# A stage still running after this many seconds has its processes killed,
+# before lib/tooling/basil.ts gives up on us at 300s.
+STAGE_TIMEOUT = float(os.environ.get("BASIL_TOOL_STAGE_TIMEOUT", 280))
+# Seconds between SIGTERM and SIGKILL when tearing down a process group.
+KILL_GRACE = 5
+
+# Shared artifact store for outputs of cached stages, see remote_from_config.
+REMOTE_CACHE = os.environ.get("BASIL_TOOL_REMOTE_CACHE")
+
+# Prometheus text file and per request JSON lines, under the cache directory
+# unless set. See record_metrics.
+METRICS_FILE = os.environ.get("BASIL_TOOL_METRICS")
+METRICS_LOG = os.environ.get("BASIL_TOOL_METRICS_LOG")
+# The log is moved to <log>.1 once it grows past this, replacing the last one.
+METRICS_LOG_BYTES = int(os.environ.get("BASIL_TOOL_METRICS_LOG_BYTES", 64 * 1024 ** 2))
+
+ENTRY_TABLE = "create table if not exists entries (entry string unique, bytes integer, last_access real);"
+
+ENTRY_INDEX = "create index if not exists entries_last_access on entries (last_access);"
+
+TOOL_TABLE = "create table if not exists tools (stat string unique, digest string);"
 
-QUEUE_TABLE = "create table if not exists jclaimed (job string unique);"
+JOB_TABLE = """create table if not exists jobs (job string, resultname string, resultfile string,
+    bytes integer, created real, last_access real, hits integer default 0, primary key (job, resultname));"""
 
+QUEUE_TABLE = "create table if not exists jclaimed (job string unique, pid integer, claimed real);"
 
-def get_tempdir(seed: str):
-    m = hashlib.md5()
-    m.update(seed.encode('utf8'))
-    dir_name = os.path.join(tempfile.gettempdir(), "basil-tool", m.hexdigest())
+ADMISSION_TABLE = """create table if not exists admission (ticket integer primary key autoincrement, stage string,
+    priority integer, pid integer, enqueued real, admitted real, processes integer default 1, held real);"""
+
+# normalised digests of binaries by device, inode, size and mtime
+NORMALISED_TABLE = "create table if not exists normalised (stat string unique, digest string, created real);"
+
+IMPORT_TABLE = "create table if not exists imports (path string primary key, source string, digest string, bytes integer, mtime_ns integer);"
+
+# How long to wait for another process computing the same job, this matches
+# the compileTimeoutMs that lib/tooling/basil.ts runs us with.
+CLAIM_WAIT_TIMEOUT = 300
+CLAIM_POLL_INTERVAL = 0.2
+CLAIM_DB_TIMEOUT = 30
+
+
+def private_dir(path: str) -> str:
+    """
+    Create a directory only we can use, or check that an existing one is ours.
+    """
+    try:
+        os.makedirs(path, mode=0o700)
+        # makedirs' mode is subject to the umask
+        os.chmod(path, 0o700)
+    except FileExistsError:
+        pass
+    check_owner(path)
+    return path
+
+def get_tempdir(bin_hash: str, cache_root: str = CACHE_ROOT):
+    """
+    Return the persistent job directory for a binary, keyed by its content hash.
+    """
+    dir_name = os.path.join(cache_root, bin_hash)
     if not os.path.exists(dir_name):
         logging.info("Created Dir %s", dir_name)
-        os.makedirs(dir_name)
+        os.makedirs(dir_name, exist_ok=True)
     else:
         logging.info("Dir Exists %s", dir_name )
+    check_owner(dir_name)
     return dir_name
 
 def make_tempdir(ignored: str):
@@ -43,19 +170,154 @@ def bin_name(tmp_dir) -> str:
     bin_file = os.path.join(tmp_dir, "a.out")
     return bin_file
 
-def read_write_binary(tmp_dir:str, filename: str) -> str:
+def hash_binary(filename: str, cache_root: str | None = None) -> str:
     """
-    Save binary from stdin.
+    The key of a binary's cache entry: its normalised digest if it is an ELF
+    file we can read, otherwise the digest of its contents. Normalised
+    digests are remembered in the index of `cache_root`, if given, against
+    the file's device, inode, size and mtime.
     """
-
+    if NORMALISE_BINARIES:
+        try:
+            if cache_root is None:
+                return normalised_digest(filename)
+            st = os.stat(filename)
+            stat = f"{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}"
+            db = index_db(cache_root)
+            rows = db.query("SELECT digest FROM normalised WHERE stat=?;", [stat])
+            if rows:
+                return rows[0][0]
+            digest = normalised_digest(filename)
+            now = time.time()
+            with db.transaction() as con:
+                # compilation directories don't outlive the cache's entries
+                con.execute("DELETE FROM normalised WHERE created<?;", [now - CACHE_MAX_AGE])
+                con.execute("INSERT OR REPLACE INTO normalised VALUES (?, ?, ?);", [stat, digest, now])
+            return digest
+        except ElfError as e:
+            logging.info(f"not normalising {filename}: {e}")
     bin_hash = hashlib.sha3_256()
-    content = sys.stdin.buffer.read()
-    bin_hash.update(content)
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            bin_hash.update(chunk)
+    return bin_hash.hexdigest()
+
+def normalised_digest(filename: str) -> str:
+    with ElfFile(filename) as elf:
+        return elf.normalised_digest()
+
+def file_digest(filename: str) -> str:
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def installed_digest(path: str, cache_root: str) -> str:
+    """
+    Digest of a file's contents, remembered in the index against the file's
+    path, size and mtime.
+    """
+    st = os.stat(path)
+    stat = f"{os.path.realpath(path)}:{st.st_size}:{st.st_mtime_ns}"
+    db = index_db(cache_root)
+    rows = db.query("SELECT digest FROM tools WHERE stat=?;", [stat])
+    if rows:
+        return rows[0][0]
+    digest = file_digest(path)
+    with db.transaction() as con:
+        con.execute("INSERT OR REPLACE INTO tools VALUES (?, ?);", [stat, digest])
+    return digest
+
+TOOL_PARTS = re.compile(rb"[\w./+-]+\.(?:jar|dll)\b")
+
+def tool_files(path: str) -> list:
+    """
+    The files making up an installed tool besides its launcher, which often
+    stays the same when the tool is upgraded: the jars and assemblies named
+    by a launcher script, found as given or next to it or in ../lib, and the
+    assemblies of a dotnet tool in the .store beside its shim.
+    """
+    real = os.path.realpath(path)
+    base = os.path.dirname(real)
+    files = set()
+    with open(real, 'rb') as f:
+        head = f.read(1 << 16)
+    if head.startswith(b"#!"):
+        for m in TOOL_PARTS.finditer(head):
+            name = os.fsdecode(m.group())
+            for candidate in [name, os.path.join(base, name), os.path.join(base, "..", "lib", os.path.basename(name))]:
+                if os.path.isfile(candidate):
+                    files.add(os.path.realpath(candidate))
+                    break
+    store = os.path.join(base, ".store", os.path.basename(real).lower())
+    for root, dirs, names in os.walk(store):
+        files.update(os.path.join(root, name) for name in names if name.endswith(".dll"))
+    return sorted(files)
+
+# Results that can't change while a request runs, see memoised.
+REQUEST_MEMO = contextvars.ContextVar("REQUEST_MEMO", default=None)
+
+
+def memoised(fn):
+    """
+    Compute fn once per request for the same arguments, as set up by main and
+    run_batch_stage. The arguments are compared by repr.
+    """
+    @functools.wraps(fn)
+    def lookup(*args):
+        memo = REQUEST_MEMO.get()
+        if memo is None:
+            return fn(*args)
+        key = (fn.__name__, repr(args))
+        if key not in memo:
+            memo[key] = fn(*args)
+        return memo[key]
+    return lookup
+
+
+@memoised
+def spec_digest(spec: str | None) -> str | None:
+    return spec and file_digest(spec)
+
+
+@memoised
+def tool_fingerprint(path: str | None, cache_root: str, also: list = ()) -> str:
+    """
+    Identifies an installed tool without running it, by the digests of its
+    launcher, the files behind it (see tool_files) and the files in `also`,
+    so that it is the same on every node. BASIL_TOOL_TOOLCHAIN, if set, is
+    folded in too, for upgrades these don't show.
+    """
+    try:
+        parts = [installed_digest(path, cache_root)]
+        parts += [installed_digest(f, cache_root) for f in tool_files(path) + list(also)]
+    except (TypeError, OSError):
+        return "missing"
+    if not parts[1:] and not TOOLCHAIN_ID:
+        # as before, keeps the keys of tools that are a single file
+        return parts[0]
+    return hashlib.sha256(json.dumps([parts, TOOLCHAIN_ID]).encode('utf8')).hexdigest()
+
+def write_atomic(path: str, content: bytes):
+    """
+    Write a file so that concurrent readers see either nothing or the whole file.
+    """
+    with publishing(path) as (tmp,):
+        with open(tmp, 'wb') as f:
+            f.write(content)
+
+def read_write_binary(tmp_dir:str, filename: str, hex_hash: str | None = None) -> str:
+    """
+    Save binary into the job directory, unless a previous invocation already did.
+    """
+
+    if hex_hash is None:
+        hex_hash = hash_binary(filename)
     bin_file = bin_name(tmp_dir)
 
 
     hash_file = os.path.join(tmp_dir, "bin_hash.sha256")
-    hex_hash = bin_hash.hexdigest()
 
     if (os.path.exists(hash_file)):
         logging.info("Binary Exists")
@@ -65,374 +327,3820 @@ def read_write_binary(tmp_dir:str, filename: str) -> str:
             logging.info("Error: binary mismatch, got the binary from a different compilation?")
     else:
         logging.info("Writing binary %s", bin_file)
-        with open(hash_file, 'w') as f:
-            f.write(hex_hash)
-        with open(bin_file, 'wb') as f:
-            f.write(content)
+        with open(filename, 'rb') as f:
+            write_atomic(bin_file, f.read())
+        write_atomic(hash_file, hex_hash.encode('utf8'))
 
     logging.info("Loaded binary: %s %s", hex_hash, bin_file)
-    print("binary", content)
     return bin_file
 
 
-def run_bap_lift(tmp_dir: str, use_asli: bool):
+def log_preview(path: str):
+    """
+    Log the start of a (possibly huge) output file.
+    """
+    if not logging.getLogger().isEnabledFor(logging.INFO):
+        return
+    with open(path, 'rb') as f:
+        preview = f.read(LOG_PREVIEW_BYTES)
+        truncated = f.read(1) != b""
+    logging.info("%s:\n%s%s", path, preview.decode('utf-8', errors='replace'), "\n[...]" if truncated else "")
+
+
+def remove_files(paths: list):
+    for path in paths:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def job_dir(tmp_dir: str, job: str) -> str:
+    """
+    Directory for the outputs of one job on the binary, so jobs with different
+    arguments never share a file.
+    """
+    d = os.path.join(tmp_dir, "job-" + hashlib.sha256(job.encode('utf8')).hexdigest()[:16])
+    os.makedirs(d, exist_ok=True)
+    return d
+
+
+def scratch_name(path: str) -> str:
+    """
+    Private name to build `path` under, next to it and with the same extension.
+    """
+    d, base = os.path.split(path)
+    return os.path.join(d, f".{os.getpid()}.{threading.get_ident()}.{base}")
+
+
+@contextlib.contextmanager
+def publishing(*paths):
+    """
+    Yields scratch names to write `paths` under. When the block finishes they
+    are renamed over `paths`, so concurrent readers only ever see complete
+    files, and hard links to the previous version (see copy_output) keep the
+    old content. An output that wasn't written removes the stale previous one.
+    """
+    scratch = [scratch_name(p) for p in paths]
+    remove_files(scratch)
+    try:
+        yield scratch
+        for tmp, path in zip(scratch, paths):
+            if os.path.exists(tmp):
+                os.replace(tmp, path)
+            else:
+                remove_files([path])
+    finally:
+        remove_files(scratch)
+
+
+"""
+Child processes run in their own process group and are registered with the
+request's ChildProcesses, so the whole tree under a tool (Boogie and its Z3
+solvers, BAP and its plugins) can be torn down at once: when the stage's
+deadline passes, when we receive SIGTERM or SIGINT, and in daemon mode when
+the client shim goes away. The stage then raises TimeoutError or Cancelled,
+publishing removes its scratch files and run_job drops anything the cache
+held for the job.
+"""
+
+class Cancelled(Exception):
+    pass
+
+
+# every ChildProcesses alive, for the signal handlers
+ALL_CHILDREN = weakref.WeakSet()
+
+
+class ChildProcesses:
+    def __init__(self):
+        self.running = set()
+        self.lock = threading.Lock()
+        # reason, once cancelled
+        self.cancelled = None
+        ALL_CHILDREN.add(self)
+
+    def start(self, command: list, **kwargs) -> subprocess.Popen:
+        with self.lock:
+            if self.cancelled is not None:
+                raise Cancelled(self.cancelled)
+            proc = subprocess.Popen(command, start_new_session=True, **kwargs)
+            self.running.add(proc)
+        return proc
+
+    def finished(self, proc: subprocess.Popen):
+        with self.lock:
+            self.running.discard(proc)
+
+    def cancel(self, reason: str):
+        """
+        Kill every running child's process group and refuse to start more.
+        """
+        with self.lock:
+            if self.cancelled is None:
+                self.cancelled = reason
+            running = list(self.running)
+        if running:
+            logging.info(f"{reason}, killing {len(running)} process groups")
+        for proc in running:
+            kill_group(proc)
+
+
+def kill_group(proc: subprocess.Popen):
+    """
+    SIGTERM a child's process group, then SIGKILL whatever is left of it
+    after KILL_GRACE seconds.
+    """
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return
+
+    def force():
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    timer = threading.Timer(KILL_GRACE, force)
+    timer.daemon = True
+    timer.start()
+
+
+# The children of this process, daemon requests each have their own.
+PROCESS_CHILDREN = ChildProcesses()
+
+CHILDREN = contextvars.ContextVar("CHILDREN", default=None)
+
+# monotonic time by which the running stage must finish
+STAGE_DEADLINE = contextvars.ContextVar("STAGE_DEADLINE", default=None)
+
+
+def current_children() -> ChildProcesses:
+    return CHILDREN.get() or PROCESS_CHILDREN
+
+
+@contextlib.contextmanager
+def stage_deadline(seconds: float = STAGE_TIMEOUT):
+    token = STAGE_DEADLINE.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        STAGE_DEADLINE.reset(token)
+
+
+def check_cancelled(what: str):
+    """
+    For loops polling on other processes, which run_command's kills can't
+    interrupt: raise once the request is cancelled or the stage's deadline
+    has passed.
+    """
+    cancelled = current_children().cancelled
+    if cancelled is not None:
+        raise Cancelled(cancelled)
+    deadline = STAGE_DEADLINE.get()
+    if deadline is not None and time.monotonic() >= deadline:
+        raise TimeoutError(f"Stage deadline passed {what}")
+
+
+def install_signal_handlers(status=None):
+    """
+    Tear down every child process tree on SIGTERM or SIGINT, including those
+    of batch pool workers, then exit with `status`, by default 128 + signal.
+    """
+    def terminate(signum, frame):
+        for children in list(ALL_CHILDREN):
+            children.cancel(f"received signal {signum}")
+        for worker in multiprocessing.active_children():
+            worker.terminate()
+        sys.exit(128 + signum if status is None else status)
+
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+
+
+def run_command(command: list, stdout_file: str, stderr_file: str, check: bool = False) -> int:
+    """
+    Run a command with its stdout and stderr written directly to files.
+    """
+    logging.info("command: %s", command)
+    children = current_children()
+    deadline = STAGE_DEADLINE.get()
+    if deadline is not None and time.monotonic() >= deadline:
+        raise TimeoutError(f"Stage deadline passed before {command[0]} could start")
+    expired = threading.Event()
+
+    def expire(proc):
+        expired.set()
+        kill_group(proc)
+
+    with publishing(stdout_file, stderr_file) as (stdout_tmp, stderr_tmp):
+        with open(stdout_tmp, 'wb') as out, open(stderr_tmp, 'wb') as err:
+            proc = children.start(command, stdout=out, stderr=err)
+            timer = None
+            if deadline is not None:
+                timer = threading.Timer(deadline - time.monotonic(), expire, [proc])
+                timer.daemon = True
+                timer.start()
+            try:
+                # wait4 rather than wait, for the resource usage of this child alone
+                _, status, usage = os.wait4(proc.pid, 0)
+            except BaseException:
+                kill_group(proc)
+                proc.wait()
+                raise
+            finally:
+                children.finished(proc)
+                if timer is not None:
+                    timer.cancel()
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            # before publishing, so the killed command's output is discarded
+            if expired.is_set():
+                raise TimeoutError(f"{command[0]} killed at the stage deadline")
+            if children.cancelled is not None:
+                raise Cancelled(children.cancelled)
+    stage = CURRENT_STAGE.get()
+    if stage is not None:
+        stage.add_child(usage)
+    log_preview(stdout_file)
+    log_preview(stderr_file)
+    if check and proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, command)
+    return proc.returncode
+
+
+def concat_files(dest: str, sources: list):
+    """
+    Copy the sources into dest one chunk at a time.
+    """
+    with publishing(dest) as (tmp,):
+        with open(tmp, 'wb') as out:
+            for source in sources:
+                with open(source, 'rb') as f:
+                    shutil.copyfileobj(f, out)
+
+
+def file_contains(path: str, needle: bytes) -> bool:
+    overlap = len(needle) - 1
+    with open(path, 'rb') as f:
+        tail = b""
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            if needle in tail + chunk:
+                return True
+            tail = chunk[-overlap:] if overlap else b""
+    return False
+
+
+"""
+The lifter's ADT and BIR dumps are large and very repetitive, so they are
+stored compressed: with zstandard when it is installed, gzip otherwise.
+Artifacts are read through open_artifact, which decompresses as it reads,
+so memory stays bounded however large the dump is.
+
+ADT files are compressed with a dictionary when one has been trained for the
+cache (--train-dictionary). Dictionaries are kept in dicts/ under the cache
+root by their id, which zstandard records in each frame, so artifacts written
+with an older dictionary can still be read. The codec and the current
+dictionary are part of the key of the stage writing the artifacts (see
+artifact_codec), so nodes sharing a remote cache only fetch artifacts they
+can read, and the first lift after training a dictionary runs again.
+"""
+
+COMPRESSED_SUFFIXES = (".zst", ".gz")
+
 
-    job = f"baplift_asli:{use_asli}"
-    cached = get_cache(tmp_dir, job)
-    if ("adt" in cached and "bir" in cached):
-        logging.info(f"using cached: {cached}")
-        return cached
+def is_compressed(path: str) -> bool:
+    return path.endswith(COMPRESSED_SUFFIXES)
 
+
+def artifact_name(path: str) -> str:
+    """
+    The name of an artifact without its compression suffix.
+    """
+    for suffix in COMPRESSED_SUFFIXES:
+        if path.endswith(suffix):
+            return path[:-len(suffix)]
+    return path
+
+
+def dictionary_dir(path: str) -> str:
+    """
+    dicts/ in the cache root holding the artifact, the first directory up
+    from it with an index.db.
+    """
+    d = os.path.dirname(os.path.abspath(path))
+    while not os.path.exists(os.path.join(d, "index.db")):
+        parent = os.path.dirname(d)
+        if parent == d:
+            raise FileNotFoundError(f"{path} is not in a cache directory")
+        d = parent
+    return os.path.join(d, "dicts")
+
+
+# path -> (mtime, ZstdCompressionDict)
+DICTIONARIES = {}
+
+
+def load_dictionary(dict_dir: str, dict_id: int | None = None):
+    """
+    The dictionary with the given id, or the current one for compressing ADT
+    files. None if there is no current dictionary.
+    """
+    path = os.path.join(dict_dir, f"{dict_id}.dict" if dict_id else "adt.dict")
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        if dict_id:
+            raise
+        return None
+    cached = DICTIONARIES.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path, 'rb') as f:
+            cached = DICTIONARIES[path] = (mtime, zstandard.ZstdCompressionDict(f.read()))
+    return cached[1]
+
+
+def artifact_codec(cache_root: str) -> str:
+    """
+    How artifacts written under cache_root are compressed.
+    """
+    if zstandard is None:
+        return "gzip"
+    dictionary = load_dictionary(os.path.join(cache_root, "dicts"))
+    return f"zstd {dictionary.dict_id() if dictionary is not None else 0}"
+
+
+def artifact_readable(path: str) -> bool:
+    """
+    Whether open_artifact can read an artifact here, which it can't if it was
+    fetched from a node with zstandard or a dictionary we lack.
+    """
+    if not os.path.exists(path):
+        return False
+    if not path.endswith(".zst"):
+        return True
+    if zstandard is None:
+        return False
+    with open(path, 'rb') as f:
+        try:
+            dict_id = zstandard.get_frame_parameters(f.read(18)).dict_id
+        except zstandard.ZstdError:
+            return False
+    return not dict_id or os.path.exists(os.path.join(dictionary_dir(path), f"{dict_id}.dict"))
+
+
+def compress_artifact(path: str, kind: str) -> str:
+    """
+    Replace an artifact with a compressed copy, returning the copy's name.
+    """
+    if zstandard is not None:
+        dest = path + ".zst"
+        dictionary = load_dictionary(dictionary_dir(path)) if kind == "adt" else None
+        compressor = zstandard.ZstdCompressor(level=ARTIFACT_ZSTD_LEVEL, dict_data=dictionary)
+        with publishing(dest) as (tmp,):
+            with open(path, 'rb') as src, open(tmp, 'wb') as out:
+                compressor.copy_stream(src, out)
+    else:
+        dest = path + ".gz"
+        with publishing(dest) as (tmp,):
+            with open(path, 'rb') as src, gzip.open(tmp, 'wb') as out:
+                shutil.copyfileobj(src, out, 1 << 20)
+    remove_files([path])
+    return dest
+
+
+def open_artifact(path: str):
+    """
+    Open an artifact for reading as a binary stream, decompressing it if it
+    is stored compressed.
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, 'rb')
+    if not path.endswith(".zst"):
+        return open(path, 'rb')
+    if zstandard is None:
+        raise RuntimeError(f"zstandard is needed to read {path}")
+    f = open(path, 'rb')
+    try:
+        # 18 bytes is the largest frame header
+        dict_id = zstandard.get_frame_parameters(f.read(18)).dict_id
+        f.seek(0)
+        dictionary = load_dictionary(dictionary_dir(path), dict_id) if dict_id else None
+        reader = zstandard.ZstdDecompressor(dict_data=dictionary).stream_reader(f, closefd=True)
+    except BaseException:
+        f.close()
+        raise
+    # buffered for readline and iteration
+    return io.BufferedReader(reader, 1 << 20)
+
+
+@contextlib.contextmanager
+def decompressed(path: str):
+    """
+    Yields the name of a plain copy of the artifact for tools that take file
+    names, removing it afterwards. Uncompressed artifacts are used in place.
+    """
+    if not is_compressed(path):
+        yield path
+        return
+    plain = scratch_name(artifact_name(path))
+    try:
+        with open_artifact(path) as f, open(plain, 'wb') as out:
+            shutil.copyfileobj(f, out, 1 << 20)
+        yield plain
+    finally:
+        remove_files([plain])
+
+
+def train_dictionary(cache_root: str, paths: list, out) -> int:
+    """
+    Train a dictionary for compressing ADT files on the ADT files (compressed
+    or not) under `paths`, and make it the current dictionary of the cache.
+    Returns its id.
+    """
+    if zstandard is None:
+        raise RuntimeError("training a dictionary needs zstandard")
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(os.path.join(root, name) for root, dirs, names in os.walk(path) for name in names)
+        else:
+            files.append(path)
+    samples = []
+    total = 0
+    for path in files:
+        if not artifact_name(path).endswith(".adt") or total >= DICTIONARY_SAMPLE_BYTES:
+            continue
+        # samples of a few lines each, the size of the dumps of small programs
+        with open_artifact(path) as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b""):
+                samples.append(chunk)
+                total += len(chunk)
+                if total >= DICTIONARY_SAMPLE_BYTES:
+                    break
+    if not samples:
+        raise ValueError("no ADT files to train on")
+    dictionary = zstandard.train_dictionary(DICTIONARY_BYTES, samples)
+    dict_dir = os.path.join(cache_root, "dicts")
+    os.makedirs(dict_dir, exist_ok=True)
+    # by id first, so no artifact can be written with a dictionary that can't be found
+    write_atomic(os.path.join(dict_dir, f"{dictionary.dict_id()}.dict"), dictionary.as_bytes())
+    write_atomic(os.path.join(dict_dir, "adt.dict"), dictionary.as_bytes())
+    print(f"Trained dictionary {dictionary.dict_id()} on {len(samples)} samples, {total} bytes", file=out)
+    return dictionary.dict_id()
+
+
+def run_bap_lift(tmp_dir: str, use_asli: bool):
     logging.info("Bap")
     adtfile = f"{tmp_dir}/out.adt"
     birfile = f"{tmp_dir}/out.bir"
 
     binary = bin_name(tmp_dir)
 
-    command = (f"{BAP_BIN} {binary}").split(" ")
-    args = [ "-d", f"adt:{adtfile}", "-d", f"bir:{birfile}"]
-    #if use_asli:
-    #    args += ["--primus-lisp-semantics=disable"]
-    #else:
-    #    args += ["--primus-lisp-semantics=enable"]
+    with publishing(adtfile, birfile) as (adt_tmp, bir_tmp):
+        command = (f"{BAP_BIN} {binary}").split(" ")
+        args = [ "-d", f"adt:{adt_tmp}", "-d", f"bir:{bir_tmp}"]
+        #if use_asli:
+        #    args += ["--primus-lisp-semantics=disable"]
+        #else:
+        #    args += ["--primus-lisp-semantics=enable"]
 
-    command += args
-    logging.info("command: %s", command)
-    if not (os.path.exists(adtfile) and os.path.exists(birfile)):
-        res = subprocess.run(command, check=True)
-        logging.info(res.stdout)
-        logging.info(res.stderr)
+        command += args
+        run_command(command, f"{tmp_dir}/bap_stdout", f"{tmp_dir}/bap_stderr", check=True)
 
-    result = {"adt": adtfile, "bir": birfile, "default": birfile}
-    update_cache(tmp_dir, job, result)
-    return result
+    outputs = {"adt": adtfile, "bir": birfile}
+    for kind in COMPRESSED_OUTPUTS:
+        outputs[kind] = compress_artifact(outputs[kind], kind)
+    return {**outputs, "default": outputs["bir"]}
 
 def run_readelf(tmp_dir):
-    job = "readelf"
-    cached = get_cache(tmp_dir, job)
-    if ("relf" in cached) :
-        return cached
-
     logging.info("Readelf")
-    command = [READELF_BIN, "-s", "-r", "-W", bin_name(tmp_dir)]
-    res = subprocess.run(command, capture_output=True, check=True)
-    logging.info(res.stdout)
-    logging.info(res.stderr)
-
     readelf_file = f"{tmp_dir}/out.relf"
+    symbols_file = f"{tmp_dir}/out.symbols.json"
+    try:
+        with ElfFile(bin_name(tmp_dir)) as elf:
+            with publishing(readelf_file) as (tmp,):
+                with open(tmp, 'wb') as f:
+                    elf.write_readelf(f)
+            symbols = [list(s) for s in elf.symbol_index()]
+    except ElfError as e:
+        if READELF_BIN is None:
+            raise
+        logging.info(f"reading the binary in process failed, running readelf: {e}")
+        command = [READELF_BIN, "-s", "-r", "-W", bin_name(tmp_dir)]
+        run_command(command, readelf_file, f"{tmp_dir}/readelf_stderr", check=True)
+        symbols = relf_symbols(readelf_file)
+    write_atomic(symbols_file, json.dumps(symbols).encode('utf8'))
 
-    with open(readelf_file, "w") as f:
-        f.write(res.stdout.decode('utf-8'))
+    return {"relf": readelf_file, "symbols": symbols_file, "default": readelf_file}
 
-    result = {"relf": readelf_file, "default": readelf_file}
-    update_cache(tmp_dir, job, result)
-    return result
-
-def run_basil(tmp_dir: str, args: list = [], spec: str | None = None):
-    job = f"basil {args} {spec}"
-    cached = get_cache(tmp_dir, job)
-    if (len(cached) > 0) :
-        logging.info(f"using cached: {cached}")
-        return cached
+def run_basil(tmp_dir: str, job: str, args: list = [], spec: str | None = None, inputs: dict = {},
+              functions: tuple = ()):
     logging.info("Basil")
-    boogie_file = f"{tmp_dir}/boogie_out.bpl"
+    work_dir = job_dir(tmp_dir, job)
+    boogie_file = f"{work_dir}/boogie_out.bpl"
     outputs = {"boogie": boogie_file, "basil-il": boogie_file + ".il"}
-
-    # dependencies
-    outputs.update(run_bap_lift(tmp_dir, False))
-    outputs.update(run_readelf(tmp_dir))
     outputs["default"] = boogie_file
     logging.info(f"run-basil  outputs {outputs}")
 
-    adtfile = outputs['adt']
-    birfile = outputs['bir']
-    readelf_file = outputs['relf']
-    #os.chdir(tmp_dir) # so  the output file is in the right dir
-    command = [BASIL_BIN]
-    files = ["-i", adtfile, "-r", readelf_file, "-o", boogie_file, '--dump-il', outputs['basil-il']]
-
-    if spec:
-        files += ["-s", spec]
-        outputs["spec"] = spec
-    command += files
-    logging.info(f"basil command {command}")
-    res = subprocess.run(command, capture_output=True, check=False)
-    logging.info(res.stdout.decode('utf-8'))
-    logging.info(res.stderr.decode('utf-8'))
+    readelf_file = inputs['relf']
+    stdout_file = f"{work_dir}/basil_stdout"
+    stderr_file = f"{work_dir}/basil_stderr"
+    with publishing(boogie_file, outputs['basil-il']) as (boogie_tmp, il_tmp), decompressed(inputs['adt']) as adtfile:
+        command = [BASIL_BIN]
+        files = ["-i", adtfile, "-r", readelf_file, "-o", boogie_tmp, '--dump-il', il_tmp]
+        if len(functions) == 1:
+            # basil translates only this procedure and its callees
+            files += ["--main-procedure", functions[0]]
 
+        if spec:
+            files += ["-s", spec]
+            outputs["spec"] = spec
+        command += files
+        logging.info(f"basil command {command}")
+        status = None
+        if BASIL_POOL is not None:
+            try:
+                with publishing(stdout_file, stderr_file) as (stdout_tmp, stderr_tmp):
+                    status = BASIL_POOL.run(files, stdout_tmp, stderr_tmp)
+                logging.info(f"basil worker status {status}")
+                log_preview(stdout_file)
+                log_preview(stderr_file)
+            except (RuntimeError, ValueError) as e:
+                logging.error(f"basil worker failed, running basil directly: {e}")
+            if status:
+                # inside publishing, so the failed run's outputs are discarded
+                raise subprocess.CalledProcessError(status, command)
+        if status is None:
+            run_command(command, stdout_file, stderr_file, check=True)
+
+    missing = [name for name in ("boogie", "basil-il") if not os.path.exists(outputs[name])]
+    if missing:
+        raise RuntimeError(f"basil exited without writing {', '.join(missing)}")
     logging.info("finish basil")
-    update_cache(tmp_dir, job, outputs)
     return outputs
 
 
-def run_boogie_only(tmp_dir: str, args: list = [], spec = None):
-    binary = bin_name(tmp_dir)
+class BasilWorker:
+    def __init__(self, command: list):
+        # in a session of its own, so kill_group takes anything it started with it
+        self.proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+                                     start_new_session=True)
+        self.jobs = 0
 
-    boogie_in = f"{tmp_dir}/boogie-in-source.bpl"
+    def run(self, args: list, stdout_file: str, stderr_file: str) -> int:
+        if any("\t" in a or "\n" in a for a in [stdout_file, stderr_file] + args):
+            raise ValueError("basil worker arguments cannot contain tabs or newlines")
+        self.jobs += 1
+        try:
+            self.proc.stdin.write("\t".join([stdout_file, stderr_file] + args) + "\n")
+            self.proc.stdin.flush()
+        except OSError as e:
+            # e.g. BrokenPipeError when the JVM died while idle
+            raise RuntimeError(f"basil worker unreachable: {e}")
+        self.wait_reply()
+        try:
+            reply = self.proc.stdout.readline()
+        except OSError as e:
+            raise RuntimeError(f"basil worker unreachable: {e}")
+        if not reply:
+            raise RuntimeError(f"basil worker exited with {self.proc.wait()}")
+        return int(reply)
 
-    with open(binary, 'r') as f: # because boogie checks the file extension
-        with open(boogie_in, 'w') as o:
-            t = f.read()
-            o.write(t)
+    def wait_reply(self):
+        """
+        Wait for the worker to answer, killing it if the request is cancelled
+        or the stage deadline passes first, as it is stuck on the job.
+        """
+        while not select.select([self.proc.stdout], [], [], CLAIM_POLL_INTERVAL)[0]:
+            try:
+                check_cancelled("before the basil worker answered")
+            except (Cancelled, TimeoutError):
+                kill_group(self.proc)
+                raise
 
-    modelfile = "counterexample.model"
-    command = [BOOGIE_BIN, boogie_in]
-    command += args + ['/mv', modelfile]
-    logging.info("command: %s", command)
+    def alive(self) -> bool:
+        return self.proc.poll() is None
 
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
 
-    res = subprocess.run(command, capture_output=True)
-    logging.info(res.stdout.decode('utf-8'))
-    logging.info(res.stderr.decode('utf-8'))
-    boogie_file = f"{tmp_dir}/out.boogie"
 
-    output = {"boogie": boogie_file, "default": boogie_file}
-    if "error" in res.stdout.decode('utf-8'):
-        output.update({"counterexample_model": modelfile})
+class BasilWorkerPool:
+    """
+    Keeps up to `size` basil JVMs resident and hands each job to an idle one,
+    starting workers on demand and recycling them after `max_jobs` jobs.
+    """
 
-    with open(boogie_file, "w") as f:
-        f.write(res.stderr.decode('utf-8'))
-        f.write(res.stdout.decode('utf-8'))
+    def __init__(self, command: list, size: int = BASIL_WORKERS, max_jobs: int = BASIL_WORKER_JOBS):
+        self.command = command
+        self.max_jobs = max_jobs
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
 
-    return output
+    def run(self, args: list, stdout_file: str, stderr_file: str) -> int:
+        with self.slots:
+            worker = None
+            while worker is None:
+                try:
+                    worker = self.idle.get_nowait()
+                except queue.Empty:
+                    logging.info(f"starting basil worker {self.command}")
+                    worker = BasilWorker(self.command)
+                    break
+                if not worker.alive():
+                    logging.info(f"idle basil worker exited with {worker.proc.returncode}, replacing it")
+                    worker.close()
+                    worker = None
+            try:
+                status = worker.run(args, stdout_file, stderr_file)
+            except Exception:
+                worker.close()
+                raise
+            if worker.jobs >= self.max_jobs:
+                worker.close()
+            else:
+                self.idle.put(worker)
+            return status
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get_nowait().close()
+
+
+BASIL_POOL = None
+
+
+def worker_jars() -> list:
+    """
+    The jars on the command line of the resident basil workers, as these
+    rather than BASIL_BIN translate in daemon mode.
+    """
+    jars = []
+    for part in (BASIL_WORKER_CMD or "").split(" "):
+        jars += [j for j in part.split(":") if j.endswith(".jar")]
+    return jars
+
+
+def run_boogie_only(tmp_dir: str, job: str, args: list = [], spec = None, functions: tuple = ()):
+    binary = bin_name(tmp_dir)
+
+    boogie_in = f"{tmp_dir}/boogie-in-source.bpl"
+
+    with publishing(boogie_in) as (tmp,):
+        shutil.copyfile(binary, tmp) # because boogie checks the file extension
 
+    work_dir = job_dir(tmp_dir, job)
+    if functions:
+        boogie_in = slice_boogie(boogie_in, f"{work_dir}/selected.bpl", functions)
+    modelfile = f"{work_dir}/counterexample.model"
+    boogie_out = f"{work_dir}/boogie_source_stdout"
+    boogie_err = f"{work_dir}/boogie_source_stderr"
+    if not verify_procedures(tmp_dir, boogie_in, args, modelfile, boogie_out, boogie_err, spec, "boogie-source"):
+        with admitted(os.path.dirname(tmp_dir), "boogie-source"), stage_deadline(), publishing(modelfile) as (model_tmp,):
+            command = [BOOGIE_BIN, boogie_in]
+            command += args + ['/mv', model_tmp]
+            run_command(command, boogie_out, boogie_err)
+    boogie_file = f"{work_dir}/out.boogie"
 
-def run_boogie(tmp_dir: str, args: list = [], spec = None):
-    outputs = run_basil(tmp_dir, args, spec)
+    output = {"boogie": boogie_file, "default": boogie_file}
+    if file_contains(boogie_out, b"error"):
+        output.update({"counterexample_model": modelfile})
 
-    boogie_file = outputs['boogie']
-    adt_file = outputs['adt']
-    bir_file = outputs['bir']
-    readelf_file = outputs['relf']
-    model_file = "counterexample.model"
+    concat_files(boogie_file, [boogie_err, boogie_out])
+
+    return output
 
-    command = [BOOGIE_BIN, boogie_file]
-    command += args + ['/mv', model_file]
-    res = subprocess.run(command, capture_output=True, check=True)
-    out = res.stdout.decode('utf-8')
-    err = res.stderr.decode('utf-8')
 
-    boogie_outbothfile = f"{tmp_dir}/boogie_stdout_stderr"
-    boogie_out = f"{tmp_dir}/boogie_stdout"
-    boogie_err = f"{tmp_dir}/boogie_stderr"
+def run_boogie(tmp_dir: str, job: str, args: list = [], spec = None, inputs: dict = {}, functions: tuple = ()):
+    outputs = {}
 
-    with open(boogie_out, 'w') as f:
-        f.write(out)
+    boogie_file = inputs['boogie']
+    work_dir = job_dir(tmp_dir, job)
+    if functions:
+        boogie_file = slice_boogie(boogie_file, f"{work_dir}/selected.bpl", functions)
+    model_file = f"{work_dir}/counterexample.model"
 
-    with open(boogie_err, 'w') as f:
-        f.write(err)
+    boogie_outbothfile = f"{work_dir}/boogie_stdout_stderr"
+    boogie_out = f"{work_dir}/boogie_stdout"
+    boogie_err = f"{work_dir}/boogie_stderr"
 
-    with open(boogie_outbothfile, 'w') as f:
-        f.write(out)
-        f.write(err)
+    if not verify_procedures(tmp_dir, boogie_file, args, model_file, boogie_out, boogie_err, spec, "boogie"):
+        with admitted(os.path.dirname(tmp_dir), "boogie"), stage_deadline(), publishing(model_file) as (model_tmp,):
+            command = [BOOGIE_BIN, boogie_file]
+            command += args + ['/mv', model_tmp]
+            run_command(command, boogie_out, boogie_err, check=True)
+    concat_files(boogie_outbothfile, [boogie_out, boogie_err])
 
     outputs.update({
+        "boogie_program": boogie_file,
         "boogie_stdout": boogie_out,
         "boogie_stderr": boogie_err,
         "boogie_stdout_stderr": boogie_outbothfile,
         })
 
-    if "error" in out:
+    if file_contains(boogie_out, b"error"):
         outputs.update({"counterexample_model": model_file})
 
 
     return outputs
 
-def pretty_print_counterexample(tmp_dir: str, args: list = [], spec = None):
-    outputs = run_boogie(tmp_dir, args, spec)
+"""
+Parallel verification: the procedures of a Boogie program are verified in
+contiguous shards, one Boogie process per shard selecting its procedures with
+/proc:, and the outputs are merged back into the format of a single run.
 
-    result = ""
+Results are also cached per procedure in the cache root's index.db, keyed by
+the procedure's text, the contracts of everything it (transitively) calls,
+the other global declarations, the spec, the Boogie arguments and the Boogie
+binary. A rerun only verifies procedures whose key changed. Cached messages
+store their locations relative to the enclosing declaration so they can be
+placed back into a file where the procedure has moved.
+"""
 
-    with open(outputs['boogie_stdout_stderr'], 'r') as i:
-        result += i.read()
-        result += "\n"
+BOOGIE_TOKEN = re.compile(r"""//[^\n]*|/\*.*?\*/|"(?:[^"\\]|\\.)*"|[{}]|[A-Za-z_.$#'`~^\\?][\w.$#'`~^\\?!]*""", re.S)
 
-    if ('counterexample_model' in outputs):
-        command = [MODEL_TOOL_BIN, outputs['counterexample_model']]
-        res = subprocess.run(command, capture_output=True, check=False)
-        logging.info(res.stdout.decode('utf-8'))
-        logging.info(res.stderr.decode('utf-8'))
-        result += res.stdout.decode('utf-8')
-        result += res.stderr.decode('utf-8')
+BOOGIE_DECL_KEYWORDS = {"procedure", "implementation", "function", "axiom", "var", "const", "type"}
 
-    ce_file = "modelTool_stdout"
-    outputs.update({'counterexample': ce_file, "default": ce_file})
+BoogieDecl = collections.namedtuple("BoogieDecl", ["keyword", "name", "start", "end", "body_start"])
 
+BOOGIE_CALL = re.compile(r"\bcall\s+(?:[^;:=]*:=\s*)?([A-Za-z_.$#'`~^\\?][\w.$#'`~^\\?!]*)\s*\(")
 
-    with open(ce_file, "w") as f:
-        f.write(result)
+PROC_TABLE = "create table if not exists proc_results (key string unique, result string, last_access real);"
 
-    return outputs
+PROC_INDEX = "create index if not exists proc_results_last_access on proc_results (last_access);"
 
 
-def cleanup_tempdirs():
+def boogie_declarations(text: str) -> list:
     """
-    Because temporary directories are shared between invocations we need to cleanup those that are no longer needed.
+    Split a Boogie program into its top level declarations.
     """
-    return 0
+    decls = []
+    depth = 0
+    current = None
+    for token in BOOGIE_TOKEN.finditer(text):
+        t = token.group()
+        if t.startswith("//") or t.startswith("/*") or t.startswith('"'):
+            continue
+        if t == "{":
+            # `{:attr ...}` is an attribute, any other brace opens a body
+            if depth == 0 and current is not None and current["body_start"] is None \
+                    and not text.startswith(":", token.end()):
+                current["body_start"] = token.start()
+            depth += 1
+        elif t == "}":
+            depth = max(depth - 1, 0)
+        elif depth == 0 and t in BOOGIE_DECL_KEYWORDS:
+            if current is not None:
+                decls.append(BoogieDecl(end=token.start(), **current))
+            current = {"keyword": t, "name": None, "start": token.start(), "body_start": None}
+        elif depth == 0 and current is not None and current["name"] is None:
+            current["name"] = t
+    if current is not None:
+        decls.append(BoogieDecl(end=len(text), **current))
+    return decls
 
-"""
-We assume the script is called from godbolt, so if the input files change we
-get a different input directory, hance a separate cache database.
-We don't checksum any input files etc for this reason.
-"""
 
-def has_cache(tmp_dir, job: str):
-    con = sqlite3.connect(f"{tmp_dir}/cache.db")
-    cur = con.cursor()
-    res = cur.execute(f"SELECT EXISTS(SELECT resultfile FROM jobs WHERE job=?);", [job])
-    r = res.fetchone()[0]
-    logging.info(f"has cache {job} : {r}")
-    con.close()
-    return r
+def verifiable_procedures(decls: list) -> list:
+    names = []
+    for d in decls:
+        if d.keyword in ("procedure", "implementation") and d.body_start is not None and d.name not in names:
+            names.append(d.name)
+    return names
 
 
-def get_cache(tmp_dir, job: str):
-    con = sqlite3.connect(f"{tmp_dir}/cache.db")
-    cur = con.cursor()
+def call_closure(roots, callees: dict) -> set:
+    """
+    `roots` and everything they transitively call.
+    """
+    closure = set(roots)
+    todo = list(closure)
+    while todo:
+        for callee in callees.get(todo.pop(), ()):
+            if callee not in closure:
+                closure.add(callee)
+                todo.append(callee)
+    return closure
 
-    # get cached result
-    res = cur.execute(f"SELECT resultname, resultfile FROM jobs WHERE job=?", [job])
-    r = res.fetchall()
-    r = {oname:ofile for (oname,ofile) in r}
-    logging.info(f"cached {job} : {r}")
-    return r
 
-    #def claim_job(tmp_dir, job: str):
-    #    try:
-    #        con = sqlite3.connect(f"{tmp_dir}/cache.db")
-    #        cur = con.cursor()
-    #        res = cur.execute(f"INSERT INTO jclaimed values (?);", [job])
-    #        con.commit()
-    #        con.close()
-    #        return True
-    #    except:
-    #        return False
-    #
-    #
-    #
-    #def unclaim_job(tmp_dir, job: str):
-    #    con = sqlite3.connect(f"{tmp_dir}/cache.db")
-    #    cur = con.cursor()
-    #    res = cur.execute(f"DELETE FROM jclaimed WHERE job=(?);", [job])
-    #    con.commit()
-    #    con.close()
-    #
-def update_cache(tmp_dir, job: str, res):
-    data = [(job, oname, ofile) for (oname, ofile) in res.items()]
-    logging.info(f"Update cache {job} : {res}")
-    con = sqlite3.connect(f"{tmp_dir}/cache.db")
-    cur = con.cursor()
-    res = cur.executemany(f"INSERT INTO jobs values(?, ?, ?);", data)
-    con.commit()
-    con.close()
+def procedure_keys(text: str, decls: list, context: str) -> dict:
+    """
+    Cache key for each procedure: its own declarations, the contracts of its
+    transitive callees (whole text for inlined callees), every other global
+    declaration and the verification context.
+    """
+    own = collections.defaultdict(list)
+    callees = collections.defaultdict(set)
+    contracts = {}
+    globals_hash = hashlib.sha256(context.encode('utf8'))
+    for d in decls:
+        decl_text = text[d.start:d.end]
+        if d.keyword in ("procedure", "implementation"):
+            own[d.name].append(decl_text)
+            if d.body_start is not None:
+                callees[d.name].update(BOOGIE_CALL.findall(text, d.body_start, d.end))
+            if d.keyword == "procedure":
+                header = text[d.start:d.body_start if d.body_start is not None else d.end]
+                contracts[d.name] = decl_text if "{:inline" in header else header
+        else:
+            globals_hash.update(decl_text.encode('utf8'))
 
-def main(tmp_dir):
-    parser = argparse.ArgumentParser(
-                    prog='BasilTool',
-                    description='Runs Basil and Associated Tools',
-                    epilog='')
-    parser.add_argument('sourcefile')
-    parser.add_argument('-d', '--directory',  required=False, help="Used to identify the compilation")
-    parser.add_argument('-t', '--tool', help="Which tool to run, basil/bap/readelf", default="basil")
-    parser.add_argument('-o', '--output', help="Which output to send to stdout", default="default")
-    parser.add_argument('-a', '--args', help="Extra args to pass to the tool", default=[])
-    parser.add_argument('-s', '--spec', help="Specfile for basil")
-    parser.add_argument('-v', '--verbose', help="Enable log output", action="store_true")
+    keys = {}
+    for name in own:
+        closure = call_closure(callees[name], callees)
+        key = globals_hash.copy()
+        for decl_text in own[name]:
+            key.update(decl_text.encode('utf8'))
+        for callee in sorted(closure):
+            key.update(b"\0" + callee.encode('utf8') + b"\0" + contracts.get(callee, "").encode('utf8'))
+        keys[name] = key.hexdigest()
+    return keys
 
-    args = parser.parse_args()
-    if args.verbose:
-        logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
-    else:
-        logging.basicConfig(stream=sys.stderr, level=logging.ERROR)
 
+BOOGIE_SUMMARY = re.compile(r"^Boogie program verifier finished with (.*)$")
 
-    #tmp_dir = get_tempdir(args.directory)
+BOOGIE_COUNT = re.compile(r"(\d+) (.+)$")
 
-    logging.info(args)
+# summary categories Boogie pluralises
+BOOGIE_PLURALS = {"errors": "error", "time outs": "time out", "solver exceptions": "solver exception"}
 
 
-    con = sqlite3.connect(f"{tmp_dir}/cache.db")
-    con.execute(JOB_TABLE)
-    con.execute(QUEUE_TABLE)
+def parse_boogie_output(text: str):
+    """
+    Split Boogie's stdout into its message lines and summary counts. Returns
+    None if there is no summary line, e.g. for resolution errors.
+    """
+    lines = []
+    summary = None
+    for line in text.splitlines():
+        m = BOOGIE_SUMMARY.match(line)
+        if m:
+            summary = m.group(1)
+        elif summary is None:
+            lines.append(line)
+    if summary is None:
+        return None
+    # the blank line before the summary
+    while lines and lines[-1] == "":
+        lines.pop()
+    counts = {}
+    for part in summary.split(", "):
+        m = BOOGIE_COUNT.match(part)
+        if m:
+            category = BOOGIE_PLURALS.get(m.group(2), m.group(2))
+            counts[category] = counts.get(category, 0) + int(m.group(1))
+    return lines, counts
 
 
-    data = None
-    with open(args.sourcefile, 'rb') as f:
-        data = f.read()
-    with open(bin_name(tmp_dir), 'wb') as f:
-        f.write(data)
+def format_boogie_output(lines: list, counts: dict) -> str:
+    totals = {"verified": 0, "error": 0}
+    for c in counts:
+        for category, n in c.items():
+            totals[category] = totals.get(category, 0) + n
+    parts = []
+    for category, n in totals.items():
+        plural = category in BOOGIE_PLURALS.values() and n != 1
+        parts.append(f"{n} {category}{'s' if plural else ''}")
+    return "\n".join(lines + ["", "Boogie program verifier finished with " + ", ".join(parts)]) + "\n"
 
 
-    def copydirs(d = args.directory):
-        job = f"import {d}"
-        #claim_job(tmp_dir, job)
-        if has_cache(tmp_dir, job):
-            return
-        for p in os.listdir(d):
-            if os.path.isdir(p):
-                copydirs(os.path.join(d, p))
-            elif os.path.isfile(p):
-                with open(os.path.join(d,p), 'rb') as inf:
-                    ofname = os.path.join(tmp_dir, p)
-                    with open(ofname, 'wb') as of:
-                        of.write(inf.read())
-                    update_cache(tmp_dir, job, {ofname: ofname})
-                    logging.info(f"{p} -> {ofname}")
-        #unclaim_job(tmp_dir, job)
-    copydirs()
-    # Copy spec
-    spec = None
-    if (args.spec):
-        spec = f"{tmp_dir}/in.spec"
-        specfile = None
-        with open(os.path.join(args.directory, args.spec), 'r') as f:
-            specfile = f.read()
-        with open(spec, 'w') as f:
-            f.write(specfile)
+class BoogieLocations:
+    """
+    Converts `file(line,col)` locations in Boogie messages to and from
+    positions relative to the enclosing top level declaration.
+    """
 
+    def __init__(self, path: str, text: str, decls: list):
+        self.location = re.compile(re.escape(path) + r"\((\d+),(\d+)\)")
+        self.path = path
+        self.decls = []
+        for d in decls:
+            if d.keyword in ("procedure", "implementation") or d.name is not None:
+                self.decls.append((text.count("\n", 0, d.start) + 1, f"{d.keyword} {d.name}", d))
+        self.starts = {decl_id: line for (line, decl_id, d) in self.decls}
 
-# TODO: give basil spec files
-# TODO: run boogie
-# TODO: primus lifter and asli lifter
+    def decl_at(self, line: int):
+        found = None
+        for entry in self.decls:
+            if entry[0] > line:
+                break
+            found = entry
+        return found
 
-    outputs = {}
+    def relative(self, line: str):
+        """
+        Returns the line with its locations replaced by placeholders and the
+        list of (declaration, line offset, column), or None if a location is
+        outside any named declaration.
+        """
+        locations = []
+        for m in self.location.finditer(line):
+            entry = self.decl_at(int(m.group(1)))
+            if entry is None:
+                return None
+            locations.append((entry[1], int(m.group(1)) - entry[0], m.group(2)))
+        return self.location.sub("\0", line), locations
 
-    if (args.args):
-        args.args = args.args.split(" ")
-
-    if args.tool == "readelf":
-        outputs = run_readelf(tmp_dir)
-    elif args.tool == "bap":
-        outputs = run_bap_lift(tmp_dir, False)
-    elif args.tool == "basil":
-        outputs = run_basil(tmp_dir, args.args, spec)
-    elif args.tool == "boogie":
-        outputs = run_boogie(tmp_dir, args.args, spec)
-    elif args.tool == "boogie-source":
-        outputs = run_boogie_only(tmp_dir, args.args, spec)
-    elif args.tool == "boogie-counterexample":
-        outputs = pretty_print_counterexample(tmp_dir, args.args, spec)
-    else:
-        print("Allowed tools: [readelf, bap, basil, boogie, boogie-source, 'boogie-counterexample]")
-        exit(1)
+    def absolute(self, template: str, locations: list):
+        parts = template.split("\0")
+        out = parts[0]
+        for (decl_id, offset, col), part in zip(locations, parts[1:]):
+            if decl_id not in self.starts:
+                return None
+            out += f"{self.path}({self.starts[decl_id] + offset},{col})" + part
+        return out
 
-    if args.output not in outputs:
-        print("Output unavailable, allowed are:", ", ".join(outputs.keys()))
-        exit(1)
 
-    with open(outputs[args.output], 'r') as f:
-        logging.info("Printinng output: %s", outputs[args.output])
-        print(f.read())
+BOOGIE_MESSAGE = re.compile(r"^.*\((\d+),(\d+)\): (Error|Warning|error|warning)")
+
+
+def split_shard_output(lines: list, counts: dict, names: list, locations: BoogieLocations):
+    """
+    Attribute a shard's messages and counts to its procedures. Returns
+    {name: (relative lines, counts)}, or None if that is not possible.
+    """
+    if any(n for category, n in counts.items() if category not in ("verified", "error")):
+        return None
+    blocks = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    current = None
+    for line in lines:
+        m = BOOGIE_MESSAGE.match(line)
+        if m:
+            entry = locations.decl_at(int(m.group(1)))
+            current = entry[2].name if entry is not None else None
+            if current not in blocks:
+                return None
+            if m.group(3).lower() == "error":
+                errors[current] += 1
+        elif current is None:
+            return None
+        relative = locations.relative(line)
+        if relative is None:
+            return None
+        blocks[current].append(relative)
+    failed = sum(1 for name in names if errors[name])
+    if sum(errors.values()) != counts.get("error", 0) or len(names) - failed != counts.get("verified", 0):
+        return None
+    return {name: (blocks[name], {"verified": 0 if errors[name] else 1, "error": errors[name]}) for name in names}
 
-    if args.directory:
-        with open(os.path.join(args.directory, "stdout"), "w") as foutfile:
-            with open(outputs[args.output], 'r') as fwrite:
-                foutfile.write(fwrite.read())
 
-    exit(0)
+def shard(items: list, n: int) -> list:
+    """
+    Split items into at most n contiguous, similarly sized shards.
+    """
+    n = max(1, min(n, len(items)))
+    size, extra = divmod(len(items), n)
+    shards = []
+    start = 0
+    for i in range(n):
+        end = start + size + (1 if i < extra else 0)
+        shards.append(items[start:end])
+        start = end
+    return shards
+
+
+def get_proc_results(tmp_dir: str, keys: list) -> dict:
+    db = index_db(os.path.dirname(tmp_dir))
+    results = {}
+    with db.transaction() as con:
+        for key in keys:
+            row = con.execute("SELECT result FROM proc_results WHERE key=?;", [key]).fetchone()
+            if row is not None:
+                results[key] = json.loads(row[0])
+        con.executemany("UPDATE proc_results SET last_access=? WHERE key=?;", [(time.time(), k) for k in results])
+    return results
+
+
+def update_proc_results(tmp_dir: str, results: dict):
+    with index_db(os.path.dirname(tmp_dir)).transaction() as con:
+        con.executemany("INSERT OR REPLACE INTO proc_results VALUES (?, ?, ?);",
+                        [(key, json.dumps(result), time.time()) for key, result in results.items()])
+
+
+def verify_procedures(tmp_dir: str, boogie_file: str, args: list, model_file: str, boogie_out: str, boogie_err: str,
+                      spec: str | None = None, stage: str = "boogie") -> bool:
+    """
+    Verify the procedures of boogie_file, reusing cached per-procedure results
+    and running the rest in parallel shards, writing the merged output to
+    boogie_out and boogie_err. The shards are admitted as `stage`, taking a
+    core each. Returns False when the program should be verified by a single
+    Boogie run instead.
+    """
+    # Boogie takes options with either a / or a - prefix
+    if any(a.startswith(("/proc:", "-proc:", "--proc:")) for a in args):
+        return False
+    with open(boogie_file, 'r') as f:
+        text = f.read()
+    decls = boogie_declarations(text)
+    procedures = verifiable_procedures(decls)
+    if len(procedures) == 0 or (len(procedures) == 1 and BOOGIE_JOBS <= 1):
+        return False
+
+    context = json.dumps([normalise_args(args), spec_digest(spec), tool_fingerprint(BOOGIE_BIN, os.path.dirname(tmp_dir))])
+    keys = procedure_keys(text, decls, context)
+    locations = BoogieLocations(boogie_file, text, decls)
+    cached = get_proc_results(tmp_dir, [keys[name] for name in procedures])
+
+    # name -> (message lines, counts) for each procedure, or for the first
+    # procedure of a shard whose output couldn't be split up
+    results = {}
+    for name in procedures:
+        if keys[name] in cached:
+            lines, counts = cached[keys[name]]
+            absolute = [locations.absolute(template, locs) for (template, locs) in lines]
+            if None not in absolute:
+                results[name] = (absolute, counts)
+    todo = [name for name in procedures if name not in results]
+    logging.info(f"{len(procedures) - len(todo)} of {len(procedures)} procedures verified from cache")
+
+    shards = shard(todo, BOOGIE_JOBS) if todo else []
+    scratch = tempfile.mkdtemp(prefix=".shards-", dir=os.path.dirname(boogie_out))
+
+    def verify_shard(i, names):
+        out = f"{scratch}/boogie_shard{i}_stdout"
+        err = f"{scratch}/boogie_shard{i}_stderr"
+        model = f"{scratch}/boogie_shard{i}.model"
+        command = [BOOGIE_BIN, boogie_file] + args + [f"/proc:{name}" for name in names] + ['/mv', model]
+        run_command(command, out, err)
+        return out, err, model
+
+    try:
+        runs = []
+        if shards:
+            with admitted(os.path.dirname(tmp_dir), stage, processes=len(shards)), stage_deadline():
+                # the work happens in the Boogie processes, threads just wait on them
+                with concurrent.futures.ThreadPoolExecutor(max_workers=len(shards)) as pool:
+                    # each shard in a copy of our context, so its Boogie run counts towards this stage
+                    runs = [f.result() for f in [pool.submit(contextvars.copy_context().run, verify_shard, i, names)
+                                                 for i, names in enumerate(shards)]]
+
+        fresh = {}
+        for names, (out, err, model) in zip(shards, runs):
+            with open(out, 'r') as f:
+                parsed = parse_boogie_output(f.read())
+            if parsed is None:
+                logging.info("sharded boogie output incomplete, verifying serially")
+                return False
+            split = split_shard_output(*parsed, names, locations)
+            if split is None:
+                results[names[0]] = parsed
+                continue
+            for name, (relative, counts) in split.items():
+                results[name] = ([locations.absolute(t, locs) for (t, locs) in relative], counts)
+                # failures are re-run so there is always a counterexample model for them
+                if counts["error"] == 0:
+                    fresh[keys[name]] = (relative, counts)
+        update_proc_results(tmp_dir, fresh)
+
+        lines = []
+        counts = []
+        for name in procedures:
+            if name in results:
+                lines += results[name][0]
+                counts.append(results[name][1])
+        write_atomic(boogie_out, format_boogie_output(lines, counts).encode('utf-8'))
+        concat_files(boogie_err, [err for (out, err, model) in runs])
+        concat_files(model_file, [model for (out, err, model) in runs if os.path.exists(model)])
+        return True
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+"""
+Counterexample models: Boogie's /mv writes one model per failing
+verification condition, each a list of constants, function tables and the
+program states captured along the failing trace. read_models parses the file
+one model at a time, so only the model being rendered is held in memory, and
+render_model prints each state's variables with bitvectors in hex and maps
+expanded from the model's select tables. States after the first only list
+the variables that changed.
+
+The counterexample-failing output keeps just the variables mentioned by the
+procedures Boogie reported errors in.
+"""
+
+# bump when the rendering changes
+MODEL_RENDERER_VERSION = 1
+
+Model = collections.namedtuple("Model", ["constants", "functions", "states"])
+
+MODEL_BITVECTOR = re.compile(r"^(\d+)bv(\d+)$")
+
+MODEL_ARRAY = re.compile(r"^as-array\[(.*)\]$")
+
+
+def model_tokens(line: str) -> list:
+    """
+    Split a model line on whitespace outside of parentheses and |quoted| names.
+    """
+    tokens = []
+    current = []
+    depth = 0
+    quoted = False
+    for c in line:
+        if c == "|":
+            quoted = not quoted
+        elif not quoted and c == "(":
+            depth += 1
+        elif not quoted and c == ")":
+            depth = max(depth - 1, 0)
+        elif not quoted and depth == 0 and c.isspace():
+            if current:
+                tokens.append("".join(current))
+                current = []
+            continue
+        current.append(c)
+    if current:
+        tokens.append("".join(current))
+    return tokens
+
+
+def model_entry(line: str):
+    """
+    (arguments, value) of a `args... -> value` line, or None.
+    """
+    tokens = model_tokens(line)
+    if "->" not in tokens:
+        return None
+    i = tokens.index("->")
+    return tokens[:i], " ".join(tokens[i + 1:])
+
+
+def read_models(f):
+    """
+    Yield the Models of a model file as each one is read.
+    """
+    model = None
+    function = None
+    state = None
+    for line in f:
+        line = line.rstrip("\n")
+        if line.startswith("*** MODEL"):
+            model = Model({}, {}, [])
+            function = state = None
+        elif model is None:
+            continue
+        elif line.startswith("*** END_MODEL"):
+            yield model
+            model = None
+        elif line.startswith("*** STATE"):
+            state = (line[len("*** STATE"):].strip(), [])
+            model.states.append(state)
+        elif line.startswith("*** END_STATE"):
+            state = None
+        elif function is not None:
+            if line.strip() == "}":
+                function = None
+                continue
+            entry = model_entry(line)
+            if entry is None:
+                continue
+            args, value = entry
+            if args == ["else"]:
+                model.functions[function]["else"] = value
+            else:
+                model.functions[function]["apps"].append((args, value))
+        else:
+            entry = model_entry(line)
+            if entry is None or len(entry[0]) != 1:
+                continue
+            name, value = entry[0][0], entry[1]
+            if state is not None:
+                state[1].append((name, value))
+            elif value == "{":
+                function = name
+                model.functions[name] = {"apps": [], "else": None}
+            else:
+                model.constants[name] = value
+    # a model cut short, e.g. by a killed Boogie
+    if model is not None:
+        yield model
+
+
+def model_scalar(value: str) -> str:
+    m = MODEL_BITVECTOR.match(value)
+    if m:
+        return f"0x{int(m.group(1)):x}:bv{m.group(2)}"
+    return value
+
+
+class ModelRenderer:
+    def __init__(self, model: Model):
+        self.model = model
+        # map element -> [(indices, value)], from the select functions of the
+        # map encoding Boogie gave Z3
+        self.selects = collections.defaultdict(list)
+        for name, table in model.functions.items():
+            if "select" in name.lower():
+                for args, value in table["apps"]:
+                    if len(args) >= 2:
+                        self.selects[args[0]].append((args[1:], value))
+
+    def value(self, value: str) -> str:
+        m = MODEL_ARRAY.match(value)
+        if m and m.group(1) in self.model.functions:
+            table = self.model.functions[m.group(1)]
+            return self.table(table["apps"], table["else"])
+        if value in self.selects:
+            return self.table(self.selects[value], None)
+        return model_scalar(value)
+
+    def table(self, apps: list, otherwise) -> str:
+        entries = [f"{' '.join(model_scalar(a) for a in args)} -> {model_scalar(value)}" for args, value in apps]
+        if otherwise is not None:
+            entries.append(f"else -> {model_scalar(otherwise)}")
+        return "{" + ", ".join(entries) + "}"
+
+
+def in_scope(name: str, variables) -> bool:
+    # incarnations are named `x@3`, `x@@1`
+    return variables is None or name.split("@")[0].strip("|") in variables
+
+
+def render_model(number: int, model: Model, out, variables=None):
+    """
+    Write a model, restricted to the variables in the `variables` set if given.
+    """
+    renderer = ModelRenderer(model)
+    out.write(f"Counterexample {number}:\n")
+    states = model.states
+    if not states:
+        # no captured states, show the incarnations of the variables instead
+        states = [("constants", [(name, value) for name, value in model.constants.items()
+                                 if not name.startswith("%lbl%") and "!" not in name])]
+    previous = {}
+    for name, assignments in states:
+        lines = []
+        for variable, value in assignments:
+            if not in_scope(variable, variables) or previous.get(variable) == value:
+                continue
+            previous[variable] = value
+            lines.append(f"    {variable} = {renderer.value(value)}\n")
+        out.write(f"  {name}\n")
+        out.writelines(lines)
+    out.write("\n")
+
+
+def failing_variables(boogie_file: str, boogie_stdout: str) -> set:
+    """
+    The identifiers used by the procedures of boogie_file that Boogie reported
+    errors in.
+    """
+    with open(boogie_file, 'r') as f:
+        text = f.read()
+    decls = boogie_declarations(text)
+    locations = BoogieLocations(boogie_file, text, decls)
+    failing = set()
+    with open(boogie_stdout, 'r') as f:
+        for line in f:
+            m = BOOGIE_MESSAGE.match(line)
+            if m and m.group(3).lower() == "error":
+                entry = locations.decl_at(int(m.group(1)))
+                if entry is not None:
+                    failing.add(entry[2].name)
+    identifiers = set()
+    for d in decls:
+        if d.keyword in ("procedure", "implementation") and d.name in failing:
+            for token in BOOGIE_TOKEN.finditer(text, d.start, d.end):
+                t = token.group()
+                if not (t.startswith("//") or t.startswith("/*") or t.startswith('"') or t in "{}"):
+                    identifiers.add(t)
+    return identifiers
+
+
+def pretty_print_counterexample(tmp_dir: str, job: str, inputs: dict = {}):
+    # alongside the Boogie run it reads
+    work_dir = job_dir(tmp_dir, job)
+    ce_file = f"{work_dir}/counterexample"
+    failing_file = f"{work_dir}/counterexample_failing"
+    outputs = {"counterexample": ce_file, "counterexample-failing": failing_file, "default": ce_file}
+
+    model_file = inputs.get('counterexample_model')
+    if model_file is not None and not os.path.exists(model_file):
+        model_file = None
+    variables = None
+    if model_file is not None:
+        variables = failing_variables(inputs['boogie_program'], inputs['boogie_stdout'])
+
+    with publishing(ce_file, failing_file) as (ce_tmp, failing_tmp):
+        with open(ce_tmp, 'w') as ce, open(failing_tmp, 'w') as failing:
+            for f in (ce, failing):
+                with open(inputs['boogie_stdout_stderr'], 'r') as i:
+                    shutil.copyfileobj(i, f)
+                f.write("\n")
+            if model_file is not None:
+                with open(model_file, 'r', errors='replace') as m:
+                    for number, model in enumerate(read_models(m), 1):
+                        render_model(number, model, ce)
+                        render_model(number, model, failing, variables)
+
+    return outputs
+
+
+"""
+ELF reading: the readelf stage parses the binary in process instead of
+running `readelf -s -r -W`. ElfFile maps the file and reads its section
+headers, symbol tables (with GNU symbol versions) and relocations, and
+write_readelf reproduces readelf's text byte for byte, as of binutils 2.40,
+for the 64 bit x86-64 and AArch64 binaries we lift. Anything else raises
+ElfError and the stage falls back to the readelf binary.
+
+Alongside the text the stage writes an index of the defined symbols, see
+SymbolIndex, for stages that need to look symbols up.
+
+With BASIL_TOOL_NORMALISE=1, cache entries are keyed on a normalised digest
+of the binary instead of its bytes, covering only what the lifters read: the
+ELF and program headers, the headers and contents of the allocated sections,
+and the readelf text of the symbol tables and relocations. Builds that differ
+only in their build-id, .comment, debug information or section header layout
+after the allocated sections share an entry. check_normalisation verifies
+that on a corpus, it must pass with BAP installed before this is turned on.
+"""
+
+# Part of the readelf stage's key, bump when the output of ElfFile changes.
+ELF_READER_VERSION = 1
+
+# Bump when normalised_digest changes, it starts a new set of cache entries.
+ELF_NORMALISATION_VERSION = 1
+
+SHF_ALLOC = 0x2
+
+# allocated sections whose contents are left out of the normalised digest
+NORMALISE_IGNORED = {b".note.gnu.build-id"}
+
+
+class ElfError(ValueError):
+    pass
+
+
+def elf_reader(method):
+    """
+    Report tables that run past the end of the file, or refer to entries
+    that don't exist, as ElfError rather than whatever the parser tripped on.
+    """
+    @functools.wraps(method)
+    def read(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        except (struct.error, IndexError) as e:
+            raise ElfError(f"{self.path} is corrupt: {e}")
+    return read
+
+
+ElfSection = collections.namedtuple("ElfSection", ["index", "name", "type", "flags", "addr", "offset", "size",
+                                                   "link", "info", "addralign", "entsize"])
+
+ElfSymbol = collections.namedtuple("ElfSymbol", ["index", "name", "value", "size", "info", "other", "shndx"])
+
+SHT_SYMTAB = 2
+SHT_RELA = 4
+SHT_NOBITS = 8
+SHT_REL = 9
+SHT_DYNSYM = 11
+SHT_SYMTAB_SHNDX = 18
+SHT_RELR = 19
+SHT_GNU_VERDEF = 0x6ffffffd
+SHT_GNU_VERNEED = 0x6ffffffe
+SHT_GNU_VERSYM = 0x6fffffff
+
+SHN_UNDEF = 0
+SHN_LORESERVE = 0xff00
+SHN_LOPROC = 0xff00
+SHN_HIPROC = 0xff1f
+SHN_LOOS = 0xff20
+SHN_HIOS = 0xff3f
+SHN_ABS = 0xfff1
+SHN_COMMON = 0xfff2
+SHN_XINDEX = 0xffff
+SHN_X86_64_LCOMMON = 0xff02
+
+EM_X86_64 = 62
+EM_AARCH64 = 183
+
+ELFOSABI_GNU = 3
+ELFOSABI_FREEBSD = 9
+
+STT_SECTION = 3
+STT_FILE = 4
+STT_GNU_IFUNC = 10
+STB_GNU_UNIQUE = 10
+STO_AARCH64_VARIANT_PCS = 0x80
+
+ELF_SYMBOL_TYPES = ["NOTYPE", "OBJECT", "FUNC", "SECTION", "FILE", "COMMON", "TLS", None, "RELC", "SRELC"]
+ELF_SYMBOL_BINDINGS = ["LOCAL", "GLOBAL", "WEAK"]
+ELF_VISIBILITIES = ["DEFAULT", "INTERNAL", "HIDDEN", "PROTECTED"]
+
+X86_64_RELOCS = dict(enumerate([
+    "NONE", "64", "PC32", "GOT32", "PLT32", "COPY", "GLOB_DAT", "JUMP_SLOT", "RELATIVE", "GOTPCREL", "32", "32S",
+    "16", "PC16", "8", "PC8", "DTPMOD64", "DTPOFF64", "TPOFF64", "TLSGD", "TLSLD", "DTPOFF32", "GOTTPOFF", "TPOFF32",
+    "PC64", "GOTOFF64", "GOTPC32", "GOT64", "GOTPCREL64", "GOTPC64", "GOTPLT64", "PLTOFF64", "SIZE32", "SIZE64",
+    "GOTPC32_TLSDESC", "TLSDESC_CALL", "TLSDESC", "IRELATIVE", "RELATIVE64", "PC32_BND", "PLT32_BND", "GOTPCRELX",
+    "REX_GOTPCRELX"]))
+X86_64_RELOCS.update({250: "GNU_VTINHERIT", 251: "GNU_VTENTRY"})
+
+AARCH64_RELOCS = {0: "NONE", 256: "NULL"}
+for first, names in [
+        (257, ["ABS64", "ABS32", "ABS16", "PREL64", "PREL32", "PREL16", "MOVW_UABS_G0", "MOVW_UABS_G0_NC",
+               "MOVW_UABS_G1", "MOVW_UABS_G1_NC", "MOVW_UABS_G2", "MOVW_UABS_G2_NC", "MOVW_UABS_G3", "MOVW_SABS_G0",
+               "MOVW_SABS_G1", "MOVW_SABS_G2", "LD_PREL_LO19", "ADR_PREL_LO21", "ADR_PREL_PG_HI21",
+               "ADR_PREL_PG_HI21_NC", "ADD_ABS_LO12_NC", "LDST8_ABS_LO12_NC", "TSTBR14", "CONDBR19", None, "JUMP26",
+               "CALL26", "LDST16_ABS_LO12_NC", "LDST32_ABS_LO12_NC", "LDST64_ABS_LO12_NC", "MOVW_PREL_G0",
+               "MOVW_PREL_G0_NC", "MOVW_PREL_G1", "MOVW_PREL_G1_NC", "MOVW_PREL_G2", "MOVW_PREL_G2_NC",
+               "MOVW_PREL_G3"]),
+        (299, ["LDST128_ABS_LO12_NC", "MOVW_GOTOFF_G0", "MOVW_GOTOFF_G0_NC", "MOVW_GOTOFF_G1", "MOVW_GOTOFF_G1_NC",
+               "MOVW_GOTOFF_G2", "MOVW_GOTOFF_G2_NC", "MOVW_GOTOFF_G3", "GOTREL64", "GOTREL32", "GOT_LD_PREL19",
+               "LD64_GOTOFF_LO15", "ADR_GOT_PAGE", "LD64_GOT_LO12_NC", "LD64_GOTPAGE_LO15"]),
+        (512, ["TLSGD_ADR_PREL21", "TLSGD_ADR_PAGE21", "TLSGD_ADD_LO12_NC", "TLSGD_MOVW_G1", "TLSGD_MOVW_G0_NC",
+               "TLSLD_ADR_PREL21", "TLSLD_ADR_PAGE21", "TLSLD_ADD_LO12_NC", "TLSLD_MOVW_G1", "TLSLD_MOVW_G0_NC",
+               "TLSLD_LD_PREL19", "TLSLD_MOVW_DTPREL_G2", "TLSLD_MOVW_DTPREL_G1", "TLSLD_MOVW_DTPREL_G1_NC",
+               "TLSLD_MOVW_DTPREL_G0", "TLSLD_MOVW_DTPREL_G0_NC", "TLSLD_ADD_DTPREL_HI12", "TLSLD_ADD_DTPREL_LO12",
+               "TLSLD_ADD_DTPREL_LO12_NC", "TLSLD_LDST8_DTPREL_LO12", "TLSLD_LDST8_DTPREL_LO12_NC",
+               "TLSLD_LDST16_DTPREL_LO12", "TLSLD_LDST16_DTPREL_LO12_NC", "TLSLD_LDST32_DTPREL_LO12",
+               "TLSLD_LDST32_DTPREL_LO12_NC", "TLSLD_LDST64_DTPREL_LO12", "TLSLD_LDST64_DTPREL_LO12_NC",
+               "TLSIE_MOVW_GOTTPREL_G1", "TLSIE_MOVW_GOTTPREL_G0_NC", "TLSIE_ADR_GOTTPREL_PAGE21",
+               "TLSIE_LD64_GOTTPREL_LO12_NC", "TLSIE_LD_GOTTPREL_PREL19", "TLSLE_MOVW_TPREL_G2",
+               "TLSLE_MOVW_TPREL_G1", "TLSLE_MOVW_TPREL_G1_NC", "TLSLE_MOVW_TPREL_G0", "TLSLE_MOVW_TPREL_G0_NC",
+               "TLSLE_ADD_TPREL_HI12", "TLSLE_ADD_TPREL_LO12", "TLSLE_ADD_TPREL_LO12_NC", "TLSLE_LDST8_TPREL_LO12",
+               "TLSLE_LDST8_TPREL_LO12_NC", "TLSLE_LDST16_TPREL_LO12", "TLSLE_LDST16_TPREL_LO12_NC",
+               "TLSLE_LDST32_TPREL_LO12", "TLSLE_LDST32_TPREL_LO12_NC", "TLSLE_LDST64_TPREL_LO12",
+               "TLSLE_LDST64_TPREL_LO12_NC", "TLSDESC_LD_PREL19", "TLSDESC_ADR_PREL21", "TLSDESC_ADR_PAGE21",
+               "TLSDESC_LD64_LO12", "TLSDESC_ADD_LO12", "TLSDESC_OFF_G1", "TLSDESC_OFF_G0_NC", "TLSDESC_LDR",
+               "TLSDESC_ADD", "TLSDESC_CALL", "TLSLE_LDST128_TPREL_LO12", "TLSLE_LDST128_TPREL_LO12_NC",
+               "TLSLD_LDST128_DTPREL_LO12", "TLSLD_LDST128_DTPREL_LO12_NC"]),
+        (1024, ["COPY", "GLOB_DAT", "JUMP_SLOT", "RELATIVE", "TLS_DTPMOD", "TLS_DTPREL", "TLS_TPREL", "TLSDESC",
+                "IRELATIVE"])]:
+    AARCH64_RELOCS.update({first + i: name for i, name in enumerate(names) if name is not None})
+
+# relocation type names by machine
+ELF_RELOCS = {EM_X86_64: ("R_X86_64_", X86_64_RELOCS), EM_AARCH64: ("R_AARCH64_", AARCH64_RELOCS)}
+
+
+class ElfFile:
+    def __init__(self, path: str):
+        self.path = path
+        self.symbol_tables = {}
+        with open(path, 'rb') as f:
+            try:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise ElfError(f"{path} is empty")
+        try:
+            self.read_headers(path)
+        except struct.error:
+            self.close()
+            raise ElfError(f"{path} is truncated")
+        except ElfError:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.data.close()
+
+    def read_headers(self, path: str):
+        ident = self.data[:16]
+        if ident[:4] != b"\x7fELF":
+            raise ElfError(f"{path} is not an ELF file")
+        if ident[4] != 2:
+            raise ElfError(f"{path} is not a 64 bit ELF file")
+        self.endian = {1: "<", 2: ">"}.get(ident[5])
+        if self.endian is None:
+            raise ElfError(f"{path} has an unknown byte order")
+        self.osabi = ident[7]
+        (self.type, self.machine, _, _, _, shoff, _, _, _, _, shentsize, shnum,
+         shstrndx) = self.unpack("HHIQQQIHHHHHH", 16)
+        if self.machine not in ELF_RELOCS:
+            raise ElfError(f"{path} is for unsupported machine {self.machine}")
+        if shoff == 0:
+            raise ElfError(f"{path} has no section headers")
+        headers = []
+        count = shnum
+        i = 0
+        while i < count:
+            headers.append(self.unpack("IIQQQQIIQQ", shoff + i * shentsize))
+            if i == 0 and shnum == 0:
+                # more sections than fit the header, the count is in the first one
+                count = headers[0][5]
+            i += 1
+        if shstrndx == SHN_XINDEX:
+            shstrndx = headers[0][6]
+        names = headers[shstrndx][4] if shstrndx < len(headers) else None
+        self.sections = [ElfSection(i, self.string(names, h[0]) if names is not None else b"", *h[1:])
+                         for i, h in enumerate(headers)]
+
+    def unpack(self, fmt: str, offset: int):
+        return struct.unpack_from(self.endian + fmt, self.data, offset)
+
+    def string(self, offset: int, index: int) -> bytes:
+        start = offset + index
+        end = self.data.find(b"\0", start)
+        if end < 0:
+            raise ElfError("unterminated string")
+        return self.data[start:end]
+
+    def sections_of_type(self, *types) -> list:
+        return [s for s in self.sections if s.type in types]
+
+    def linked(self, section: ElfSection):
+        if 0 < section.link < len(self.sections):
+            return self.sections[section.link]
+        return None
+
+    def symbols(self, section: ElfSection) -> list:
+        if section.index in self.symbol_tables:
+            return self.symbol_tables[section.index]
+        strtab = self.linked(section)
+        if strtab is None:
+            raise ElfError(f"symbol table {section.name} has no string table")
+        shndx = None
+        for s in self.sections_of_type(SHT_SYMTAB_SHNDX):
+            if s.link == section.index:
+                shndx = s
+        symbols = []
+        for i in range(section.size // 24):
+            name, info, other, index, value, size = self.unpack("IBBHQQ", section.offset + i * 24)
+            if index == SHN_XINDEX and shndx is not None:
+                index = self.unpack("I", shndx.offset + i * 4)[0]
+            symbols.append(ElfSymbol(i, self.string(strtab.offset, name), value, size, info, other, index))
+        self.symbol_tables[section.index] = symbols
+        return symbols
+
+    def symbol_versions(self, section: ElfSection) -> dict:
+        """
+        Symbol index -> (version, kind, version index) for a dynamic symbol
+        table, where kind is "undefined", "hidden" or "public", following
+        readelf's get_symbol_version_string.
+        """
+        versym = [s for s in self.sections_of_type(SHT_GNU_VERSYM) if s.link == section.index]
+        if section.type != SHT_DYNSYM or not versym:
+            return {}
+        strtab = self.linked(section)
+        verdefs = self.sections_of_type(SHT_GNU_VERDEF)
+        verneeds = self.sections_of_type(SHT_GNU_VERNEED)
+        versions = {}
+        for symbol in self.symbols(section):
+            vers = self.unpack("H", versym[0].offset + symbol.index * 2)[0]
+            if vers == 0:
+                continue
+            kind = "hidden" if vers & 0x8000 else "public"
+            found = None
+            max_vd_ndx = 0
+            if symbol.shndx != SHN_UNDEF and vers != 0x8001 and verdefs:
+                offset = verdefs[0].offset
+                while True:
+                    _, flags, ndx, _, _, aux, next_ = self.unpack("HHHHIII", offset)
+                    max_vd_ndx = max(max_vd_ndx, ndx & 0x7fff)
+                    if ndx == vers & 0x7fff or next_ == 0:
+                        break
+                    offset += next_
+                if ndx == vers & 0x7fff:
+                    if ndx == 1 and flags == 1:
+                        # the file's own base version
+                        continue
+                    name = self.string(strtab.offset, self.unpack("I", offset + aux)[0])
+                    # the symbols naming the versions themselves
+                    if symbol.name != name:
+                        found = (name, kind, vers)
+            if found is None and verneeds:
+                offset = verneeds[0].offset
+                while found is None:
+                    _, _, _, aux, next_ = self.unpack("HHIII", offset)
+                    vna = offset + aux
+                    while True:
+                        _, _, other, name, vna_next = self.unpack("IHHII", vna)
+                        if other == vers:
+                            found = (self.string(strtab.offset, name), "undefined", other)
+                            break
+                        if vna_next == 0:
+                            break
+                        vna += vna_next
+                    if next_ == 0:
+                        break
+                    offset += next_
+                if found is None and (max_vd_ndx or vers & 0x7fff != 1) and vers & 0x7fff > max_vd_ndx:
+                    found = (b"<corrupt>", kind, vers)
+            if found is not None:
+                versions[symbol.index] = found
+        return versions
+
+    def relocations(self, section: ElfSection) -> list:
+        """
+        (offset, info, addend) of each relocation in a REL or RELA section,
+        or the offsets relocated by a RELR section.
+        """
+        if section.type == SHT_RELR:
+            offsets = []
+            where = 0
+            for i in range(section.size // 8):
+                entry = self.unpack("Q", section.offset + i * 8)[0]
+                if entry & 1 == 0:
+                    offsets.append(entry)
+                    where = entry + 8
+                else:
+                    j = 0
+                    while entry >> 1:
+                        entry >>= 1
+                        if entry & 1:
+                            offsets.append(where + j * 8)
+                        j += 1
+                    where += 63 * 8
+            return offsets
+        if section.type == SHT_RELA:
+            entsize = section.entsize or 24
+            return [self.unpack("QQq", section.offset + i * entsize) for i in range(section.size // entsize)]
+        entsize = section.entsize or 16
+        return [self.unpack("QQ", section.offset + i * entsize) + (None,) for i in range(section.size // entsize)]
+
+    @elf_reader
+    def write_readelf(self, out):
+        """
+        Write what `readelf -s -r -W` prints for this file.
+        """
+        self.write_relocations(out)
+        self.write_symbols(out)
+
+    def write_relocations(self, out):
+        found = False
+        prefix, names = ELF_RELOCS[self.machine]
+        for section in self.sections_of_type(SHT_RELA, SHT_REL, SHT_RELR):
+            if section.size == 0:
+                continue
+            found = True
+            count = section.size // (section.entsize or {SHT_RELA: 24, SHT_REL: 16, SHT_RELR: 8}[section.type])
+            out.write(b"\nRelocation section '%s' at offset %s contains %d %s:\n" % (
+                printable(section.name), c_hex(section.offset), count, b"entry" if count == 1 else b"entries"))
+            if section.type == SHT_RELR:
+                offsets = self.relocations(section)
+                out.write(b"  %d %s\n" % (len(offsets), b"offset" if len(offsets) == 1 else b"offsets"))
+                for offset in offsets:
+                    out.write(b"%016x\n" % offset)
+                continue
+            is_rela = section.type == SHT_RELA
+            out.write(b"    Offset             Info             Type               Symbol's Value  Symbol's Name"
+                      + (b" + Addend\n" if is_rela else b"\n"))
+            symtab = self.linked(section)
+            if symtab is not None and symtab.type not in (SHT_SYMTAB, SHT_DYNSYM):
+                symtab = None
+            symbols = self.symbols(symtab) if symtab is not None else []
+            versions = self.symbol_versions(symtab) if symtab is not None else {}
+            for offset, info, addend in self.relocations(section):
+                kind = info & 0xffffffff
+                name = names.get(kind)
+                line = b"%016x  %016x " % (offset, info)
+                line += b"%-22s" % (prefix + name).encode() if name is not None else b"unrecognized: %-7x" % kind
+                index = info >> 32
+                if index:
+                    if index >= len(symbols):
+                        raise ElfError(f"bad symbol index {index} in {section.name}")
+                    symbol = symbols[index]
+                    version = versions.get(index)
+                    suffix = b""
+                    if version is not None:
+                        suffix = (b"@@" if version[1] == "public" else b"@") + printable(version[0])
+                    line += b" "
+                    if symbol.info & 0xf == STT_GNU_IFUNC:
+                        # readelf shows the resolver is called rather than its value
+                        shown = printable(symbol.name)
+                        line += shown + suffix + b"()" + b" " * (15 - len(shown) if len(shown) <= 14 else 1)
+                    else:
+                        line += b"%016x " % symbol.value
+                    if not symbol.name and symbol.info & 0xf == STT_SECTION:
+                        line += self.section_name(symbol.shndx)
+                    else:
+                        line += printable(symbol.name) + suffix
+                    if is_rela:
+                        line += b" - %x" % -addend if addend < 0 else b" + %x" % addend
+                elif is_rela:
+                    line += b" " * 20 + (b"-%x" % -addend if addend < 0 else b"%x" % addend)
+                out.write(line + b"\n")
+        if not found:
+            out.write(b"\nThere are no relocations in this file.\n")
+
+    def section_name(self, index: int) -> bytes:
+        if index < len(self.sections):
+            return printable(self.sections[index].name)
+        if index == SHN_ABS:
+            return b"ABS"
+        if index == SHN_COMMON:
+            return b"COMMON"
+        return b"<section 0x%x>" % index
+
+    def write_symbols(self, out):
+        for section in self.sections_of_type(SHT_SYMTAB, SHT_DYNSYM):
+            symbols = self.symbols(section)
+            versions = self.symbol_versions(section)
+            out.write(b"\nSymbol table '%s' contains %d %s:\n" % (
+                printable(section.name), len(symbols), b"entry" if len(symbols) == 1 else b"entries"))
+            out.write(b"   Num:    Value          Size Type    Bind   Vis      Ndx Name\n")
+            for symbol in symbols:
+                vis = symbol.other & 3
+                line = b"%6d: %016x %s" % (symbol.index, symbol.value,
+                                            b"%5d" % symbol.size if symbol.size <= 99999 else b"%#x" % symbol.size)
+                line += b" %-7s %-6s %-7s" % (self.symbol_type(symbol.info & 0xf), self.symbol_binding(symbol.info >> 4),
+                                              ELF_VISIBILITIES[vis].encode())
+                if symbol.other ^ vis:
+                    line += b" [%s] " % self.symbol_other(symbol.other ^ vis)
+                line += b" %4s " % self.symbol_index_type(symbol.shndx)
+                if not symbol.name and symbol.info & 0xf == STT_SECTION and symbol.shndx < len(self.sections):
+                    line += printable(self.sections[symbol.shndx].name)
+                else:
+                    line += printable(symbol.name)
+                version = versions.get(symbol.index)
+                if version is not None:
+                    if version[1] == "undefined":
+                        line += b"@%s (%d)" % (printable(version[0]), version[2])
+                    else:
+                        line += (b"@" if version[1] == "hidden" else b"@@") + printable(version[0])
+                out.write(line + b"\n")
+
+    def symbol_type(self, kind: int) -> bytes:
+        if kind < len(ELF_SYMBOL_TYPES) and ELF_SYMBOL_TYPES[kind] is not None:
+            return ELF_SYMBOL_TYPES[kind].encode()
+        if 13 <= kind <= 15:
+            return b"<processor specific>: %d" % kind
+        if 10 <= kind <= 12:
+            if kind == STT_GNU_IFUNC and self.osabi in (ELFOSABI_GNU, ELFOSABI_FREEBSD):
+                return b"IFUNC"
+            return b"<OS specific>: %d" % kind
+        return b"<unknown>: %d" % kind
+
+    def symbol_binding(self, binding: int) -> bytes:
+        if binding < len(ELF_SYMBOL_BINDINGS):
+            return ELF_SYMBOL_BINDINGS[binding].encode()
+        if binding == STB_GNU_UNIQUE and self.osabi == ELFOSABI_GNU:
+            return b"UNIQUE"
+        if 10 <= binding <= 12:
+            return b"<OS specific>: %d" % binding
+        if 13 <= binding <= 15:
+            return b"<processor specific>: %d" % binding
+        return b"<unknown>: %d" % binding
+
+    def symbol_other(self, other: int) -> bytes:
+        if self.machine == EM_AARCH64 and other & STO_AARCH64_VARIANT_PCS:
+            other &= ~STO_AARCH64_VARIANT_PCS
+            return b"VARIANT_PCS" if other == 0 else b"VARIANT_PCS | %x" % other
+        return b"<other>: %x" % other
+
+    def symbol_index_type(self, index: int) -> bytes:
+        if index == SHN_UNDEF:
+            return b"UND"
+        if index == SHN_ABS:
+            return b"ABS"
+        if index == SHN_COMMON:
+            return b"COM"
+        if index == SHN_X86_64_LCOMMON and self.machine == EM_X86_64:
+            return b"LARGE_COM"
+        if SHN_LOPROC <= index <= SHN_HIPROC:
+            return b"PRC[0x%04x]" % index
+        if SHN_LOOS <= index <= SHN_HIOS:
+            return b"OS [0x%04x]" % index
+        if index >= SHN_LORESERVE:
+            return b"RSV[0x%04x]" % index
+        if index >= len(self.sections):
+            return b"bad section index[%3d]" % index
+        return b"%3d" % index
+
+    @elf_reader
+    def normalised_digest(self) -> str:
+        """
+        Digest of the parts of the binary the lifters read, see above.
+        """
+        digest = hashlib.sha3_256(b"normalised %d\0" % ELF_NORMALISATION_VERSION)
+        digest.update(self.data[:16])
+        (type_, machine, version, entry, phoff, _, flags, ehsize, phentsize, phnum, _, _,
+         _) = self.unpack("HHIQQQIHHHHHH", 16)
+        digest.update(struct.pack("<HHIQQIHHH", type_, machine, version, entry, phoff, flags, ehsize, phentsize, phnum))
+        for i in range(phnum):
+            digest.update(self.data[phoff + i * phentsize:phoff + (i + 1) * phentsize])
+        for section in self.sections:
+            if not section.flags & SHF_ALLOC:
+                continue
+            digest.update(struct.pack("<I", len(section.name)) + section.name)
+            digest.update(struct.pack("<IQQQQIIQQ", *section[2:]))
+            if section.type != SHT_NOBITS and section.name not in NORMALISE_IGNORED:
+                digest.update(self.data[section.offset:section.offset + section.size])
+        text = io.BytesIO()
+        self.write_readelf(text)
+        digest.update(text.getvalue())
+        return digest.hexdigest()
+
+    @elf_reader
+    def symbol_index(self) -> list:
+        """
+        (address, size, type, binding, name) of every defined, named symbol,
+        with any version stripped from the name, as a SymbolIndex takes them.
+        """
+        index = set()
+        for section in self.sections_of_type(SHT_SYMTAB, SHT_DYNSYM):
+            for symbol in self.symbols(section):
+                if symbol.shndx == SHN_UNDEF or not symbol.name or symbol.info & 0xf in (STT_SECTION, STT_FILE):
+                    continue
+                index.add((symbol.value, symbol.size, self.symbol_type(symbol.info & 0xf).decode(),
+                           self.symbol_binding(symbol.info >> 4).decode(),
+                           symbol.name.split(b"@")[0].decode('utf8', errors='replace')))
+        return sorted(index)
+
+
+def printable(name: bytes) -> bytes:
+    """
+    A name as readelf prints it, with control characters shown as ^X.
+    """
+    if not any(c < 0x20 or c == 0x7f for c in name):
+        return name
+    return b"".join(b"^" + bytes([(c + 0x40) & 0x7f]) if c < 0x20 or c == 0x7f else bytes([c]) for c in name)
+
+
+def c_hex(value: int) -> bytes:
+    # printf's %#x, which has no prefix for 0
+    return b"%#x" % value if value else b"0"
+
+
+def relf_symbols(relf_file: str) -> list:
+    """
+    The symbol index entries for `readelf -s` output, when the binary could
+    not be read in process.
+    """
+    index = set()
+    with open(relf_file, 'r', errors='replace') as f:
+        for line in f:
+            fields = line.split()
+            # Num: Value Size Type Bind Vis Ndx Name
+            if len(fields) >= 8 and fields[0].endswith(":") and fields[6] != "UND" \
+                    and fields[3] not in ("SECTION", "FILE"):
+                try:
+                    size = int(fields[2], 0)
+                except ValueError:
+                    continue
+                index.add((int(fields[1], 16), size, fields[3], fields[4], fields[-1].split("@")[0]))
+    return sorted(index)
+
+
+class SymbolIndex:
+    """
+    The defined symbols of a binary by name and by address, loaded from the
+    `symbols` output of the readelf stage.
+    """
+
+    def __init__(self, symbols: list):
+        self.symbols = [tuple(s) for s in sorted(symbols)]
+        self.addresses = [s[0] for s in self.symbols]
+        self.max_size = max((max(s[1], 1) for s in self.symbols), default=1)
+        self.names = collections.defaultdict(list)
+        for s in self.symbols:
+            self.names[s[4]].append(s)
+
+    def lookup(self, name: str) -> list:
+        return self.names.get(name, [])
+
+    def containing(self, address: int, kind: str | None = None) -> list:
+        """
+        Symbols whose extent includes the address, optionally only those of
+        one type, e.g. FUNC. A symbol without a size covers its own address.
+        """
+        found = []
+        i = bisect.bisect_right(self.addresses, address)
+        while i > 0 and self.addresses[i - 1] + self.max_size > address:
+            i -= 1
+            start, size, type_, binding, name = self.symbols[i]
+            if address < start + max(size, 1) and (kind is None or type_ == kind):
+                found.append(self.symbols[i])
+        return found[::-1]
+
+
+def corpus_files(paths: list) -> list:
+    """
+    The files named by `paths` and those under the directories among them.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(os.path.join(root, name) for root, dirs, names in os.walk(path) for name in names)
+        else:
+            files.append(path)
+    return files
+
+
+def check_readelf(paths: list, out) -> int:
+    """
+    Differential test of ElfFile against the readelf binary on every ELF file
+    under `paths`, reporting the first differing line of each mismatch.
+    Returns the number of mismatches.
+    """
+    if READELF_BIN is None:
+        raise FileNotFoundError("readelf is needed to check against")
+    counts = collections.Counter()
+    for path in corpus_files(paths):
+        try:
+            with open(path, 'rb') as f:
+                if f.read(4) != b"\x7fELF":
+                    continue
+            with ElfFile(path) as elf:
+                ours = io.BytesIO()
+                elf.write_readelf(ours)
+        except ElfError as e:
+            counts["unsupported"] += 1
+            logging.info(f"skipping {path}: {e}")
+            continue
+        except OSError:
+            continue
+        theirs = subprocess.run([READELF_BIN, "-s", "-r", "-W", path], stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL).stdout
+        if theirs == ours.getvalue():
+            counts["identical"] += 1
+            continue
+        counts["different"] += 1
+        ours = ours.getvalue().split(b"\n")
+        theirs = theirs.split(b"\n")
+        line = next((i for i, (a, b) in enumerate(zip(ours, theirs)) if a != b), min(len(ours), len(theirs)))
+        print(f"{path}:{line + 1}:", file=out)
+        print("  readelf:", theirs[line].decode('utf8', errors='replace') if line < len(theirs) else "<end>", file=out)
+        print("  ours:   ", ours[line].decode('utf8', errors='replace') if line < len(ours) else "<end>", file=out)
+    print(f"{counts['identical']} identical, {counts['different']} different, {counts['unsupported']} unsupported",
+          file=out)
+    return counts["different"]
+
+
+def lifted_digests(cache_root: str, path: str) -> dict:
+    """
+    Output name -> digest of the readelf stage's text and, when BAP is
+    installed, of BAP's ADT and BIR for a binary, lifted in its own entry
+    of `cache_root`.
+    """
+    tmp_dir = get_tempdir(file_digest(path), cache_root)
+    read_write_binary(tmp_dir, path)
+    outputs = {"relf": run_readelf(tmp_dir)["relf"]}
+    if BAP_BIN is not None:
+        lifted = run_bap_lift(tmp_dir, False)
+        outputs.update({"adt": lifted["adt"], "bir": lifted["bir"]})
+    digests = {}
+    for name, output in outputs.items():
+        digest = hashlib.sha256()
+        with open_artifact(output) as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        digests[name] = digest.hexdigest()
+    return digests
+
+
+def check_normalisation(paths: list, out) -> int:
+    """
+    Group the ELF files under `paths` by normalised digest and lift every
+    distinct binary of each group, reporting groups whose members' lifter
+    outputs differ. Returns the number of such groups.
+    """
+    groups = collections.defaultdict(dict)
+    for path in corpus_files(paths):
+        try:
+            with ElfFile(path) as elf:
+                key = elf.normalised_digest()
+        except (ElfError, OSError):
+            continue
+        groups[key].setdefault(file_digest(path), path)
+    shared = [members for members in groups.values() if len(members) > 1]
+    different = 0
+    cache_root = tempfile.mkdtemp(prefix="basil-tool-normalisation-")
+    try:
+        index_db(cache_root)
+        for members in shared:
+            paths = list(members.values())
+            lifted = [lifted_digests(cache_root, path) for path in paths]
+            for path, digests in zip(paths[1:], lifted[1:]):
+                outputs = [name for name in digests if digests[name] != lifted[0][name]]
+                if outputs:
+                    different += 1
+                    print(f"{paths[0]} and {path}: {', '.join(outputs)} differ", file=out)
+                    break
+    finally:
+        shutil.rmtree(cache_root, ignore_errors=True)
+    print(f"{sum(len(m) for m in groups.values())} binaries, {len(groups)} normalised, "
+          f"{len(shared)} shared by distinct binaries, {different} with different lifter output", file=out)
+    return different
+
+
+# path -> (stat, SymbolIndex), so the daemon loads each index once
+SYMBOL_INDEXES = {}
+
+
+def symbol_index(symbols_file: str) -> SymbolIndex:
+    st = os.stat(symbols_file)
+    stat = (st.st_ino, st.st_size, st.st_mtime_ns)
+    cached = SYMBOL_INDEXES.get(symbols_file)
+    if cached is not None and cached[0] == stat:
+        return cached[1]
+    with open(symbols_file, 'r') as f:
+        index = SymbolIndex(json.load(f))
+    SYMBOL_INDEXES[symbols_file] = (stat, index)
+    return index
+
+
+"""
+Function filtering (-f): only the selected functions and their transitive
+callees are of interest. BAP cannot lift part of a binary so the lift stays
+whole, but basil is given the function as its main procedure when there is
+just one, Boogie only verifies the selected procedures, and BIR and Boogie
+outputs are sliced down to the selection before they are sent.
+"""
+
+BIR_SUB = re.compile(rb"^[0-9a-fA-F]+: sub ([^\s(]+)\(")
+
+BIR_CALL = re.compile(rb"\bcall @([^\s]+)")
+
+
+def resolve_functions(selection: list, symbols_file: str | None) -> tuple:
+    """
+    Names for a list of function names and addresses, an address names the
+    function containing it. Raises ValueError for addresses outside every
+    function.
+    """
+    names = set()
+    for item in selection:
+        if not item.lower().startswith("0x"):
+            names.add(item)
+            continue
+        matches = symbol_index(symbols_file).containing(int(item, 16), "FUNC")
+        if not matches:
+            raise ValueError(f"No function at {item}")
+        names.add(matches[0][4])
+    return tuple(sorted(names))
+
+
+def selected_names(functions: tuple, names) -> list:
+    """
+    The procedures among `names` of the selected functions, which basil names
+    after the function and its address, e.g. main_1812 for main. Raises
+    ValueError if there are none, rather than slice away everything.
+    """
+    pattern = re.compile("^(?:" + "|".join(re.escape(f) for f in functions) + r")(?:_\d+)?$")
+    found = [name for name in names if pattern.match(name)]
+    if not found:
+        raise ValueError(f"No procedure found for {', '.join(functions)}")
+    return found
+
+
+def slice_bir(src: str, dest: str, functions: tuple) -> str:
+    """
+    Keep the program header and the subs of the selected functions and their
+    callees, in their original order.
+    """
+    spans = collections.defaultdict(list)
+    callees = collections.defaultdict(set)
+    header_end = None
+    with open_artifact(src) as f:
+        offset = 0
+        current = None
+        for line in f:
+            match = BIR_SUB.match(line)
+            if match:
+                # a sub runs up to the next one
+                if current is not None:
+                    spans[current][-1][1] = offset
+                else:
+                    header_end = offset
+                current = match.group(1).decode('utf8', errors='replace')
+                spans[current].append([offset, None])
+            elif current is not None:
+                callees[current].update(c.decode('utf8', errors='replace') for c in BIR_CALL.findall(line))
+            offset += len(line)
+        if current is not None:
+            spans[current][-1][1] = offset
+    keep = call_closure(selected_names(functions, spans), callees)
+    selected = sorted(span for name in keep for span in spans[name])
+    with publishing(dest) as (tmp,):
+        with open_artifact(src) as f, open(tmp, 'wb') as out:
+            out.write(f.read(header_end if header_end is not None else -1))
+            position = header_end
+            # compressed artifacts can't seek, skip forwards by reading
+            for start, end in selected:
+                while position < start:
+                    position += len(f.read(min(start - position, 1 << 20)))
+                out.write(f.read(end - start))
+                position = end
+    return dest
+
+
+def slice_boogie(src: str, dest: str, functions: tuple) -> str:
+    """
+    Keep every global declaration and procedure without a body, but only the
+    procedures of the selected functions and their callees.
+    """
+    with open(src, 'r') as f:
+        text = f.read()
+    decls = boogie_declarations(text)
+    callees = collections.defaultdict(set)
+    for d in decls:
+        if d.keyword in ("procedure", "implementation") and d.body_start is not None:
+            callees[d.name].update(BOOGIE_CALL.findall(text, d.body_start, d.end))
+    procedures = {d.name for d in decls if d.keyword in ("procedure", "implementation")}
+    keep = call_closure(selected_names(functions, procedures), callees)
+    parts = [text[:decls[0].start] if decls else text]
+    parts += [text[d.start:d.end] for d in decls
+              if d.keyword not in ("procedure", "implementation") or d.body_start is None or d.name in keep]
+    write_atomic(dest, "".join(parts).encode('utf8'))
+    return dest
+
+
+SLICERS = {".bir": slice_bir, ".bpl": slice_boogie}
+
+
+def slice_output(tmp_dir: str, path: str, functions: tuple) -> str:
+    """
+    The selected part of an output, for the kinds of output that can be
+    sliced. Slices are kept for as long as the output file is unchanged.
+    """
+    slicer = SLICERS.get(os.path.splitext(artifact_name(path))[1])
+    if slicer is None:
+        return path
+    st = os.stat(path)
+    dest = os.path.join(job_dir(tmp_dir, f"slice {path} {st.st_ino}:{st.st_size}:{st.st_mtime_ns} {functions}"),
+                        os.path.basename(artifact_name(path)))
+    if os.path.exists(dest):
+        return dest
+    return slicer(path, dest, functions)
+
+
+"""
+The pipeline is a graph of stages. Each stage names the stages it depends on,
+the outputs it always produces, whether its outputs are cached, and what its
+result depends on besides its dependencies' results: tool versions, arguments
+and input files. run_pipeline only runs the stages needed for the requested
+output, and runs independent stages concurrently.
+
+A stage's job key (see job_key) is a digest of those, the binary and its
+dependencies' keys, so it changes whenever anything upstream of it does.
+"""
+
+Stage = collections.namedtuple("Stage", ["name", "deps", "outputs", "cached", "key", "run"])
+
+StageContext = collections.namedtuple("StageContext", ["tmp_dir", "cache_root", "bin_hash", "args", "spec", "metrics", "remote",
+                                                       "functions"])
+
+STAGES = {stage.name: stage for stage in [
+    Stage("readelf", [], ["relf", "symbols"], True,
+          lambda ctx: {"tools": [tool_fingerprint(READELF_BIN, ctx.cache_root)], "reader": ELF_READER_VERSION},
+          lambda ctx, inputs: run_readelf(ctx.tmp_dir)),
+    Stage("bap", [], ["adt", "bir"], True,
+          lambda ctx: {"tools": [tool_fingerprint(BAP_BIN, ctx.cache_root)], "asli": False,
+                       "codec": artifact_codec(ctx.cache_root)},
+          lambda ctx, inputs: run_bap_lift(ctx.tmp_dir, False)),
+    Stage("basil", ["bap", "readelf"], ["boogie", "basil-il"], True,
+          lambda ctx: {"tools": [tool_fingerprint(BASIL_BIN, ctx.cache_root, worker_jars())],
+                       "spec": spec_digest(ctx.spec), "functions": ctx.functions},
+          lambda ctx, inputs: run_basil(ctx.tmp_dir, job_key("basil", ctx), ctx.args, ctx.spec, inputs, ctx.functions)),
+    Stage("boogie", ["basil"], ["boogie_stdout", "boogie_stderr", "boogie_stdout_stderr"], False,
+          lambda ctx: {"tools": [tool_fingerprint(BOOGIE_BIN, ctx.cache_root)], "args": normalise_args(ctx.args),
+                       "functions": ctx.functions},
+          lambda ctx, inputs: run_boogie(ctx.tmp_dir, job_key("boogie", ctx), ctx.args, ctx.spec, inputs, ctx.functions)),
+    Stage("boogie-source", [], ["boogie"], False,
+          lambda ctx: {"tools": [tool_fingerprint(BOOGIE_BIN, ctx.cache_root)], "args": normalise_args(ctx.args),
+                       "functions": ctx.functions},
+          lambda ctx, inputs: run_boogie_only(ctx.tmp_dir, job_key("boogie-source", ctx), ctx.args, ctx.spec,
+                                              ctx.functions)),
+    Stage("boogie-counterexample", ["boogie"], ["counterexample", "counterexample-failing"], False,
+          lambda ctx: {"renderer": MODEL_RENDERER_VERSION},
+          lambda ctx, inputs: pretty_print_counterexample(ctx.tmp_dir, job_key("boogie", ctx), inputs)),
+]}
+
+
+def normalise_args(args: list) -> list:
+    """
+    Arguments as they matter to the job key: each option together with the
+    values following it, in sorted order. Leading positional arguments keep
+    their order.
+    """
+    positional = []
+    options = []
+    for arg in args:
+        if not arg:
+            continue
+        if arg.startswith(("-", "/")):
+            options.append([arg])
+        elif options:
+            options[-1].append(arg)
+        else:
+            positional.append(arg)
+    return positional + sorted(options)
+
+
+@memoised
+def job_key(name: str, ctx: StageContext) -> str:
+    stage = STAGES[name]
+    parts = {"binary": ctx.bin_hash, **stage.key(ctx), "deps": [job_key(dep, ctx) for dep in stage.deps]}
+    return f"{name} " + hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf8')).hexdigest()
+
+
+def stage_closure(name: str) -> list:
+    """
+    The stage and everything it depends on, in dependency order.
+    """
+    order = []
+    def visit(n):
+        if n in order:
+            return
+        for dep in STAGES[n].deps:
+            visit(dep)
+        order.append(n)
+    visit(name)
+    return order
+
+
+def plan_stages(tool: str, output: str) -> list:
+    """
+    Stages needed for `output` of `tool`, e.g. -t basil -o adt only needs bap.
+    """
+    order = stage_closure(tool)
+    for name in order:
+        if output in STAGES[name].outputs:
+            return stage_closure(name)
+    return order
+
+
+def run_stage(stage: Stage, ctx: StageContext, deps: list):
+    """
+    Run a stage once its dependencies are done, returning its outputs merged
+    over those of its dependencies.
+    """
+    inputs = {}
+    for dep in deps:
+        inputs.update(dep.result())
+    with ctx.metrics.stage(stage.name):
+        if not stage.cached:
+            with admitted_stage(ctx.cache_root, stage), stage_deadline():
+                outputs = stage.run(ctx, inputs)
+        else:
+            job = job_key(stage.name, ctx)
+            # a row whose files are gone, e.g. from a run that failed after recording them, is a miss
+            is_complete = lambda cached: all(o in cached and artifact_readable(cached[o]) for o in stage.outputs)
+
+            def compute():
+                if ctx.remote is not None:
+                    fetched = ctx.remote.fetch(ctx.tmp_dir, job)
+                    if fetched is not None and is_complete(fetched):
+                        note_cache("remote")
+                        return fetched
+                with admitted_stage(ctx.cache_root, stage), stage_deadline():
+                    result = stage.run(ctx, inputs)
+                if ctx.remote is not None:
+                    ctx.remote.store(ctx.tmp_dir, job, result)
+                return result
+
+            outputs = run_job(ctx.tmp_dir, job, is_complete, compute)
+    return {**inputs, **outputs}
+
+
+def run_pipeline(tool: str, output: str, ctx: StageContext):
+    order = plan_stages(tool, output)
+    logging.info(f"running stages {order}")
+    # one thread per stage, so stages blocked on their dependencies can't starve the pool
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(order)) as pool:
+        futures = {}
+        for name in order:
+            stage = STAGES[name]
+            # in a copy of our context, which holds the request's child processes
+            futures[name] = pool.submit(contextvars.copy_context().run, run_stage, stage, ctx,
+                                        [futures[dep] for dep in stage.deps])
+        outputs = {}
+        for name in order:
+            outputs.update(futures[name].result())
+    return outputs
+
+
+"""
+Admission control: the heavy stages (BAP, the basil JVM and Boogie with Z3)
+take a slot on the host before they run, so that concurrent requests queue
+instead of thrashing the machine. Waiting stages hold a ticket in the cache
+root's index.db. Whoever polls admits waiting tickets in queue order while
+their stage has a free slot and the cores and memory the stage is expected
+to use fit next to the stages already running. Stages that fill the cache
+go before uncached ones, as every later request for the binary benefits
+from them, but once a ticket has to wait for the host every ticket waiting
+at the time goes before those that arrive later, whatever their priority,
+so the host is served first come first served while it is busy. Tickets of
+processes that died are dropped.
+
+Only the computation holds a slot, cache hits and waits for another process
+computing the same job don't. The Boogie stages queue for their slot in
+verify_procedures, once they know how many Boogie processes they will run.
+"""
+
+# Cores and memory each process of a stage is expected to use while it runs.
+HEAVY_STAGES = {
+    "bap": (1, 2 * 1024 ** 3),
+    "basil": (1, 2 * 1024 ** 3),
+    "boogie": (1, 1024 ** 3),
+    "boogie-source": (1, 1024 ** 3),
+}
+
+# Stages sharing the slots of another, both Boogie stages run the same solvers.
+STAGE_POOLS = {"boogie-source": "boogie"}
+
+# Stages that take their slot themselves rather than in run_stage.
+SELF_ADMITTED = {"boogie", "boogie-source"}
+
+# Queue priorities, lower goes first.
+PRIORITY_CACHE_FILL = 0
+PRIORITY_UNCACHED = 1
+PRIORITY_PREFETCH = 2
+
+# Overrides the priority of the stages a request runs, see run_prefetch.
+ADMISSION_PRIORITY = contextvars.ContextVar("ADMISSION_PRIORITY", default=None)
+
+
+def host_memory() -> int:
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError):
+        return 0
+
+
+def stage_pool(stage: str) -> str:
+    return STAGE_POOLS.get(stage, stage)
+
+
+def stage_slots(config: str | None = STAGE_SLOTS) -> dict:
+    """
+    Number of each pool of heavy stages that may run at once and of all of
+    them under "total", as many as fit the cores and memory and at least one,
+    along with the host's "cores" and "memory" (bytes, 0 if unknown) that the
+    running stages must fit in together.
+    """
+    cores = os.cpu_count() or 1
+    memory = host_memory()
+    slots = {"total": cores, "cores": cores, "memory": memory}
+    for name, (cpus, mem) in HEAVY_STAGES.items():
+        if stage_pool(name) != name:
+            continue
+        fit = cores // max(cpus, 1)
+        if memory:
+            fit = min(fit, memory // mem)
+        slots[name] = max(1, fit)
+    for part in (config or "").split(","):
+        if part.strip():
+            name, _, value = part.partition("=")
+            if name.strip() not in slots:
+                raise ValueError(f"Unknown stage in slots '{part}'")
+            slots[name.strip()] = max(1, int(value))
+    return slots
+
+
+SLOTS = None
+
+
+def stage_usage(stage: str, processes: int) -> tuple:
+    cpus, mem = HEAVY_STAGES.get(stage, (1, 0))
+    return cpus * processes, mem * processes
+
+
+def hold_waiting(con, now: float):
+    con.execute("UPDATE admission SET held=? WHERE held IS NULL AND admitted IS NULL AND priority<?;",
+                [now, PRIORITY_PREFETCH])
+
+
+def admit_waiting(con, slots: dict):
+    """
+    Admit waiting tickets, in queue order, while their pool has free slots
+    and the cores and memory of their stage fit next to those already
+    running. A ticket that doesn't fit holds back the ones behind it, so
+    Boogie isn't starved by a stream of smaller stages, unless nothing is
+    running at all. Every ticket waiting then is marked held, and held
+    tickets queue ahead of later ones. Prefetches are never held, they
+    stay behind everything else.
+    """
+    rows = con.execute("SELECT ticket, stage, processes, pid, admitted FROM admission "
+                       "ORDER BY held IS NULL, held, priority, ticket;").fetchall()
+    dead = [(ticket,) for (ticket, stage, processes, pid, admitted) in rows if not pid_alive(pid)]
+    con.executemany("DELETE FROM admission WHERE ticket=?;", dead)
+    dead = {ticket for (ticket,) in dead}
+    running = collections.Counter()
+    cpus = mem = 0
+    for ticket, stage, processes, pid, admitted in rows:
+        if admitted is not None and ticket not in dead:
+            running[stage_pool(stage)] += 1
+            used_cpus, used_mem = stage_usage(stage, processes)
+            cpus += used_cpus
+            mem += used_mem
+    total = sum(running.values())
+    now = time.time()
+    for ticket, stage, processes, pid, admitted in rows:
+        if admitted is not None or ticket in dead:
+            continue
+        if total >= slots["total"]:
+            hold_waiting(con, now)
+            break
+        pool = stage_pool(stage)
+        if running[pool] >= slots.get(pool, 1):
+            continue
+        need_cpus, need_mem = stage_usage(stage, processes)
+        if total and (cpus + need_cpus > slots["cores"] or (slots["memory"] and mem + need_mem > slots["memory"])):
+            hold_waiting(con, now)
+            break
+        con.execute("UPDATE admission SET admitted=? WHERE ticket=?;", [now, ticket])
+        running[pool] += 1
+        total += 1
+        cpus += need_cpus
+        mem += need_mem
+
+
+def admitted_stage(cache_root: str, stage: Stage):
+    if stage.name in SELF_ADMITTED:
+        return contextlib.nullcontext()
+    return admitted(cache_root, stage.name, stage.cached)
+
+
+@contextlib.contextmanager
+def admitted(cache_root: str, stage: str, cached: bool = False, processes: int = 1):
+    """
+    Hold a slot for a heavy stage running `processes` processes while the
+    block runs, queueing for it first. The time spent queued is added to the
+    stage's metrics.
+    """
+    global SLOTS
+    if stage not in HEAVY_STAGES:
+        yield
+        return
+    if SLOTS is None:
+        SLOTS = stage_slots()
+    db = index_db(cache_root)
+    priority = ADMISSION_PRIORITY.get()
+    if priority is None:
+        priority = PRIORITY_CACHE_FILL if cached else PRIORITY_UNCACHED
+    with db.transaction() as con:
+        ticket = con.execute("INSERT INTO admission (stage, priority, pid, enqueued, processes) VALUES (?, ?, ?, ?, ?);",
+                             [stage, priority, os.getpid(), time.time(), processes]).lastrowid
+    start = time.monotonic()
+    try:
+        while True:
+            with db.transaction() as con:
+                admit_waiting(con, SLOTS)
+                row = con.execute("SELECT admitted FROM admission WHERE ticket=?;", [ticket]).fetchone()
+            if row is not None and row[0] is not None:
+                break
+            if time.monotonic() - start > ADMISSION_TIMEOUT:
+                raise TimeoutError(f"Host busy, {stage} could not start within {ADMISSION_TIMEOUT:.0f}s")
+            check_cancelled(f"while {stage} was queued")
+            time.sleep(CLAIM_POLL_INTERVAL)
+        note_queued(time.monotonic() - start)
+        logging.info(f"{stage} admitted after {time.monotonic() - start:.3f}s")
+        yield
+    finally:
+        with db.transaction() as con:
+            con.execute("DELETE FROM admission WHERE ticket=?;", [ticket])
+            # hand our slot on without waiting for the next poll
+            admit_waiting(con, SLOTS)
+
+
+"""
+Each request records, per stage, the wall time, the CPU time and peak RSS of
+the child processes the stage ran, and the outcome of its cache lookup. Counters
+are summed across processes in the index database and rendered to a Prometheus
+text file after every request, and the request itself is appended as one JSON
+line to the metrics log. Basil jobs run on the resident worker pool are not
+child processes, only their wall time is recorded.
+"""
+
+# The stage a thread is running, run_command and run_job report to it.
+CURRENT_STAGE = contextvars.ContextVar("CURRENT_STAGE", default=None)
+
+METRICS_TABLE = "create table if not exists metrics (name string, labels string, value real, primary key (name, labels));"
+
+# name -> (type, help), the max_rss metric keeps the largest value seen
+METRICS = {
+    "basil_tool_requests_total": ("counter", "Requests handled, by tool and exit status."),
+    "basil_tool_request_seconds_total": ("counter", "Wall time spent handling requests."),
+    "basil_tool_stage_runs_total": ("counter", "Stages run, including cache hits."),
+    "basil_tool_stage_seconds_total": ("counter", "Wall time spent in each stage."),
+    "basil_tool_stage_cpu_seconds_total": ("counter", "CPU time of the child processes run by each stage."),
+    "basil_tool_stage_max_rss_bytes": ("gauge", "Largest peak RSS of a child process run by each stage."),
+    "basil_tool_cache_hits_total": ("counter", "Stages whose outputs were already cached."),
+    "basil_tool_cache_misses_total": ("counter", "Stages computed and added to the cache."),
+    "basil_tool_cache_remote_hits_total": ("counter", "Stages missing locally whose outputs came from the remote cache."),
+    "basil_tool_cache_waits_total": ("counter", "Times a stage waited for another process computing the same job."),
+    "basil_tool_stage_queue_seconds_total": ("counter", "Time stages spent queued for a slot on the host."),
+}
+
+CACHE_COUNTERS = {"hit": "basil_tool_cache_hits_total", "miss": "basil_tool_cache_misses_total",
+                  "remote": "basil_tool_cache_remote_hits_total"}
+
+
+class StageMetrics:
+    def __init__(self, name: str):
+        self.name = name
+        # hit, miss, remote, or None for stages that are not cached
+        self.cache = None
+        self.waits = 0
+        self.queued = 0.0
+        self.wall = 0.0
+        self.user = 0.0
+        self.system = 0.0
+        self.max_rss = 0
+        self.children = 0
+        self.lock = threading.Lock()
+
+    def add_child(self, usage):
+        with self.lock:
+            self.children += 1
+            self.user += usage.ru_utime
+            self.system += usage.ru_stime
+            # kilobytes on linux
+            self.max_rss = max(self.max_rss, usage.ru_maxrss * 1024)
+
+    @classmethod
+    def from_dict(cls, fields: dict):
+        stage = cls(fields["stage"])
+        for name in ("cache", "waits", "queued", "wall", "user", "system", "max_rss", "children"):
+            setattr(stage, name, fields[name])
+        return stage
+
+    def as_dict(self) -> dict:
+        return {"stage": self.name, "cache": self.cache, "waits": self.waits, "queued": round(self.queued, 6),
+                "wall": round(self.wall, 6), "user": round(self.user, 6), "system": round(self.system, 6),
+                "max_rss": self.max_rss, "children": self.children}
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.start = time.monotonic()
+        self.stages = []
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        stage = StageMetrics(name)
+        token = CURRENT_STAGE.set(stage)
+        start = time.monotonic()
+        try:
+            yield stage
+        finally:
+            stage.wall = time.monotonic() - start
+            CURRENT_STAGE.reset(token)
+            self.stages.append(stage)
+
+
+def note_cache(outcome: str):
+    stage = CURRENT_STAGE.get()
+    if stage is None:
+        return
+    if outcome == "wait":
+        stage.waits += 1
+    else:
+        stage.cache = outcome
+
+
+def note_queued(seconds: float):
+    stage = CURRENT_STAGE.get()
+    if stage is not None:
+        stage.queued += seconds
+
+
+def record_metrics(cache_root: str, metrics: RequestMetrics, fields: dict):
+    """
+    Add a finished request to the counters, then rewrite the Prometheus file and
+    append the request to the log, rotating it once it reaches METRICS_LOG_BYTES.
+    """
+    wall = time.monotonic() - metrics.start
+    request = {"time": time.time(), **fields, "wall": round(wall, 6),
+               "stages": [stage.as_dict() for stage in metrics.stages]}
+    counts = [("basil_tool_requests_total", {"tool": fields["tool"], "status": fields["status"]}, 1),
+              ("basil_tool_request_seconds_total", {}, wall)]
+    for stage in metrics.stages:
+        labels = {"stage": stage.name}
+        counts += [("basil_tool_stage_runs_total", labels, 1),
+                   ("basil_tool_stage_seconds_total", labels, stage.wall),
+                   ("basil_tool_stage_cpu_seconds_total", labels, stage.user + stage.system),
+                   ("basil_tool_cache_waits_total", labels, stage.waits),
+                   ("basil_tool_stage_queue_seconds_total", labels, stage.queued)]
+        if stage.cache is not None:
+            counts.append((CACHE_COUNTERS[stage.cache], labels, 1))
+    peaks = [("basil_tool_stage_max_rss_bytes", {"stage": s.name}, s.max_rss) for s in metrics.stages if s.children]
+
+    with index_db(cache_root).transaction() as con:
+        con.executemany("INSERT INTO metrics VALUES (?, ?, ?) ON CONFLICT(name, labels) DO UPDATE SET value=value+excluded.value;",
+                        [(name, prometheus_labels(labels), value) for name, labels, value in counts])
+        con.executemany("INSERT INTO metrics VALUES (?, ?, ?) ON CONFLICT(name, labels) DO UPDATE SET value=max(value, excluded.value);",
+                        [(name, prometheus_labels(labels), value) for name, labels, value in peaks])
+        rows = con.execute("SELECT name, labels, value FROM metrics ORDER BY name, labels;").fetchall()
+
+    lines = []
+    for name, (kind, description) in METRICS.items():
+        lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+        lines += [f"{name}{labels} {int(value) if value.is_integer() else value}" for (n, labels, value) in rows if n == name]
+    write_atomic(METRICS_FILE or os.path.join(cache_root, "metrics.prom"), ("\n".join(lines) + "\n").encode())
+
+    # a single short write to an O_APPEND file, so concurrent requests don't interleave
+    log = METRICS_LOG or os.path.join(cache_root, "metrics.jsonl")
+    fd = os.open(log, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(request) + "\n").encode())
+        if os.fstat(fd).st_size > METRICS_LOG_BYTES:
+            rotate_log(log, fd)
+    finally:
+        os.close(fd)
+
+
+def rotate_log(log: str, fd: int):
+    """
+    Move a full log aside, unless a concurrent request already has.
+    """
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    try:
+        st = os.stat(log)
+    except FileNotFoundError:
+        return
+    # still the file we have open, so nobody rotated it since
+    if (st.st_dev, st.st_ino) == (os.fstat(fd).st_dev, os.fstat(fd).st_ino):
+        os.replace(log, log + ".1")
+
+
+def prometheus_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    def quote(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{quote(v)}"' for k, v in labels.items()) + "}"
+
+
+"""
+Outputs of cached stages can also be shared between nodes through a remote
+store, configured like the compiler caches in lib/cache/from-config.ts:
+`S3(bucket,path,region)`, or `OnDisk(path)` for a shared filesystem or
+testing. Several, separated by `;`, are tried in order. A stage missing
+locally is fetched from the first store that has it before it is computed,
+and computed outputs are written to every store.
+
+Objects are keyed by the binary hash and the job key, which covers the
+toolchain. Each job's files are stored under their path relative to the job
+directory, followed by a manifest of the outputs, so a job is only visible
+once all its files are.
+"""
+
+class OnDiskStore:
+    def __init__(self, root: str):
+        self.root = root
+        self.details = f"OnDiskStore({root})"
+
+    def get(self, key: str, dest: str) -> bool:
+        try:
+            copy_output(os.path.join(self.root, key), dest)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def put(self, key: str, src: str):
+        path = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with publishing(path) as (tmp,):
+            shutil.copyfile(src, tmp)
+
+
+class S3Store:
+    # one client per region, as lib/s3-handler.ts does
+    clients = {}
+
+    def __init__(self, bucket: str, path: str, region: str):
+        # only now, it takes longer to import than many requests take
+        try:
+            import boto3
+        except ImportError:
+            raise ValueError("the S3 remote cache needs boto3")
+        if region not in S3Store.clients:
+            S3Store.clients[region] = boto3.client("s3", region_name=region)
+        self.client = S3Store.clients[region]
+        self.bucket = bucket
+        self.path = path
+        self.details = f"S3Store(s3://{bucket}/{path} in {region})"
+
+    def get(self, key: str, dest: str) -> bool:
+        import botocore.exceptions
+        try:
+            with publishing(dest) as (tmp,):
+                self.client.download_file(self.bucket, f"{self.path}/{key}", tmp)
+            return True
+        except botocore.exceptions.ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey"):
+                return False
+            raise
+
+    def put(self, key: str, src: str):
+        self.client.upload_file(src, self.bucket, f"{self.path}/{key}",
+                                ExtraArgs={"StorageClass": "REDUCED_REDUNDANCY"})
+
+
+def outside_job_dir(path: str) -> bool:
+    return os.path.isabs(path) or os.path.normpath(path).split(os.sep)[0] == ".."
+
+
+class RemoteCache:
+    def __init__(self, stores: list):
+        self.stores = stores
+
+    def fetch(self, tmp_dir: str, job: str):
+        """
+        Download a job's outputs into the job directory, returning them, or
+        None if no store has the job.
+        """
+        prefix = remote_prefix(tmp_dir, job)
+        manifest = scratch_name(os.path.join(tmp_dir, "remote-manifest.json"))
+        for store in self.stores:
+            try:
+                if not store.get(f"{prefix}/manifest.json", manifest):
+                    continue
+                with open(manifest, 'r') as f:
+                    names = json.load(f)
+                # the manifest names files to write, it mustn't reach outside the job directory
+                if any(not isinstance(path, str) or outside_job_dir(path) for path in names.values()):
+                    raise ValueError(f"{prefix}/manifest.json has paths outside the job directory")
+                for path in sorted(set(names.values())):
+                    os.makedirs(os.path.dirname(os.path.join(tmp_dir, path)), exist_ok=True)
+                    if not store.get(f"{prefix}/{path}", os.path.join(tmp_dir, path)):
+                        raise FileNotFoundError(f"{prefix}/{path}")
+                logging.info(f"fetched {job} from {store.details}")
+                return {name: os.path.join(tmp_dir, path) for name, path in names.items()}
+            except Exception as e:
+                logging.error(f"Error while trying to read {store.details}: {e}")
+            finally:
+                remove_files([manifest])
+        return None
+
+    def store(self, tmp_dir: str, job: str, outputs: dict):
+        prefix = remote_prefix(tmp_dir, job)
+        names = {name: os.path.relpath(path, tmp_dir) for name, path in outputs.items()}
+        if any(outside_job_dir(path) for path in names.values()):
+            logging.info(f"not storing {job} remotely, it has outputs outside the job directory")
+            return
+        manifest = scratch_name(os.path.join(tmp_dir, "remote-manifest.json"))
+        try:
+            with open(manifest, 'w') as f:
+                json.dump(names, f)
+            for store in self.stores:
+                try:
+                    for path in sorted(set(names.values())):
+                        store.put(f"{prefix}/{path}", os.path.join(tmp_dir, path))
+                    store.put(f"{prefix}/manifest.json", manifest)
+                except Exception as e:
+                    logging.error(f"Error while trying to write {store.details}: {e}")
+        finally:
+            remove_files([manifest])
+
+
+def remote_prefix(tmp_dir: str, job: str) -> str:
+    return f"{os.path.basename(tmp_dir)}/{job.replace(' ', '-')}"
+
+
+REMOTE_STORES = {}
+
+
+def remote_from_config(config: str | None):
+    """
+    Stores are created once per process, so the daemon reuses connections.
+    """
+    if not config:
+        return None
+    stores = []
+    for part in config.split(";"):
+        if part not in REMOTE_STORES:
+            match = re.match(r"^([^(]+)\(([^)]+)\)$", part)
+            if not match:
+                raise ValueError(f"Unable to parse '{part}'")
+            params = match.group(2).split(",")
+            if match.group(1) == "OnDisk" and len(params) == 1:
+                REMOTE_STORES[part] = OnDiskStore(params[0])
+            elif match.group(1) == "S3" and len(params) == 3:
+                REMOTE_STORES[part] = S3Store(*params)
+            else:
+                raise ValueError(f"Bad remote cache '{part}'")
+        stores.append(REMOTE_STORES[part])
+    return RemoteCache(stores)
+
+
+"""
+Every job directory under the cache root is listed in the root's index.db
+with its size and last access time. Invocations hold a shared flock on the
+entry's lock file while they use it, eviction takes the lock exclusively
+(without blocking) so entries in use are never removed.
+"""
+
+def index_db(cache_root: str):
+    return CacheDB.get(os.path.join(cache_root, "index.db"), [ENTRY_TABLE, ENTRY_INDEX, TOOL_TABLE, PROC_TABLE, PROC_INDEX, METRICS_TABLE,
+                                                                 ADMISSION_TABLE, migrate_admission_table, NORMALISED_TABLE])
+
+
+def migrate_admission_table(con):
+    columns = [row[1] for row in con.execute("PRAGMA table_info(admission);")]
+    if "processes" not in columns:
+        con.execute("ALTER TABLE admission ADD COLUMN processes integer default 1;")
+        con.execute("ALTER TABLE admission ADD COLUMN held real;")
+
+
+def entry_lock_file(cache_root: str, entry: str):
+    lock_dir = os.path.join(cache_root, "locks")
+    os.makedirs(lock_dir, exist_ok=True)
+    return os.path.join(lock_dir, f"{entry}.lock")
+
+
+def lock_entry(cache_root: str, entry: str):
+    """
+    Take a shared lock on an entry, this must happen before the job directory
+    is created so a concurrent eviction cannot remove it from under us.
+    The lock is released when the returned file is closed.
+    """
+    path = entry_lock_file(cache_root, entry)
+    while True:
+        f = open(path, 'a')
+        fcntl.flock(f, fcntl.LOCK_SH)
+        # eviction unlinks the lock file, a lock on the old one guards nothing
+        if same_file(f.fileno(), path):
+            return f
+        f.close()
+
+
+def same_file(fd: int, path: str) -> bool:
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return False
+    fst = os.fstat(fd)
+    return (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino)
+
+
+def dir_size(path: str) -> int:
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def touch_entry(cache_root: str, entry: str, size: int | None = None):
+    with index_db(cache_root).transaction() as con:
+        if size is None:
+            con.execute("INSERT INTO entries VALUES (?, 0, ?) ON CONFLICT(entry) DO UPDATE SET last_access=excluded.last_access;",
+                        [entry, time.time()])
+        else:
+            con.execute("INSERT INTO entries VALUES (?, ?, ?) ON CONFLICT(entry) DO UPDATE SET bytes=excluded.bytes, last_access=excluded.last_access;",
+                        [entry, size, time.time()])
+
+
+def evict_entry(cache_root: str, entry: str) -> bool:
+    lock_path = entry_lock_file(cache_root, entry)
+    with open(lock_path, 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logging.info(f"not evicting {entry}, in use")
+            return False
+        if not same_file(lock.fileno(), lock_path):
+            # another eviction got here first
+            return False
+        path = os.path.join(cache_root, entry)
+        if os.path.isdir(path):
+            # rename first so nothing sees a half deleted directory
+            trash = os.path.join(cache_root, f".evict-{entry}-{os.getpid()}")
+            os.rename(path, trash)
+            CacheDB.forget(os.path.join(path, "cache.db"))
+            shutil.rmtree(trash, ignore_errors=True)
+        with index_db(cache_root).transaction() as con:
+            con.execute("DELETE FROM entries WHERE entry=?;", [entry])
+        # still holding the lock, so anyone waiting on this file sees it is gone and retries
+        os.unlink(lock_path)
+    logging.info(f"evicted {entry}")
+    return True
+
+
+def cleanup_tempdirs(cache_root: str = CACHE_ROOT, max_bytes: int = CACHE_MAX_BYTES,
+                     max_entries: int = CACHE_MAX_ENTRIES, max_age: float = CACHE_MAX_AGE):
+    """
+    Because temporary directories are shared between invocations we need to cleanup those that are no longer needed.
+    Evicts least recently used entries until the cache is within the byte and
+    entry limits, and any entry not used for max_age seconds.
+    Returns the number of entries evicted.
+    """
+    if not os.path.isdir(cache_root):
+        return 0
+    db = index_db(cache_root)
+    known = {e for (e,) in db.query("SELECT entry FROM entries;")}
+    # pick up directories the index doesn't know about, e.g. from a crashed run
+    with db.transaction() as con:
+        for d in os.scandir(cache_root):
+            if d.is_dir() and d.name.startswith(".evict-"):
+                shutil.rmtree(d.path, ignore_errors=True)
+            elif d.is_dir() and d.name not in ("locks", "dicts") and d.name not in known:
+                con.execute("INSERT OR IGNORE INTO entries VALUES (?, ?, ?);",
+                            [d.name, dir_size(d.path), d.stat().st_mtime])
+        con.execute("DELETE FROM proc_results WHERE last_access < ?;", [time.time() - max_age])
+    entries = db.query("SELECT entry, bytes, last_access FROM entries ORDER BY last_access ASC;")
+
+    total_bytes = sum(e[1] for e in entries)
+    total_entries = len(entries)
+    now = time.time()
+    evicted = 0
+    for (entry, size, last_access) in entries:
+        if total_bytes <= max_bytes and total_entries <= max_entries and now - last_access <= max_age:
+            break
+        if evict_entry(cache_root, entry):
+            total_bytes -= size
+            total_entries -= 1
+            evicted += 1
+    logging.info(f"cleanup evicted {evicted} entries, {total_entries} entries {total_bytes} bytes remain")
+    return evicted
+
+
+def maybe_cleanup_tempdirs(cache_root: str, **limits):
+    """
+    Amortised sweep after a request, at most once per SWEEP_INTERVAL across all
+    processes sharing the cache root.
+    """
+    stamp = os.path.join(cache_root, "last-sweep")
+    try:
+        if time.time() - os.stat(stamp).st_mtime < SWEEP_INTERVAL:
+            return 0
+    except FileNotFoundError:
+        pass
+    with open(stamp, 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return 0
+        os.utime(stamp)
+        return cleanup_tempdirs(cache_root, **limits)
+
+"""
+The job directory, and hence the cache database, is keyed by the hash of the
+input binary, so results are shared by every invocation on the same binary.
+Other input files are not checksummed.
+
+Databases are opened through CacheDB, which keeps one connection per file per
+process in WAL mode, so readers don't block the writer and concurrent
+processes wait on each other (busy_timeout) instead of failing.
+"""
+
+class CacheDB:
+    _open = {}
+    _open_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, path: str, schema: list):
+        with cls._open_lock:
+            db = cls._open.get(path)
+            if db is None or not db.valid():
+                if db is not None:
+                    db.con.close()
+                db = cls._open[path] = cls(path, schema)
+            return db
+
+    @classmethod
+    def forget(cls, path: str):
+        with cls._open_lock:
+            db = cls._open.pop(path, None)
+        if db is not None:
+            with db.lock:
+                db.con.close()
+
+    def __init__(self, path: str, schema: list):
+        self.path = path
+        # autocommit, transactions are explicit
+        self.con = sqlite3.connect(path, timeout=CLAIM_DB_TIMEOUT, check_same_thread=False, isolation_level=None)
+        self.inode = os.stat(path).st_ino
+        self.lock = threading.RLock()
+        self.con.execute("PRAGMA journal_mode=WAL;")
+        self.con.execute("PRAGMA synchronous=NORMAL;")
+        self.con.execute(f"PRAGMA busy_timeout={int(CLAIM_DB_TIMEOUT * 1000)};")
+        with self.transaction() as con:
+            for statement in schema:
+                if callable(statement):
+                    statement(con)
+                else:
+                    con.execute(statement)
+
+    def valid(self) -> bool:
+        """
+        False once the file has been removed, e.g. by eviction of its entry.
+        """
+        try:
+            return os.stat(self.path).st_ino == self.inode
+        except FileNotFoundError:
+            return False
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock:
+            self.con.execute("BEGIN IMMEDIATE;")
+            try:
+                yield self.con
+            except BaseException:
+                self.con.execute("ROLLBACK;")
+                raise
+            self.con.execute("COMMIT;")
+
+    def query(self, sql: str, params=()) -> list:
+        with self.lock:
+            return self.con.execute(sql, params).fetchall()
+
+
+def migrate_jobs_table(con):
+    """
+    Databases from before the jobs table had a key may hold duplicate rows.
+    """
+    columns = [row[1] for row in con.execute("PRAGMA table_info(jobs);")]
+    if columns and "hits" not in columns:
+        con.execute("ALTER TABLE jobs RENAME TO jobs_old;")
+        con.execute(JOB_TABLE)
+        con.execute("INSERT OR REPLACE INTO jobs (job, resultname, resultfile, created, last_access) "
+                    "SELECT job, resultname, resultfile, ?, ? FROM jobs_old;", [time.time(), time.time()])
+        con.execute("DROP TABLE jobs_old;")
+
+
+def job_db(tmp_dir):
+    return CacheDB.get(f"{tmp_dir}/cache.db", [migrate_jobs_table, JOB_TABLE, QUEUE_TABLE, IMPORT_TABLE])
+
+
+def get_cache(tmp_dir, job: str):
+    # get cached result
+    r = job_db(tmp_dir).query("SELECT resultname, resultfile FROM jobs WHERE job=?;", [job])
+    r = {oname:ofile for (oname,ofile) in r}
+    logging.info(f"cached {job} : {r}")
+    return r
+
+
+def record_hit(tmp_dir, job: str):
+    with job_db(tmp_dir).transaction() as con:
+        con.execute("UPDATE jobs SET hits=hits+1, last_access=? WHERE job=?;", [time.time(), job])
+
+
+def claim_job(tmp_dir, job: str):
+    """
+    Try to become the process that computes `job`. A claim left behind by a
+    process that has since died is taken over.
+    """
+    try:
+        with job_db(tmp_dir).transaction() as con:
+            row = con.execute("SELECT pid FROM jclaimed WHERE job=?;", [job]).fetchone()
+            if row is not None and not pid_alive(row[0]):
+                logging.info(f"claim on {job} by dead process {row[0]}, taking over")
+                con.execute("DELETE FROM jclaimed WHERE job=? AND pid=?;", [job, row[0]])
+            con.execute("INSERT INTO jclaimed values (?, ?, ?);", [job, os.getpid(), time.time()])
+        logging.info(f"claimed {job}")
+        return True
+    except sqlite3.IntegrityError:
+        return False
+
+
+def unclaim_job(tmp_dir, job: str):
+    with job_db(tmp_dir).transaction() as con:
+        con.execute("DELETE FROM jclaimed WHERE job=(?) AND pid=(?);", [job, os.getpid()])
+
+
+def is_claimed(tmp_dir, job: str):
+    rows = job_db(tmp_dir).query("SELECT pid FROM jclaimed WHERE job=?;", [job])
+    return len(rows) > 0 and pid_alive(rows[0][0])
+
+
+def pid_alive(pid: int):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def promote_claimant(tmp_dir, job: str):
+    """
+    Move the queued prefetch stages of the process computing `job` up to the
+    priority of a cache fill, now that a request is waiting on them.
+    """
+    rows = job_db(tmp_dir).query("SELECT pid FROM jclaimed WHERE job=?;", [job])
+    if rows:
+        with index_db(os.path.dirname(tmp_dir)).transaction() as con:
+            con.execute("UPDATE admission SET priority=? WHERE pid=? AND priority=?;",
+                        [PRIORITY_CACHE_FILL, rows[0][0], PRIORITY_PREFETCH])
+
+
+def wait_for_job(tmp_dir, job: str):
+    """
+    Block while another process holds the claim on `job`.
+    """
+    logging.info(f"waiting for {job}")
+    start = time.monotonic()
+    # prefetches don't promote each other
+    promote = ADMISSION_PRIORITY.get() != PRIORITY_PREFETCH
+    while is_claimed(tmp_dir, job):
+        if promote:
+            # the claimant may only queue its stage after we started waiting
+            promote_claimant(tmp_dir, job)
+        if time.monotonic() - start > CLAIM_WAIT_TIMEOUT:
+            raise TimeoutError(f"Timed out waiting for {job}")
+        check_cancelled(f"waiting for {job}")
+        time.sleep(CLAIM_POLL_INTERVAL)
+
+
+# In-memory copy of completed jobs, (tmp_dir, job) -> outputs. Only long lived
+# in daemon mode, where it saves a database round trip per stage.
+JOB_INDEX = {}
+
+
+def indexed_job(tmp_dir, job: str):
+    cached = JOB_INDEX.get((tmp_dir, job))
+    if cached is not None and not all(os.path.exists(f) for f in cached.values()):
+        # evicted since we saw it
+        JOB_INDEX.pop((tmp_dir, job), None)
+        return None
+    return cached
+
+
+def run_job(tmp_dir, job: str, is_complete, compute):
+    """
+    Single-flight execution of a cached job: the first process to claim the job
+    runs `compute` while any others block, then reuse its cached outputs.
+    """
+    cached = indexed_job(tmp_dir, job)
+    if cached is not None:
+        note_cache("hit")
+        return dict(cached)
+    while True:
+        cached = get_cache(tmp_dir, job)
+        if is_complete(cached):
+            logging.info(f"using cached: {cached}")
+            note_cache("hit")
+            record_hit(tmp_dir, job)
+            JOB_INDEX[(tmp_dir, job)] = dict(cached)
+            return cached
+        if claim_job(tmp_dir, job):
+            try:
+                # the previous claimant may have finished between the two checks
+                cached = get_cache(tmp_dir, job)
+                if is_complete(cached):
+                    note_cache("hit")
+                    return cached
+                note_cache("miss")
+                try:
+                    result = compute()
+                except BaseException:
+                    invalidate_job(tmp_dir, job)
+                    raise
+                update_cache(tmp_dir, job, result)
+                JOB_INDEX[(tmp_dir, job)] = dict(result)
+                return result
+            finally:
+                unclaim_job(tmp_dir, job)
+        note_cache("wait")
+        wait_for_job(tmp_dir, job)
+
+
+def invalidate_job(tmp_dir, job: str):
+    """
+    Forget any outputs recorded for a job whose computation failed or was
+    cancelled, so its partial artifacts are never used.
+    """
+    logging.info(f"invalidating {job}")
+    JOB_INDEX.pop((tmp_dir, job), None)
+    with job_db(tmp_dir).transaction() as con:
+        con.execute("DELETE FROM jobs WHERE job=?;", [job])
+
+
+def update_cache(tmp_dir, job: str, res):
+    now = time.time()
+    data = [(job, oname, ofile, os.path.getsize(ofile) if os.path.exists(ofile) else 0, now, now)
+            for (oname, ofile) in res.items()]
+    logging.info(f"Update cache {job} : {res}")
+    with job_db(tmp_dir).transaction() as con:
+        con.executemany("INSERT INTO jobs (job, resultname, resultfile, bytes, created, last_access) VALUES (?, ?, ?, ?, ?, ?) "
+                        "ON CONFLICT(job, resultname) DO UPDATE SET resultfile=excluded.resultfile, "
+                        "bytes=excluded.bytes, last_access=excluded.last_access;", data)
+
+def main(argv=None, out=None, cwd=None):
+    """
+    Run one request, writing the selected output to `out`. Returns the exit
+    status. In daemon mode `cwd` is the client's working directory.
+    """
+    if out is None:
+        out = sys.stdout
+    parser = argparse.ArgumentParser(
+                    prog='BasilTool',
+                    description='Runs Basil and Associated Tools',
+                    epilog='')
+    parser.add_argument('sourcefile', nargs='?')
+    parser.add_argument('-d', '--directory',  required=False, help="Used to identify the compilation")
+    parser.add_argument('-t', '--tool', help="Which tool to run, basil/bap/readelf", default="basil")
+    parser.add_argument('-o', '--output', help="Which output to send to stdout", default="default")
+    parser.add_argument('-a', '--args', help="Extra args to pass to the tool", default=[])
+    parser.add_argument('-s', '--spec', help="Specfile for basil")
+    parser.add_argument('-f', '--functions', help="Comma separated function names or addresses to restrict the output to")
+    parser.add_argument('-v', '--verbose', help="Enable log output", action="store_true")
+    parser.add_argument('--cache-dir', help="Directory for cached artifacts", default=CACHE_ROOT)
+    parser.add_argument('--max-cache-bytes', type=int, default=CACHE_MAX_BYTES, help="Evict cached binaries beyond this total size")
+    parser.add_argument('--max-cache-entries', type=int, default=CACHE_MAX_ENTRIES, help="Evict cached binaries beyond this count")
+    parser.add_argument('--max-cache-age', type=float, default=CACHE_MAX_AGE, help="Evict cached binaries unused for this many seconds")
+    parser.add_argument('--sweep', help="Evict old cache entries and exit", action="store_true")
+    parser.add_argument('--daemon', help="Serve requests from the client shim on a unix socket", action="store_true")
+    parser.add_argument('--socket', help="Socket path for --daemon", default=DAEMON_SOCKET)
+    parser.add_argument('--batch', metavar='MANIFEST', help="Run the records of a JSONL manifest, - for stdin, and exit")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help="Processes to run --batch stages on")
+    parser.add_argument('--check-readelf', nargs='+', metavar='PATH',
+                        help="Compare the in-process ELF reader with readelf on these binaries or directories and exit")
+    parser.add_argument('--check-normalisation', nargs='+', metavar='PATH',
+                        help="Check that binaries under these paths with equal normalised digests lift identically and exit")
+    parser.add_argument('--train-dictionary', nargs='+', metavar='PATH',
+                        help="Train the cache's ADT compression dictionary on the ADT files under these paths and exit")
+    parser.add_argument('--prefetch', nargs='?', const="bap", choices=sorted(PREFETCH_TOOLS),
+                        help="Lift the binary in the background at low priority and exit, through bap (the default) or basil")
+    parser.add_argument('--prefetch-worker', action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument('--remote-cache', help="Shared artifact store, S3(bucket,path,region) or OnDisk(path)", default=REMOTE_CACHE)
+
+    args = parser.parse_args(argv)
+    if args.verbose:
+        logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+    else:
+        logging.basicConfig(stream=sys.stderr, level=logging.ERROR)
+
+
+    logging.info(args)
+    REQUEST_MEMO.set({})
+
+    if cwd is not None:
+        for path in ["sourcefile", "directory", "cache_dir", "batch"]:
+            if getattr(args, path) and getattr(args, path) != "-":
+                setattr(args, path, os.path.join(cwd, getattr(args, path)))
+        for paths in ["check_readelf", "check_normalisation", "train_dictionary"]:
+            if getattr(args, paths):
+                setattr(args, paths, [os.path.join(cwd, p) for p in getattr(args, paths)])
+
+    limits = {"max_bytes": args.max_cache_bytes, "max_entries": args.max_cache_entries, "max_age": args.max_cache_age}
+    if args.daemon:
+        serve_daemon(args.socket)
+        return 0
+    if args.check_readelf:
+        return 1 if check_readelf(args.check_readelf, out) else 0
+    if args.check_normalisation:
+        return 1 if check_normalisation(args.check_normalisation, out) else 0
+    if args.train_dictionary:
+        private_dir(args.cache_dir)
+        train_dictionary(args.cache_dir, args.train_dictionary, out)
+        return 0
+    if args.batch:
+        private_dir(args.cache_dir)
+        failed = run_batch(args.batch, args, out)
+        maybe_cleanup_tempdirs(args.cache_dir, **limits)
+        return 1 if failed else 0
+    if args.sweep:
+        print("Evicted", cleanup_tempdirs(args.cache_dir, **limits), file=out)
+        return 0
+    if not args.sourcefile:
+        parser.error("sourcefile is required")
+    if args.prefetch and not args.prefetch_worker:
+        start_prefetch(argv, cwd)
+        return 0
+
+    private_dir(args.cache_dir)
+    metrics = RequestMetrics()
+    request = {"tool": args.tool, "output": args.output, "binary": None, "status": "error"}
+    if args.prefetch:
+        request.update({"tool": "prefetch", "output": args.prefetch})
+    try:
+        with metrics.stage("hash"):
+            bin_hash = hash_binary(args.sourcefile, args.cache_dir)
+        request["binary"] = bin_hash
+        with lock_entry(args.cache_dir, bin_hash):
+            touch_entry(args.cache_dir, bin_hash)
+            tmp_dir = get_tempdir(bin_hash, args.cache_dir)
+            if args.prefetch:
+                status = request["status"] = run_prefetch(args, tmp_dir, bin_hash, metrics)
+            else:
+                status = request["status"] = run_tool(args, tmp_dir, bin_hash, out, metrics)
+            touch_entry(args.cache_dir, bin_hash, dir_size(tmp_dir))
+    finally:
+        try:
+            record_metrics(args.cache_dir, metrics, request)
+        except (OSError, sqlite3.Error) as e:
+            logging.warning(f"could not record metrics: {e}")
+    maybe_cleanup_tempdirs(args.cache_dir, **limits)
+    return status
+
+
+def send_output(path: str, out):
+    """
+    Copy a file to the `out` stream without reading it into memory, using
+    sendfile when `out` is backed by a file descriptor. Compressed artifacts
+    are decompressed on the way.
+    """
+    out.flush()
+    if is_compressed(path):
+        with open_artifact(path) as f:
+            write_stream(f, out)
+        return
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        offset = 0
+        try:
+            out_fd = out.fileno()
+            while offset < size:
+                sent = os.sendfile(out_fd, f.fileno(), offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+            return
+        except (OSError, io.UnsupportedOperation) as e:
+            if offset != 0:
+                raise
+            logging.info(f"sendfile unavailable, copying: {e}")
+        write_stream(f, out)
+
+
+def write_stream(f, out):
+    target = out.buffer if hasattr(out, 'buffer') else out
+    for chunk in iter(lambda: f.read(1 << 20), b""):
+        target.write(chunk if target is not out else chunk.decode('utf-8', errors='replace'))
+
+
+def reflink(src: str, dest: str) -> bool:
+    """
+    Copy-on-write clone of src, on filesystems that support it.
+    """
+    try:
+        with open(src, 'rb') as s, open(dest, 'wb') as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        return True
+    except OSError:
+        try:
+            os.unlink(dest)
+        except FileNotFoundError:
+            pass
+        return False
+
+
+def copy_output(src: str, dest: str):
+    """
+    Give dest the contents of src as cheaply as possible: a hard link when both
+    are on the same filesystem, otherwise a reflink, otherwise a (sendfile) copy.
+    Artifacts are never rewritten in place (see publishing), so sharing the inode
+    is safe.
+    """
+    tmp = f"{dest}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.link(src, tmp)
+    except OSError:
+        if not reflink(src, tmp):
+            shutil.copyfile(src, tmp)
+    os.replace(tmp, dest)
+    if os.path.lexists(tmp):
+        # rename is a no-op when both names are already links to the same file
+        os.unlink(tmp)
+
+
+def export_output(src: str, dest: str):
+    """
+    copy_output, but decompressing compressed artifacts.
+    """
+    if not is_compressed(src):
+        copy_output(src, dest)
+        return
+    with publishing(dest) as (tmp,):
+        with open_artifact(src) as f, open(tmp, 'wb') as out:
+            shutil.copyfileobj(f, out, 1 << 20)
+
+
+# The selected output is also left in the compilation directory under this name.
+OUTPUT_COPY = "stdout"
+
+
+def import_directory(tmp_dir: str, directory: str) -> int:
+    """
+    Mirror the compilation directory into src/ of the job directory, linking
+    rather than copying where possible. Files unchanged since the last import
+    are skipped on their size and mtime, files whose contents are already there
+    on their digest. Returns the number of files written.
+    """
+    dest_root = os.path.join(tmp_dir, "src")
+    db = job_db(tmp_dir)
+    rows = []
+    written = skipped = 0
+    with open(os.path.join(tmp_dir, "import.lock"), 'a') as lock:
+        # imports of different directories for the same binary write the same tree
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        known = {path: rest for (path, *rest) in db.query("SELECT path, source, digest, bytes, mtime_ns FROM imports;")}
+        for root, dirs, files in os.walk(directory):
+            for name in files:
+                source = os.path.join(root, name)
+                if not os.path.isfile(source):
+                    # sockets, fifos, dangling links
+                    continue
+                path = os.path.relpath(source, directory)
+                if path == OUTPUT_COPY:
+                    # ours, from a previous request
+                    continue
+                dest = os.path.join(dest_root, path)
+                st = os.stat(source)
+                old = known.get(path)
+                if old is not None and os.path.exists(dest):
+                    if old[0] == source and old[2:] == [st.st_size, st.st_mtime_ns]:
+                        skipped += 1
+                        continue
+                    digest = file_digest(source)
+                    if digest == old[1]:
+                        rows.append((path, source, digest, st.st_size, st.st_mtime_ns))
+                        skipped += 1
+                        continue
+                else:
+                    digest = file_digest(source)
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                copy_output(source, dest)
+                rows.append((path, source, digest, st.st_size, st.st_mtime_ns))
+                written += 1
+                logging.info(f"{source} -> {dest}")
+        with db.transaction() as con:
+            con.executemany("INSERT OR REPLACE INTO imports VALUES (?, ?, ?, ?, ?);", rows)
+    logging.info(f"imported {written} files from {directory}, {skipped} unchanged")
+    return written
+
+
+def import_spec(tmp_dir: str, path: str) -> str:
+    """
+    Copy a spec file into the job directory under its digest, so requests with
+    different specs for the same binary never see each other's.
+    """
+    dest = os.path.join(tmp_dir, "specs", file_digest(path) + ".spec")
+    if not os.path.exists(dest):
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        # copied rather than linked, the name must stay true to the contents
+        with publishing(dest) as (tmp,):
+            shutil.copyfile(path, tmp)
+    return dest
+
+
+def run_tool(args, tmp_dir, bin_hash, out, metrics):
+
+    job_db(tmp_dir)
+
+    read_write_binary(tmp_dir, args.sourcefile, bin_hash)
+
+    if args.directory:
+        with metrics.stage("import"):
+            import_directory(tmp_dir, args.directory)
+    spec = None
+    if (args.spec):
+        spec = import_spec(tmp_dir, os.path.join(args.directory, args.spec))
+
+
+# TODO: give basil spec files
+# TODO: run boogie
+# TODO: primus lifter and asli lifter
+
+    outputs = {}
+
+    if (args.args):
+        args.args = args.args.split()
+
+    if args.tool not in STAGES:
+        print("Allowed tools: [readelf, bap, basil, boogie, boogie-source, 'boogie-counterexample]", file=out)
+        return 1
+
+    ctx = StageContext(tmp_dir, args.cache_dir, bin_hash, args.args, spec, metrics,
+                       remote_from_config(args.remote_cache), ())
+    if args.functions:
+        selection = [f.strip() for f in args.functions.split(",") if f.strip()]
+        symbols = None
+        if any(f.lower().startswith("0x") for f in selection):
+            symbols = run_pipeline("readelf", "symbols", ctx)["symbols"]
+        try:
+            ctx = ctx._replace(functions=resolve_functions(selection, symbols))
+        except ValueError as e:
+            print(e, file=out)
+            return 1
+    outputs = run_pipeline(args.tool, args.output, ctx)
+
+    if args.output not in outputs:
+        print("Output unavailable, allowed are:", ", ".join(outputs.keys()), file=out)
+        return 1
+
+    output = outputs[args.output]
+    if ctx.functions:
+        with metrics.stage("slice"):
+            try:
+                output = slice_output(tmp_dir, output, ctx.functions)
+            except ValueError as e:
+                print(e, file=out)
+                return 1
+    logging.info("Printinng output: %s", output)
+    with metrics.stage("send"):
+        send_output(output, out)
+    # print() used to add this
+    out.write("\n")
+
+    if args.directory:
+        export_output(output, os.path.join(args.directory, OUTPUT_COPY))
+
+    return 0
+
+
+"""
+Prefetching: `basil-tool.py --prefetch -d DIR BINARY`, run when compilation
+finishes, starts lifting the binary in a detached worker process and returns
+at once. The worker runs readelf and BAP, or with `--prefetch basil` the
+basil stage too, filling the cache as a normal request would. Its stages
+queue for admission behind everything else. A request that then needs one
+of its jobs waits on the worker's claim rather than lifting again, and
+promotes the worker's queued stages to its own priority while it does.
+"""
+
+# --prefetch choice -> the tools whose stages are run
+PREFETCH_TOOLS = {"bap": ["readelf", "bap"], "basil": ["basil"]}
+
+
+def start_prefetch(argv, cwd=None):
+    """
+    Start the prefetch worker for this request, detached from us.
+    """
+    command = [sys.executable, os.path.abspath(__file__)] + list(sys.argv[1:] if argv is None else argv)
+    subprocess.Popen(command + ["--prefetch-worker"], cwd=cwd, start_new_session=True, stdin=subprocess.DEVNULL,
+                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def run_prefetch(args, tmp_dir, bin_hash, metrics) -> int:
+    job_db(tmp_dir)
+    read_write_binary(tmp_dir, args.sourcefile, bin_hash)
+    spec = None
+    if args.spec and args.prefetch == "basil":
+        spec = import_spec(tmp_dir, os.path.join(args.directory, args.spec))
+    tool_args = args.args.split() if args.args else []
+    ctx = StageContext(tmp_dir, args.cache_dir, bin_hash, tool_args, spec, metrics,
+                       remote_from_config(args.remote_cache), ())
+    ADMISSION_PRIORITY.set(PRIORITY_PREFETCH)
+    for tool in PREFETCH_TOOLS[args.prefetch]:
+        run_pipeline(tool, "default", ctx)
+    return 0
+
+
+"""
+Batch mode: `basil-tool.py --batch MANIFEST` runs every record of a JSONL
+manifest, each {"binary", "tool", "output", "args", "spec"} with an optional
+"dest" to copy the output to. The stages all records need are deduplicated
+by job key, so records on the same binary share its lift, and run on a pool
+of processes as soon as their dependencies are done. One JSON line is
+written per record as it completes, with the path of its output artifact.
+"""
+
+# nodes are the (job directory, job key) of each stage the record needs
+BatchRecord = collections.namedtuple("BatchRecord", ["number", "fields", "ctx", "nodes"])
+
+
+def run_batch_stage(name: str, fields: dict, inputs: dict):
+    """
+    Pool worker: run one stage of a batch, returning its outputs merged over
+    `inputs` and the stage's metrics.
+    """
+    REQUEST_MEMO.set({})
+    metrics = RequestMetrics()
+    ctx = StageContext(metrics=metrics, remote=remote_from_config(fields["remote"]),
+                       **{k: v for k, v in fields.items() if k != "remote"})
+    done = concurrent.futures.Future()
+    done.set_result(inputs)
+    return run_stage(STAGES[name], ctx, [done]), [stage.as_dict() for stage in metrics.stages]
+
+
+def init_batch_worker(level: int):
+    logging.basicConfig(stream=sys.stderr, level=level)
+    install_signal_handlers()
+
+
+def batch_record(number: int, fields: dict, base_dir: str, args, entries: dict) -> BatchRecord:
+    """
+    Prepare the job directory for a manifest record. Raises ValueError for
+    records that can't run.
+    """
+    if "binary" not in fields:
+        raise ValueError("a record needs a binary")
+    tool = fields.setdefault("tool", "basil")
+    output = fields.setdefault("output", "default")
+    if tool not in STAGES:
+        raise ValueError(f"Unknown tool {tool}")
+    binary = os.path.join(base_dir, fields["binary"])
+    bin_hash = hash_binary(binary, args.cache_dir)
+    if bin_hash not in entries:
+        # held until the batch is done, so the entry can't be evicted under us
+        entries[bin_hash] = lock_entry(args.cache_dir, bin_hash)
+        touch_entry(args.cache_dir, bin_hash)
+    tmp_dir = get_tempdir(bin_hash, args.cache_dir)
+    job_db(tmp_dir)
+    read_write_binary(tmp_dir, binary, bin_hash)
+    spec = import_spec(tmp_dir, os.path.join(base_dir, fields["spec"])) if fields.get("spec") else None
+    tool_args = fields.get("args") or []
+    if isinstance(tool_args, str):
+        tool_args = tool_args.split()
+    ctx = StageContext(tmp_dir, args.cache_dir, bin_hash, tool_args, spec, None, None, ())
+    return BatchRecord(number, fields, ctx, {name: (tmp_dir, job_key(name, ctx)) for name in plan_stages(tool, output)})
+
+
+def run_batch(manifest: str, args, out) -> int:
+    """
+    Run the records of a manifest on `args.jobs` processes. Returns the
+    number of records that failed.
+    """
+    base_dir = os.path.dirname(os.path.abspath(manifest)) if manifest != "-" else os.getcwd()
+    start = time.monotonic()
+    entries = {}
+    records = []
+    failed = 0
+
+    def report(record_number: int, fields: dict, result: dict):
+        nonlocal failed
+        failed += result["status"] != 0
+        out.write(json.dumps({"record": record_number, **{k: fields.get(k) for k in ("binary", "tool", "output")},
+                              **result}) + "\n")
+        out.flush()
+
+    with (sys.stdin if manifest == "-" else open(manifest, 'r')) as f:
+        for number, line in enumerate(f):
+            if not line.strip():
+                continue
+            fields = {}
+            try:
+                fields = json.loads(line)
+                if not isinstance(fields, dict):
+                    fields = {}
+                    raise ValueError("a record must be an object")
+                records.append(batch_record(number, fields, base_dir, args, entries))
+            except (ValueError, OSError) as e:
+                report(number, fields, {"status": 1, "error": str(e)})
+
+    # stage instances by (job directory, job key), shared by every record needing them
+    nodes = {}
+    for record in records:
+        # in dependency order, so a node's dependencies come before it
+        for name, node in record.nodes.items():
+            if node not in nodes:
+                nodes[node] = {"name": name, "record": record, "deps": [record.nodes[dep] for dep in STAGES[name].deps]}
+    results = {}
+    errors = {}
+    waiting = {record.number: record for record in records}
+
+    def finish_records():
+        for record in list(waiting.values()):
+            keys = list(record.nodes.values())
+            error = next((errors[k] for k in keys if k in errors), None)
+            if error is None and not all(k in results for k in keys):
+                continue
+            del waiting[record.number]
+            fields = record.fields
+            metrics = RequestMetrics()
+            # records are timed from the start of the batch
+            metrics.start = start
+            result = {"status": 1, "binary_hash": record.ctx.bin_hash}
+            if error is not None:
+                result["error"] = error
+            else:
+                outputs = {}
+                for k in keys:
+                    outputs.update(results[k][0])
+                    if nodes[k]["record"] is record:
+                        metrics.stages += [StageMetrics.from_dict(s) for s in results[k][1]]
+                if fields["output"] not in outputs:
+                    result["error"] = "Output unavailable, allowed are: " + ", ".join(outputs.keys())
+                else:
+                    path = outputs[fields["output"]]
+                    result.update({"status": 0, "path": path})
+                    if fields.get("dest"):
+                        export_output(path, os.path.join(base_dir, fields["dest"]))
+            try:
+                record_metrics(args.cache_dir, metrics, {"tool": fields["tool"], "output": fields["output"],
+                                                         "binary": record.ctx.bin_hash, "status": result["status"],
+                                                         "batch": True})
+            except (OSError, sqlite3.Error) as e:
+                logging.warning(f"could not record metrics: {e}")
+            report(record.number, fields, result)
+
+    try:
+        # not forked, a child must not share our open sqlite connections, nor in
+        # daemon mode the state of our other threads
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs, mp_context=multiprocessing.get_context("forkserver"),
+                                                    initializer=init_batch_worker,
+                                                    initargs=[logging.getLogger().level]) as pool:
+            running = {}
+            submitted = set()
+
+            def submit_ready():
+                for node, info in nodes.items():
+                    if node in submitted:
+                        continue
+                    failed_dep = next((dep for dep in info["deps"] if dep in errors), None)
+                    if failed_dep is not None:
+                        # dependents of a failed stage fail with it
+                        submitted.add(node)
+                        errors[node] = errors[failed_dep]
+                        continue
+                    if any(dep not in results for dep in info["deps"]):
+                        continue
+                    inputs = {}
+                    for dep in info["deps"]:
+                        inputs.update(results[dep][0])
+                    fields = info["record"].ctx._asdict()
+                    del fields["metrics"]
+                    # the config, the worker opens the stores itself
+                    fields["remote"] = args.remote_cache
+                    running[pool.submit(run_batch_stage, info["name"], fields, inputs)] = node
+                    submitted.add(node)
+
+            submit_ready()
+            finish_records()
+            while running:
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    node = running.pop(future)
+                    try:
+                        results[node] = future.result()
+                    except Exception as e:
+                        logging.error(f"{nodes[node]['name']} failed: {e}")
+                        errors[node] = f"{nodes[node]['name']} failed: {e}"
+                submit_ready()
+                finish_records()
+    finally:
+        for bin_hash, lock in entries.items():
+            touch_entry(args.cache_dir, bin_hash, dir_size(get_tempdir(bin_hash, args.cache_dir)))
+            lock.close()
+    return failed
+
+
+"""
+Daemon mode: `basil-tool.py --daemon` keeps tool paths, the job index and
+module state warm and serves requests on a unix socket. The client shim
+sends its argv and cwd along with its stdout/stderr file descriptors
+(SCM_RIGHTS), so the daemon writes the output directly and only the exit
+status comes back over the socket. The shim is basil_client.py, which tools
+should run so that requests the daemon serves don't load this file.
+"""
+
+class DaemonHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        msg, fds, _, _ = socket.recv_fds(self.request, 1 << 16, 2)
+        while not msg.endswith(b"\n"):
+            chunk = self.request.recv(1 << 16)
+            if not chunk:
+                break
+            msg += chunk
+        request = json.loads(msg)
+        children = ChildProcesses()
+        CHILDREN.set(children)
+        # the client sends nothing more, so the connection only becomes
+        # readable when the client has gone, e.g. killed at its timeout
+        threading.Thread(target=self.watch_client, args=[children], daemon=True).start()
+        with open(fds[0], 'w') as out, open(fds[1], 'w') as err:
+            try:
+                status = main(request["argv"], out=out, cwd=request["cwd"])
+            except SystemExit as e:
+                status = e.code if isinstance(e.code, int) else 1
+            except Exception:
+                traceback.print_exc(file=err)
+                status = 1
+        self.request.sendall(json.dumps({"status": status}).encode('utf8') + b"\n")
+
+    def watch_client(self, children: ChildProcesses):
+        try:
+            self.request.recv(1)
+        except OSError:
+            pass
+        children.cancel("client went away")
+
+
+def serve_daemon(socket_path: str):
+    global BASIL_POOL
+    if os.path.exists(socket_path):
+        if run_client(None, socket_path) is not None:
+            logging.error(f"A daemon is already listening on {socket_path}")
+            return
+        os.unlink(socket_path)
+    private_dir(os.path.dirname(socket_path))
+    with socketserver.ThreadingUnixStreamServer(socket_path, DaemonHandler) as server:
+        server.daemon_threads = True
+        logging.info(f"basil-tool daemon listening on {socket_path}")
+        install_signal_handlers(status=0)
+        if BASIL_WORKER_CMD:
+            BASIL_POOL = BasilWorkerPool(BASIL_WORKER_CMD.split(" "))
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(socket_path)
+            if BASIL_POOL is not None:
+                BASIL_POOL.close()
 
 
 if __name__ == "__main__":
-    with tempfile.TemporaryDirectory() as tmp_dir:
-        main(tmp_dir)
+    status = None
+    if "--daemon" not in sys.argv[1:] and os.path.exists(DAEMON_SOCKET):
+        status = run_client(sys.argv[1:])
+    if status is None:
+        install_signal_handlers()
+        status = main()
+    exit(status)
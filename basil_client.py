@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+"""
+Client shim for basil-tool.py. With a daemon listening (`basil-tool.py
+--daemon`) a request is forwarded to it without loading basil-tool.py, which
+takes longer to compile than most cached requests take to serve. Without
+one, basil-tool.py runs the request in this process.
+
+Only the standard library modules needed to reach the daemon are imported
+here, keep it that way.
+"""
+import json
+import os
+import runpy
+import socket
+import sys
+import tempfile
+
+# Artifacts are kept here between invocations, one directory per input binary.
+CACHE_ROOT = os.environ.get("BASIL_TOOL_CACHE", os.path.join(tempfile.gettempdir(), "basil-tool"))
+
+# Unix socket of a running `basil-tool.py --daemon`.
+DAEMON_SOCKET = os.environ.get("BASIL_TOOL_SOCKET", os.path.join(CACHE_ROOT, "daemon.sock"))
+
+BASIL_TOOL = os.path.join(os.path.dirname(os.path.abspath(__file__)), "basil-tool.py")
+
+
+def check_owner(path: str):
+    """
+    Refuse a directory or socket someone else owns, as whoever created it
+    could have planted cache entries or a daemon there.
+    """
+    st = os.lstat(path)
+    if st.st_uid != os.getuid():
+        raise PermissionError(f"{path} is owned by uid {st.st_uid}, not us")
+
+
+def run_client(argv, socket_path: str = DAEMON_SOCKET):
+    """
+    Forward a request to the daemon. Returns its exit status, or None if no
+    daemon is listening. With argv None this only checks for a daemon.
+    """
+    try:
+        # our stdout and stderr are handed to whoever listens there
+        check_owner(os.path.dirname(os.path.abspath(socket_path)))
+        check_owner(socket_path)
+    except PermissionError as e:
+        print(f"basil-tool: not using the daemon: {e}", file=sys.stderr)
+        return None
+    except FileNotFoundError:
+        return None
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(socket_path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        return None
+    with sock:
+        if argv is None:
+            return 0
+        sys.stdout.flush()
+        request = json.dumps({"argv": argv, "cwd": os.getcwd()}).encode('utf8') + b"\n"
+        socket.send_fds(sock, [request], [sys.stdout.fileno(), sys.stderr.fileno()])
+        reply = sock.makefile('rb').readline()
+    if not reply:
+        print("basil-tool daemon closed the connection", file=sys.stderr)
+        return 1
+    return json.loads(reply)["status"]
+
+
+if __name__ == "__main__":
+    status = run_client(sys.argv[1:]) if "--daemon" not in sys.argv[1:] else None
+    if status is None:
+        sys.argv[0] = BASIL_TOOL
+        runpy.run_path(BASIL_TOOL, run_name="__main__")
+    sys.exit(status)
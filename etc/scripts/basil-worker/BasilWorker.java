@@ -0,0 +1,51 @@
+import java.io.BufferedReader;
+import java.io.FileOutputStream;
+import java.io.InputStreamReader;
+import java.io.PrintStream;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.nio.charset.StandardCharsets;
+import java.util.Arrays;
+
+/**
+ * Resident basil JVM for the worker pool in basil-tool.py.
+ *
+ * Reads one job per line on stdin: tab separated stdout file, stderr file and
+ * basil arguments. Runs basil's main class in this JVM with its output sent to
+ * those files, then writes the exit status as a line on stdout.
+ *
+ * Run with basil on the classpath, e.g.
+ *   java -cp basil.jar etc/scripts/basil-worker/BasilWorker.java
+ * The main class can be changed with -Dbasil.main=...
+ */
+public class BasilWorker {
+    public static void main(String[] args) throws Exception {
+        Method entry = Class.forName(System.getProperty("basil.main", "Main")).getMethod("main", String[].class);
+        PrintStream protocol = System.out;
+        PrintStream log = System.err;
+        BufferedReader jobs = new BufferedReader(new InputStreamReader(System.in, StandardCharsets.UTF_8));
+
+        String line;
+        while ((line = jobs.readLine()) != null) {
+            String[] fields = line.split("\t", -1);
+            String[] jobArgs = Arrays.copyOfRange(fields, 2, fields.length);
+            int status = 0;
+            try (PrintStream out = new PrintStream(new FileOutputStream(fields[0]), true);
+                 PrintStream err = new PrintStream(new FileOutputStream(fields[1]), true)) {
+                System.setOut(out);
+                System.setErr(err);
+                try {
+                    entry.invoke(null, (Object) jobArgs);
+                } catch (InvocationTargetException e) {
+                    e.getCause().printStackTrace(err);
+                    status = 1;
+                } finally {
+                    System.setOut(protocol);
+                    System.setErr(log);
+                }
+            }
+            protocol.println(status);
+            protocol.flush();
+        }
+    }
+}
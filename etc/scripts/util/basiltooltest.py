@@ -0,0 +1,638 @@
+import importlib.util
+import io
+import json
+import os
+import shutil
+import signal
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+CASES = os.path.join(BASE_PATH, 'test', 'basil-tool')
+
+ROOT = os.path.normpath(os.path.join(BASE_PATH, '..', '..', '..'))
+# for basil_client, which basil-tool.py imports from beside it
+sys.path.insert(0, ROOT)
+spec = importlib.util.spec_from_file_location("basil_tool", os.path.join(ROOT, 'basil-tool.py'))
+basil_tool = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(basil_tool)
+
+READELF = shutil.which("readelf")
+GCC = shutil.which("gcc")
+
+C_SOURCE = r"""
+#include <stdio.h>
+int counter = 3;
+static int helper(int x) { return x * counter; }
+int main(int argc, char **argv) {
+    printf("%d\n", helper(argc));
+    return 0;
+}
+"""
+
+
+def aarch64_object() -> bytes:
+    """
+    A relocatable AArch64 object calling puts, built by hand as there is no
+    cross compiler to hand.
+    """
+    text = bytes.fromhex("00000094" "00000090" "00000091" "c0035fd6")
+    data = struct.pack("<QQ", 3, 0)
+    shstrtab = b"\0.text\0.rela.text\0.data\0.symtab\0.strtab\0.shstrtab\0"
+    strtab = b"\0t.c\0counter\0main\0puts\0"
+
+    def name(table, s):
+        return table.index(s.encode() + b"\0")
+
+    def sym(nm, info, other, shndx, value, size):
+        return struct.pack("<IBBHQQ", nm, info, other, shndx, value, size)
+
+    symtab = b"".join([
+        sym(0, 0, 0, 0, 0, 0),
+        sym(name(strtab, "t.c"), 0x04, 0, 0xfff1, 0, 0),       # LOCAL FILE ABS
+        sym(0, 0x03, 0, 1, 0, 0),                             # LOCAL SECTION .text
+        sym(0, 0x03, 0, 3, 0, 0),                             # LOCAL SECTION .data
+        sym(name(strtab, "counter"), 0x01, 0, 3, 0, 8),       # LOCAL OBJECT
+        sym(name(strtab, "main"), 0x12, 0, 1, 0, len(text)),  # GLOBAL FUNC
+        sym(name(strtab, "puts"), 0x10, 0, 0, 0, 0),          # GLOBAL NOTYPE UND
+    ])
+    rela = b"".join(struct.pack("<QQq", offset, (symbol << 32) | kind, addend) for offset, symbol, kind, addend in [
+        (0, 6, 283, 0),   # CALL26 puts
+        (4, 3, 275, 8),   # ADR_PREL_PG_HI21 .data + 8
+        (8, 3, 277, 8),   # ADD_ABS_LO12_NC .data + 8
+        (12, 4, 257, -4), # ABS64 counter - 4
+    ])
+    body = b""
+    offsets = []
+    for content in [text, rela, data, symtab, strtab, shstrtab]:
+        body += b"\0" * (-len(body) % 8)
+        offsets.append(64 + len(body))
+        body += content
+    body += b"\0" * (-len(body) % 8)
+    shoff = 64 + len(body)
+    sections = [struct.pack("<IIQQQQIIQQ", 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)]
+    for (nm, kind, flags, link, info, align, entsize), content, offset in zip([
+            (".text", 1, 0x6, 0, 0, 4, 0),
+            (".rela.text", 4, 0x40, 4, 1, 8, 24),
+            (".data", 1, 0x3, 0, 0, 8, 0),
+            (".symtab", 2, 0, 5, 5, 8, 24),
+            (".strtab", 3, 0, 0, 0, 1, 0),
+            (".shstrtab", 3, 0, 0, 0, 1, 0)], [text, rela, data, symtab, strtab, shstrtab], offsets):
+        sections.append(struct.pack("<IIQQQQIIQQ", name(shstrtab, nm), kind, flags, 0, offset, len(content),
+                                    link, info, align, entsize))
+    header = b"\x7fELF\x02\x01\x01" + b"\0" * 9 + struct.pack(
+        "<HHIQQQIHHHHHH", 1, 183, 1, 0, 0, shoff, 0, 64, 0, 0, 64, len(sections), 6)
+    return header + body + b"".join(sections)
+
+
+@unittest.skipUnless(READELF, "readelf is needed to compare against")
+class ReadelfParityTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def compile(self, name, *flags):
+        source = os.path.join(self.dir, "t.c")
+        with open(source, 'w') as f:
+            f.write(C_SOURCE)
+        path = os.path.join(self.dir, name)
+        result = subprocess.run([GCC, source, "-o", path] + list(flags), capture_output=True)
+        if result.returncode != 0:
+            self.skipTest(f"gcc {' '.join(flags)} failed: {result.stderr.decode()}")
+        return path
+
+    def assert_parity(self, path):
+        with basil_tool.ElfFile(path) as elf:
+            ours = io.BytesIO()
+            elf.write_readelf(ours)
+        theirs = subprocess.run([READELF, "-s", "-r", "-W", path], stdout=subprocess.PIPE).stdout
+        self.assertEqual(ours.getvalue().decode(errors='replace'), theirs.decode(errors='replace'))
+
+    def test_aarch64_object(self):
+        path = os.path.join(self.dir, "t.o")
+        with open(path, 'wb') as f:
+            f.write(aarch64_object())
+        self.assert_parity(path)
+
+    @unittest.skipUnless(GCC, "needs gcc")
+    def test_pie(self):
+        self.assert_parity(self.compile("pie", "-O1", "-fPIE", "-pie"))
+
+    @unittest.skipUnless(GCC, "needs gcc")
+    def test_debug_info(self):
+        self.assert_parity(self.compile("debug", "-g", "-O0"))
+
+    @unittest.skipUnless(GCC, "needs gcc")
+    def test_object(self):
+        self.assert_parity(self.compile("t.o", "-c", "-g", "-O2"))
+
+    @unittest.skipUnless(GCC, "needs gcc")
+    def test_shared_library(self):
+        self.assert_parity(self.compile("t.so", "-shared", "-fPIC", "-Wl,-z,pack-relative-relocs"))
+
+    @unittest.skipUnless(GCC, "needs gcc")
+    def test_static(self):
+        self.assert_parity(self.compile("static", "-static", "-O2"))
+
+    @unittest.skipUnless(GCC, "needs gcc")
+    def test_corrupt_symbol_table(self):
+        path = self.compile("a.out", "-O1")
+        with basil_tool.ElfFile(path) as elf:
+            symtab = elf.sections_of_type(basil_tool.SHT_SYMTAB)[0]
+            shoff, shentsize = elf.unpack("Q", 40)[0], elf.unpack("H", 58)[0]
+        # point .symtab's sh_offset past the end of the file
+        with open(path, 'r+b') as f:
+            f.seek(shoff + symtab.index * shentsize + 24)
+            f.write(struct.pack("<Q", os.path.getsize(path) + 4096))
+        with basil_tool.ElfFile(path) as elf:
+            with self.assertRaises(basil_tool.ElfError):
+                elf.write_readelf(io.BytesIO())
+        # the stage falls back to readelf, which copes
+        outputs = basil_tool.run_readelf(self.dir)
+        with open(outputs["relf"], 'rb') as f:
+            theirs = subprocess.run([READELF, "-s", "-r", "-W", path], stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL).stdout
+            self.assertEqual(f.read(), theirs)
+
+    @unittest.skipUnless(GCC, "needs gcc")
+    def test_check_readelf(self):
+        self.compile("pie", "-O1")
+        out = io.StringIO()
+        self.assertEqual(basil_tool.check_readelf([self.dir], out), 0)
+        self.assertIn(" 0 different", out.getvalue())
+
+
+def read_case(name: str) -> str:
+    with open(os.path.join(CASES, name), 'r') as f:
+        return f.read()
+
+
+class BoogieOutputTests(unittest.TestCase):
+    def setUp(self):
+        self.text = read_case("prog.bpl")
+        self.decls = basil_tool.boogie_declarations(self.text)
+        self.locations = basil_tool.BoogieLocations("prog.bpl", self.text, self.decls)
+
+    def test_parse(self):
+        lines, counts = basil_tool.parse_boogie_output(read_case("prog-errors.out"))
+        self.assertEqual(counts, {"verified": 1, "error": 2})
+        self.assertEqual(len(lines), 7)
+        self.assertEqual(lines[-1], "    prog.bpl(14,3): anon0")
+
+    def test_parse_time_out(self):
+        lines, counts = basil_tool.parse_boogie_output(read_case("prog-timeout.out"))
+        self.assertEqual(counts, {"verified": 2, "error": 0, "time out": 1})
+
+    def test_parse_resolution_errors(self):
+        self.assertIsNone(basil_tool.parse_boogie_output(read_case("prog-resolution.out")))
+
+    def test_split(self):
+        lines, counts = basil_tool.parse_boogie_output(read_case("prog-errors.out"))
+        split = basil_tool.split_shard_output(lines, counts, ["helper", "main", "ok"], self.locations)
+        self.assertEqual(split["ok"], ([], {"verified": 1, "error": 0}))
+        self.assertEqual(split["main"][1], {"verified": 0, "error": 1})
+        # the related location and trace stay with the error they belong to
+        self.assertEqual([template for template, locs in split["helper"][0]], [
+            "\0: Error: a postcondition could not be proved on this return path",
+            "\0: Related location: this is the postcondition that could not be proved",
+            "Execution trace:",
+            "    \0: anon0",
+        ])
+        self.assertEqual(split["main"][0][0][1], [("procedure main", 5, "3")])
+
+    def test_merge(self):
+        lines, counts = basil_tool.parse_boogie_output(read_case("prog-errors.out"))
+        split = basil_tool.split_shard_output(lines, counts, ["helper", "main", "ok"], self.locations)
+        merged = []
+        for name in ["helper", "main", "ok"]:
+            merged += [self.locations.absolute(t, locs) for t, locs in split[name][0]]
+        output = basil_tool.format_boogie_output(merged, [split[name][1] for name in ["helper", "main", "ok"]])
+        self.assertEqual(output, read_case("prog-errors.out"))
+
+    def test_merge_counts(self):
+        output = basil_tool.format_boogie_output([], [{"verified": 1, "error": 0}, {"verified": 0, "error": 1},
+                                                     {"verified": 2, "error": 0, "time out": 2}])
+        self.assertEqual(output, "\nBoogie program verifier finished with 3 verified, 1 error, 2 time outs\n")
+
+    def test_procedure_moved(self):
+        lines, counts = basil_tool.parse_boogie_output(read_case("prog-errors.out"))
+        split = basil_tool.split_shard_output(lines, counts, ["helper", "main", "ok"], self.locations)
+        moved = self.text.replace("procedure main()", "procedure extra()\n{\n}\n\nprocedure main()")
+        locations = basil_tool.BoogieLocations("prog.bpl", moved, basil_tool.boogie_declarations(moved))
+        self.assertEqual([locations.absolute(t, locs) for t, locs in split["main"][0]], [
+            "prog.bpl(20,3): Error: this assertion could not be proved",
+            "Execution trace:",
+            "    prog.bpl(18,3): anon0",
+        ])
+        # helper is before the change, so it stays where it was
+        self.assertEqual(locations.absolute(*split["helper"][0][0]), "prog.bpl(8,3): Error: a postcondition could not be "
+                                                                      "proved on this return path")
+
+    def test_procedure_removed(self):
+        lines, counts = basil_tool.parse_boogie_output(read_case("prog-errors.out"))
+        split = basil_tool.split_shard_output(lines, counts, ["helper", "main", "ok"], self.locations)
+        renamed = self.text.replace("procedure main()", "procedure main2()")
+        locations = basil_tool.BoogieLocations("prog.bpl", renamed, basil_tool.boogie_declarations(renamed))
+        self.assertIsNone(locations.absolute(*split["main"][0][0]))
+
+    def test_split_time_out(self):
+        lines, counts = basil_tool.parse_boogie_output(read_case("prog-timeout.out"))
+        self.assertIsNone(basil_tool.split_shard_output(lines, counts, ["helper", "main", "ok"], self.locations))
+
+    def test_split_message_outside_shard(self):
+        lines, counts = basil_tool.parse_boogie_output(read_case("prog-errors.out"))
+        self.assertIsNone(basil_tool.split_shard_output(lines, counts, ["helper", "ok"], self.locations))
+
+    def test_split_counts_disagree(self):
+        lines, counts = basil_tool.parse_boogie_output(read_case("prog-errors.out"))
+        counts["error"] = 3
+        self.assertIsNone(basil_tool.split_shard_output(lines, counts, ["helper", "main", "ok"], self.locations))
+
+
+class CounterexampleModelTests(unittest.TestCase):
+    def render(self, variables=None):
+        out = io.StringIO()
+        with open(os.path.join(CASES, "prog.model"), 'r') as f:
+            for number, model in enumerate(basil_tool.read_models(f), 1):
+                basil_tool.render_model(number, model, out, variables)
+        return out.getvalue()
+
+    def test_tokens(self):
+        self.assertEqual(basil_tool.model_tokens("  |T@[bv64]bv8!val!0| 16bv64 -> 255bv8"),
+                         ["|T@[bv64]bv8!val!0|", "16bv64", "->", "255bv8"])
+        self.assertEqual(basil_tool.model_tokens("|a b| (- 1) -> (f (g 1) 2)"),
+                         ["|a b|", "(- 1)", "->", "(f (g 1) 2)"])
+
+    def test_read(self):
+        with open(os.path.join(CASES, "prog.model"), 'r') as f:
+            models = list(basil_tool.read_models(f))
+        self.assertEqual(len(models), 3)
+        first = models[0]
+        self.assertEqual(first.constants["|#x@@2|"], "17bv8")
+        self.assertEqual(first.functions["k!0"], {"apps": [(["4096bv64"], "42bv8")], "else": "0bv8"})
+        self.assertEqual(first.functions["MapType0Select"]["apps"][1], (["|T@[bv64]bv8!val!0|", "17bv64"], "1bv8"))
+        self.assertEqual([name for name, assignments in first.states], ["<initial>", "prog.bpl(14,3)"])
+        # cut off in its first state
+        self.assertEqual(models[2].states, [("<initial>", [("R0", "2bv64")])])
+
+    def test_render(self):
+        self.assertEqual(self.render(), read_case("prog.model.txt"))
+
+    def test_render_failing(self):
+        variables = basil_tool.failing_variables(os.path.join(CASES, "prog.bpl"), os.path.join(CASES, "prog-errors.out"))
+        self.assertIn("R0", variables)
+        # only used by ok, which verified
+        self.assertNotIn("true", variables)
+        self.assertEqual(self.render(variables), read_case("prog.model.failing.txt"))
+
+    def test_render_quoted(self):
+        rendered = self.render({"#x"})
+        self.assertIn("    |#x| = 0x11:bv8\n", rendered)
+        self.assertNotIn("R0", rendered)
+
+
+class SliceTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def slice(self, slicer, case, functions):
+        dest = os.path.join(self.dir, case)
+        slicer(os.path.join(CASES, case), dest, functions)
+        with open(dest, 'r') as f:
+            return f.read()
+
+    def test_bir(self):
+        sliced = self.slice(basil_tool.slice_bir, "prog.bir", ("main",))
+        self.assertTrue(sliced.startswith("00000a4d: program\n"))
+        self.assertIn(": sub main(", sliced)
+        self.assertIn(": sub helper(", sliced)
+        self.assertNotIn("unused", sliced)
+        # the subs are kept whole
+        self.assertIn("00000330: call R30 with noreturn\n", sliced)
+
+    def test_bir_callee(self):
+        sliced = self.slice(basil_tool.slice_bir, "prog.bir", ("helper",))
+        self.assertIn(": sub helper(", sliced)
+        self.assertNotIn(": sub main(", sliced)
+
+    def test_boogie(self):
+        sliced = self.slice(basil_tool.slice_boogie, "prog-basil.bpl", ("main",))
+        self.assertIn("procedure main_1812()", sliced)
+        self.assertIn("procedure helper_1796()", sliced)
+        self.assertNotIn("unused", sliced)
+        # globals, axioms and bodiless procedures stay
+        self.assertIn("var {:extern} mem: [bv64]bv8;", sliced)
+        self.assertIn("axiom ($counter_addr == 69632bv64);", sliced)
+        self.assertIn("procedure {:extern} rely();", sliced)
+
+    def test_boogie_exact_name(self):
+        sliced = self.slice(basil_tool.slice_boogie, "prog-basil.bpl", ("helper_1796",))
+        self.assertIn("procedure helper_1796()", sliced)
+        self.assertNotIn("procedure main_1812()", sliced)
+
+    def test_no_match(self):
+        with self.assertRaises(ValueError):
+            self.slice(basil_tool.slice_boogie, "prog-basil.bpl", ("mai",))
+        with self.assertRaises(ValueError):
+            self.slice(basil_tool.slice_bir, "prog.bir", ("missing",))
+
+
+TOOL = os.path.join(ROOT, 'basil-tool.py')
+
+# writes the adt and bir files named by bap's -d adt:<file> -d bir:<file>,
+# noting the run in $BAP_RUNS and taking $BAP_SLEEP seconds if set
+FAKE_BAP = """#!/bin/sh
+[ -n "$BAP_RUNS" ] && echo run >> "$BAP_RUNS"
+[ -n "$BAP_SLEEP" ] && sleep "$BAP_SLEEP"
+for arg; do
+    case "$arg" in
+        adt:*) echo "Program(\"$1\")" > "${arg#adt:}" ;;
+        bir:*) echo "00000001: program" > "${arg#bir:}" ;;
+    esac
+done
+"""
+
+# writes the files named by -o and --dump-il, then exits with $BASIL_STATUS
+FAKE_BASIL = """#!/bin/sh
+[ -n "$BASIL_RUNS" ] && echo run >> "$BASIL_RUNS"
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -o) echo "procedure main();" > "$2"; shift ;;
+        --dump-il) echo "main" > "$2"; shift ;;
+    esac
+    shift
+done
+exit "${BASIL_STATUS:-0}"
+"""
+
+
+class ToolTestCase(unittest.TestCase):
+    """
+    Runs basil-tool.py as a command, with fake tools first on the PATH and a
+    cache of its own.
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.bin = os.path.join(self.dir, "bin")
+        self.cache = os.path.join(self.dir, "cache")
+        os.makedirs(self.bin)
+        self.fake_tool("bap", FAKE_BAP)
+        self.fake_tool("basil", FAKE_BASIL)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def fake_tool(self, name, script):
+        path = os.path.join(self.bin, name)
+        with open(path, 'w') as f:
+            f.write(script)
+        os.chmod(path, 0o755)
+
+    def compile(self, name, source=C_SOURCE):
+        c_file = os.path.join(self.dir, name + ".c")
+        with open(c_file, 'w') as f:
+            f.write(source)
+        path = os.path.join(self.dir, name)
+        subprocess.run([GCC, c_file, "-o", path], check=True)
+        return path
+
+    def tool_command(self, args, env):
+        full_env = dict(os.environ, PATH=self.bin + os.pathsep + os.environ["PATH"],
+                        BASIL_TOOL_SOCKET=os.path.join(self.dir, "no-daemon.sock"), **env)
+        for name in ["BASIL_TOOL_METRICS", "BASIL_TOOL_METRICS_LOG", "BASIL_TOOL_REMOTE_CACHE", "BASIL_WORKER_CMD"]:
+            full_env.pop(name, None)
+        return [sys.executable, TOOL, "--cache-dir", self.cache] + list(args), full_env
+
+    def run_tool(self, *args, **env):
+        command, env = self.tool_command(args, env)
+        return subprocess.run(command, env=env, capture_output=True, text=True, timeout=120)
+
+    def start_tool(self, *args, **env):
+        command, env = self.tool_command(args, env)
+        return subprocess.Popen(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+    def runs(self, name):
+        path = os.path.join(self.dir, name)
+        if not os.path.exists(path):
+            return 0
+        with open(path, 'r') as f:
+            return len(f.readlines())
+
+    def cache_outcomes(self, stage):
+        """
+        The cache outcome of `stage` in each request so far, from the metrics log.
+        """
+        with open(os.path.join(self.cache, "metrics.jsonl"), 'r') as f:
+            requests = [json.loads(line) for line in f]
+        return [s["cache"] for r in requests for s in r["stages"] if s["stage"] == stage]
+
+    def query(self, db, sql, params=()):
+        con = basil_tool.sqlite3.connect(db)
+        try:
+            return con.execute(sql, params).fetchall()
+        finally:
+            con.close()
+
+
+@unittest.skipUnless(GCC, "needs gcc")
+class BatchTests(ToolTestCase):
+    def test_two_binaries(self):
+        first = self.compile("first")
+        second = self.compile("second", C_SOURCE.replace("counter = 3", "counter = 4"))
+        manifest = os.path.join(self.dir, "manifest.jsonl")
+        with open(manifest, 'w') as f:
+            for binary in [first, second]:
+                f.write(json.dumps({"binary": binary, "tool": "basil", "output": "adt"}) + "\n")
+                f.write(json.dumps({"binary": binary, "tool": "readelf"}) + "\n")
+        result = self.run_tool("--batch", manifest, "-j", "2")
+        self.assertEqual(result.returncode, 0, result.stderr)
+        reports = [json.loads(line) for line in result.stdout.splitlines()]
+        self.assertEqual(sorted(r["record"] for r in reports), [0, 1, 2, 3])
+        self.assertEqual({r["status"] for r in reports}, {0})
+        self.assertEqual(len({r["binary_hash"] for r in reports}), 2)
+        for report in reports:
+            self.assertTrue(os.path.exists(report["path"]))
+        index = basil_tool.sqlite3.connect(os.path.join(self.cache, "index.db"))
+        self.assertEqual(index.execute("PRAGMA integrity_check;").fetchone(), ("ok",))
+        index.close()
+
+
+@unittest.skipUnless(GCC, "needs gcc")
+class CacheTests(ToolTestCase):
+    def setUp(self):
+        super().setUp()
+        self.binary = self.compile("prog")
+        self.bap_runs = os.path.join(self.dir, "bap-runs")
+        self.basil_runs = os.path.join(self.dir, "basil-runs")
+
+    def lift(self, **env):
+        return self.run_tool("-t", "basil", "-o", "adt", self.binary, BAP_RUNS=self.bap_runs, **env)
+
+    def job_db(self):
+        [entry] = [d for d in os.listdir(self.cache) if os.path.exists(os.path.join(self.cache, d, "cache.db"))]
+        return os.path.join(self.cache, entry, "cache.db")
+
+    def test_hit(self):
+        first = self.lift()
+        second = self.lift()
+        self.assertEqual(first.returncode, 0, first.stderr)
+        self.assertEqual(second.stdout, first.stdout)
+        self.assertEqual(self.runs("bap-runs"), 1)
+        self.assertEqual(self.cache_outcomes("bap"), ["miss", "hit"])
+
+    def test_failed_job_not_cached(self):
+        for _ in range(2):
+            failed = self.run_tool("-t", "basil", "-o", "boogie", self.binary, BASIL_RUNS=self.basil_runs,
+                                   BASIL_STATUS="1")
+            self.assertNotEqual(failed.returncode, 0)
+        self.assertEqual(self.runs("basil-runs"), 2)
+        fixed = self.run_tool("-t", "basil", "-o", "boogie", self.binary, BASIL_RUNS=self.basil_runs)
+        self.assertEqual(fixed.returncode, 0, fixed.stderr)
+        self.assertEqual(fixed.stdout.strip(), "procedure main();")
+        self.assertEqual(self.runs("basil-runs"), 3)
+        self.assertEqual(self.cache_outcomes("basil"), ["miss", "miss", "miss"])
+
+    def test_single_flight(self):
+        requests = [self.start_tool("-t", "basil", "-o", "adt", self.binary, BAP_RUNS=self.bap_runs, BAP_SLEEP="1")
+                    for _ in range(3)]
+        outputs = set()
+        for request in requests:
+            out, err = request.communicate(timeout=120)
+            self.assertEqual(request.returncode, 0, err)
+            outputs.add(out)
+        self.assertEqual(len(outputs), 1)
+        self.assertEqual(self.runs("bap-runs"), 1)
+
+    def test_claim_takeover(self):
+        self.assertEqual(self.lift().returncode, 0)
+        db = self.job_db()
+        [(job,)] = self.query(db, "SELECT DISTINCT job FROM jobs WHERE job LIKE 'bap %';")
+        dead = subprocess.Popen(["true"])
+        dead.wait()
+        con = basil_tool.sqlite3.connect(db)
+        with con:
+            con.execute("DELETE FROM jobs WHERE job=?;", [job])
+            con.execute("INSERT INTO jclaimed VALUES (?, ?, ?);", [job, dead.pid, 0])
+        con.close()
+        # waiting on the dead claim would run into the test's timeout
+        result = self.lift()
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(self.runs("bap-runs"), 2)
+        self.assertEqual(self.query(db, "SELECT * FROM jclaimed;"), [])
+
+    def test_cancel_while_queued(self):
+        self.assertEqual(self.run_tool("-t", "readelf", self.binary).returncode, 0)
+        index = os.path.join(self.cache, "index.db")
+        holder = subprocess.Popen(["sleep", "60"])
+        self.addCleanup(holder.wait)
+        self.addCleanup(holder.kill)
+        con = basil_tool.sqlite3.connect(index)
+        with con:
+            con.execute("INSERT INTO admission (stage, priority, pid, enqueued, admitted) VALUES ('bap', 0, ?, 0, 0);",
+                        [holder.pid])
+        con.close()
+        request = self.start_tool("-t", "basil", "-o", "adt", self.binary, BASIL_TOOL_SLOTS="bap=1,total=1",
+                                  BASIL_TOOL_ADMISSION_TIMEOUT="60")
+        deadline = time.monotonic() + 30
+        while self.query(index, "SELECT count(*) FROM admission;") == [(1,)]:
+            self.assertLess(time.monotonic(), deadline, "the request never queued")
+            time.sleep(0.1)
+        start = time.monotonic()
+        request.send_signal(signal.SIGTERM)
+        request.communicate(timeout=30)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(request.returncode, 128 + signal.SIGTERM)
+        self.assertEqual(self.query(index, "SELECT pid FROM admission;"), [(holder.pid,)])
+        self.assertEqual(self.query(self.job_db(), "SELECT * FROM jclaimed;"), [])
+        self.assertEqual(self.runs("bap-runs"), 0)
+
+
+class EvictionTests(unittest.TestCase):
+    def setUp(self):
+        self.cache = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.cache, "entry"))
+        basil_tool.touch_entry(self.cache, "entry", 0)
+
+    def tearDown(self):
+        basil_tool.CacheDB.forget(os.path.join(self.cache, "index.db"))
+        shutil.rmtree(self.cache)
+
+    def test_entry_in_use(self):
+        lock = basil_tool.lock_entry(self.cache, "entry")
+        self.assertFalse(basil_tool.evict_entry(self.cache, "entry"))
+        self.assertEqual(basil_tool.cleanup_tempdirs(self.cache, max_bytes=0, max_entries=0, max_age=0), 0)
+        self.assertTrue(os.path.isdir(os.path.join(self.cache, "entry")))
+        lock.close()
+        self.assertTrue(basil_tool.evict_entry(self.cache, "entry"))
+        self.assertFalse(os.path.exists(os.path.join(self.cache, "entry")))
+        self.assertEqual(os.listdir(os.path.join(self.cache, "locks")), [])
+        self.assertEqual(basil_tool.index_db(self.cache).query("SELECT entry FROM entries;"), [])
+
+    def test_lock_after_eviction(self):
+        self.assertTrue(basil_tool.evict_entry(self.cache, "entry"))
+        with basil_tool.lock_entry(self.cache, "entry"):
+            self.assertEqual(os.listdir(os.path.join(self.cache, "locks")), ["entry.lock"])
+            self.assertFalse(basil_tool.evict_entry(self.cache, "entry"))
+
+
+class AdmissionTests(unittest.TestCase):
+    def setUp(self):
+        self.con = basil_tool.sqlite3.connect(":memory:")
+        self.con.execute(basil_tool.ADMISSION_TABLE)
+        self.slots = {"bap": 4, "basil": 4, "boogie": 4, "total": 4, "cores": 4, "memory": 0}
+
+    def enqueue(self, stage, priority, processes=1):
+        return self.con.execute("INSERT INTO admission (stage, priority, pid, enqueued, processes) VALUES (?, ?, ?, ?, ?);",
+                                [stage, priority, os.getpid(), time.time(), processes]).lastrowid
+
+    def admit(self):
+        basil_tool.admit_waiting(self.con, self.slots)
+        return {ticket for (ticket,) in self.con.execute("SELECT ticket FROM admission WHERE admitted IS NOT NULL;")}
+
+    def finish(self, ticket):
+        self.con.execute("DELETE FROM admission WHERE ticket=?;", [ticket])
+
+    def test_boogie_not_starved(self):
+        lifts = [self.enqueue("bap", basil_tool.PRIORITY_CACHE_FILL) for _ in range(4)]
+        self.assertEqual(self.admit(), set(lifts))
+        boogie = self.enqueue("boogie", basil_tool.PRIORITY_UNCACHED, processes=4)
+        self.assertEqual(self.admit(), set(lifts))
+        # a cache fill arriving later doesn't overtake the held Boogie ticket
+        later = self.enqueue("bap", basil_tool.PRIORITY_CACHE_FILL)
+        self.finish(lifts[0])
+        self.assertEqual(self.admit(), set(lifts[1:]))
+        for ticket in lifts[1:]:
+            self.finish(ticket)
+        self.assertEqual(self.admit(), {boogie})
+        self.finish(boogie)
+        self.assertEqual(self.admit(), {later})
+
+    def test_shards_take_cores(self):
+        first = self.enqueue("boogie", basil_tool.PRIORITY_UNCACHED, processes=2)
+        second = self.enqueue("boogie-source", basil_tool.PRIORITY_UNCACHED, processes=2)
+        third = self.enqueue("boogie", basil_tool.PRIORITY_UNCACHED, processes=1)
+        self.assertEqual(self.admit(), {first, second})
+        self.finish(first)
+        self.assertEqual(self.admit(), {second, third})
+
+    def test_prefetch_stays_behind(self):
+        lifts = [self.enqueue("bap", basil_tool.PRIORITY_CACHE_FILL) for _ in range(4)]
+        prefetch = self.enqueue("bap", basil_tool.PRIORITY_PREFETCH)
+        self.admit()
+        later = self.enqueue("basil", basil_tool.PRIORITY_UNCACHED)
+        self.finish(lifts[0])
+        self.assertIn(later, self.admit())
+        self.assertNotIn(prefetch, self.admit())
+
+
+if __name__ == '__main__':
+    unittest.main()